@@ -0,0 +1,128 @@
+"""
+后台列表页的分页、排序和行片段缓存 (app.py 与 app_server.py 共用)。
+
+列表按 id 或名称排序，用键集游标 (?after= / ?before=) 翻页，每页固定 ADMIN_PAGE_SIZE 行，
+查询沿主键或 name 索引读取，耗时与目录大小无关。
+每一行渲染好的 HTML 按 (软件 id, 行版本号) 缓存，行版本号取自 software_changes，
+目录变化后重建页面时只需重新渲染被修改过的行。
+"""
+import json
+import threading
+from collections import OrderedDict
+from flask import request
+from catalog_db import encode_cursor, decode_cursor
+
+ADMIN_PAGE_SIZE = 50
+# 排序参数 -> (列, 是否倒序)；只允许有索引的列，保证每页都是一次索引范围扫描
+ADMIN_SORTS = {
+    '-id': ('id', True),
+    'id': ('id', False),
+    'name': ('name', False),
+    '-name': ('name', True),
+}
+DEFAULT_ADMIN_SORT = '-id'
+ADMIN_SORT_LABELS = {
+    '-id': '最新添加',
+    'id': '最早添加',
+    'name': '名称 A-Z',
+    '-name': '名称 Z-A',
+}
+
+
+class AdminPage:
+    """一页列表：rows 为带 row_revision 列的软件行，prev / next 为翻页游标 (没有时为 None)"""
+
+    __slots__ = ('sort', 'rows', 'prev_cursor', 'next_cursor')
+
+    def __init__(self, sort, rows, prev_cursor, next_cursor):
+        self.sort = sort
+        self.rows = rows
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+
+
+def admin_page_args():
+    """读取 ?sort=&after=&before=，无效的参数按默认值处理；返回 (sort, after, before)"""
+    sort = request.args.get('sort', DEFAULT_ADMIN_SORT)
+    if sort not in ADMIN_SORTS:
+        sort = DEFAULT_ADMIN_SORT
+    after = request.args.get('after')
+    before = request.args.get('before') if after is None else None
+    return sort, after, before
+
+
+def _encode_position(sort, row):
+    column, _ = ADMIN_SORTS[sort]
+    # 名称可能重复 (app.py 的表没有 UNIQUE 约束)，游标同时记录 id
+    return encode_cursor(json.dumps([row[column], row['id']], ensure_ascii=False))
+
+
+def _decode_position(cursor):
+    try:
+        value, row_id = json.loads(decode_cursor(cursor) or '')
+        return value, int(row_id)
+    except (ValueError, TypeError):
+        return None
+
+
+def read_admin_page(conn, sort, after=None, before=None, limit=ADMIN_PAGE_SIZE):
+    """按键集游标读取一页软件；游标无效时返回第一页"""
+    column, descending = ADMIN_SORTS[sort]
+    position = _decode_position(after or before) if (after or before) else None
+    backwards = before is not None and position is not None
+    # 向前翻页时反向扫描，取到后再倒回来
+    reverse = descending != backwards
+    order = 'DESC' if reverse else 'ASC'
+    sql = 'SELECT s.*, c.revision AS row_revision FROM software s LEFT JOIN software_changes c ON c.software_id = s.id'
+    params = []
+    if position is not None:
+        sql += f" WHERE (s.{column}, s.id) {'<' if reverse else '>'} (?, ?)"
+        params += list(position)
+    sql += f' ORDER BY s.{column} {order}, s.id {order} LIMIT ?'
+    params.append(limit + 1)
+
+    rows = conn.execute(sql, params).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backwards:
+        rows.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = position is not None, has_more
+
+    prev_cursor = _encode_position(sort, rows[0]) if rows and has_prev else None
+    next_cursor = _encode_position(sort, rows[-1]) if rows and has_next else None
+    return AdminPage(sort, rows, prev_cursor, next_cursor)
+
+
+def admin_page_key(sort, after, before):
+    """整页缓存 (按目录版本) 和 ETag 使用的键"""
+    return f"list:{sort}:{after or ''}:{before or ''}"
+
+
+class RowFragmentCache:
+    """按 (软件 id, 行版本号) 缓存渲染好的表格行 HTML，LRU 淘汰"""
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # 命中 / 未命中次数，供 metrics.py 采集 (不加锁递增，是近似值)
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, row, render_row):
+        """row 需包含 row_revision 列；缓存未命中时调用 render_row(dict(row))"""
+        key = (row['id'], row['row_revision'])
+        html = self._entries.get(key)
+        if html is not None:
+            self.hits += 1
+            return html
+        self.misses += 1
+        html = render_row(dict(row))
+        with self._lock:
+            self._entries[key] = html
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return html
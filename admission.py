@@ -0,0 +1,277 @@
+"""
+安装包下载的准入控制和带宽整形 (app.py 的 /download/)。
+
+强制更新发布时所有客户端会同时开始下载，慢速下载长时间占住服务线程，目录接口和后台页面随之变慢。这里：
+  - 限制同时发送的安装包数 (DOWNLOAD_MAX_ACTIVE)，超出的请求在队列中最多等待 DOWNLOAD_QUEUE_TIMEOUT 秒，
+    队列已满或等待超时返回 503 + Retry-After；
+  - 限制每个客户端 IP 同时进行 (含排队) 的下载数 (DOWNLOAD_PER_CLIENT)，超出返回 429 + Retry-After；
+    位于反向代理之后时用 DOWNLOAD_TRUSTED_PROXIES 指定代理层数，客户端 IP 取 X-Forwarded-For 中
+    从右数第 N 个地址 (与 werkzeug ProxyFix 的 x_for 相同)；未设置而对端是本机或 unix socket 时，
+    对端只是代理，不做按客户端限制 (否则所有客户端共用一个名额)；
+  - 可选令牌桶限速：DOWNLOAD_RATE_LIMIT 为所有下载合计的字节/秒，DOWNLOAD_CLIENT_RATE_LIMIT 为单个下载的上限；
+  - 由 serve.py 运行时，下载 (含排队) 最多占用 --threads 减去 DOWNLOAD_RESERVED_THREADS 个线程，
+    剩余线程始终留给目录接口和后台页面。
+Retry-After 带随机抖动，避免被拒绝的客户端同时重试。计数按进程统计 (serve.py 的每个 worker 分别限制)。
+只有需要发送文件内容的请求 (200 / 206) 才占用名额，304 和 HEAD 直接返回；
+交给 nginx 发送文件 (APPSTORE_FILE_OFFLOAD) 时不做限制，请改用 nginx 的 limit_conn / limit_rate。
+各项配置为 0 表示不限制，可用同名的 APPSTORE_ 环境变量设置 (限速支持 K / M 后缀，如 50M)。
+"""
+import os
+import time
+import random
+import threading
+from collections import deque
+from flask import request, jsonify, current_app
+from metrics import registry as metrics_registry
+
+DEFAULT_ADMISSION_CONFIG = {
+    'DOWNLOAD_MAX_ACTIVE': 4,
+    'DOWNLOAD_MAX_QUEUE': 2,
+    'DOWNLOAD_QUEUE_TIMEOUT': 10.0,
+    'DOWNLOAD_PER_CLIENT': 2,
+    'DOWNLOAD_TRUSTED_PROXIES': 0,
+    'DOWNLOAD_RATE_LIMIT': 0,
+    'DOWNLOAD_CLIENT_RATE_LIMIT': 0,
+    'DOWNLOAD_RESERVED_THREADS': 2,
+    'DOWNLOAD_RETRY_AFTER': 30,
+}
+# serve.py 在 WSGI environ 中提供每个 worker 的线程数
+THREADS_ENVIRON_KEY = 'appstore.threads'
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024 * 1024, 'G': 1024 * 1024 * 1024}
+QUEUE_WAIT_BUCKETS = (0.001, 0.01, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# 对端是这些地址 (或没有地址的 unix socket) 时视为同机的反向代理
+LOOPBACK_ADDRESSES = ('127.0.0.1', '::1')
+
+DOWNLOADS_ACTIVE = metrics_registry.gauge('appstore_downloads_active', '正在发送的安装包数')
+DOWNLOADS_QUEUED = metrics_registry.gauge('appstore_downloads_queued', '排队等待下载名额的请求数')
+DOWNLOAD_REJECTIONS = metrics_registry.counter('appstore_download_rejections_total', '被拒绝的下载请求数',
+                                               ('reason',))
+DOWNLOAD_QUEUE_WAIT = metrics_registry.histogram('appstore_download_queue_wait_seconds', '获得下载名额前的等待时间',
+                                                 buckets=QUEUE_WAIT_BUCKETS)
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason, status):
+        super().__init__(reason)
+        self.reason = reason
+        self.status = status
+
+
+def client_address(remote_addr, forwarded_for, trusted_proxies):
+    """
+    按客户端限制时使用的地址：设置了代理层数时取 X-Forwarded-For 从右数第 N 个地址 (层数不足时用对端地址)；
+    未设置且对端是本机或 unix socket 时返回 None，表示无法区分客户端。
+    """
+    if trusted_proxies:
+        values = [value.strip() for value in (forwarded_for or '').split(',') if value.strip()]
+        if len(values) >= trusted_proxies:
+            return values[-trusted_proxies]
+        return remote_addr or None
+    if not remote_addr or remote_addr in LOOPBACK_ADDRESSES:
+        return None
+    return remote_addr
+
+
+def parse_size(value):
+    """解析 "50M" / "512K" / "1048576" 形式的字节数"""
+    value = str(value).strip().upper().removesuffix('B')
+    if value and value[-1] in SIZE_SUFFIXES:
+        return int(float(value[:-1]) * SIZE_SUFFIXES[value[-1]])
+    return int(float(value or 0))
+
+
+class TokenBucket:
+    """令牌桶：consume() 先记账 (允许透支)，再按透支量睡眠；多个下载共用一个桶时大致平分带宽"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ShapedBody:
+    """包装响应体迭代器：发送每个块之前从令牌桶中取令牌，关闭时调用 on_close"""
+
+    def __init__(self, body, buckets, on_close):
+        self.body = body
+        self.buckets = buckets
+        self.on_close = on_close
+
+    def __iter__(self):
+        for chunk in self.body:
+            for bucket in self.buckets:
+                bucket.consume(len(chunk))
+            yield chunk
+
+    def close(self):
+        try:
+            close = getattr(self.body, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self.on_close()
+
+
+def hook_close(body, on_close):
+    """
+    让响应体关闭时调用 on_close。send_file 的响应是 direct_passthrough，WSGI 服务器直接拿到响应体，
+    response.call_on_close 注册的回调不会执行；不限速时在原对象上替换 close，保留 wsgi.file_wrapper (sendfile)。
+    """
+    original = getattr(body, 'close', None)
+
+    def close():
+        try:
+            if original is not None:
+                original()
+        finally:
+            on_close()
+    try:
+        body.close = close
+    except AttributeError:
+        return ShapedBody(body, (), on_close)
+    return body
+
+
+class DownloadAdmission:
+    """进程内的下载名额：全局并发上限 + 先进先出的等待队列 + 每个客户端的并发上限"""
+
+    def __init__(self, config):
+        self.config = config
+        self.active = 0
+        self._waiting = deque()
+        self._clients = {}
+        self._cond = threading.Condition()
+        rate = parse_size(config['DOWNLOAD_RATE_LIMIT'])
+        self._global_bucket = TokenBucket(rate) if rate > 0 else None
+
+    def limits(self, threads=None):
+        """返回 (并发上限, 队列长度)；已知线程数时保证下载 (含排队) 不占满全部线程"""
+        max_active = self.config['DOWNLOAD_MAX_ACTIVE'] or float('inf')
+        max_queue = self.config['DOWNLOAD_MAX_QUEUE']
+        if threads:
+            available = max(1, threads - self.config['DOWNLOAD_RESERVED_THREADS'])
+            max_active = min(max_active, available)
+            max_queue = min(max_queue, available - max_active)
+        return max_active, max_queue
+
+    def acquire(self, client, threads=None):
+        """取得一个下载名额，返回等待的秒数；无法取得时抛出 AdmissionRejected (client 为 None 时不按客户端限制)"""
+        max_active, max_queue = self.limits(threads)
+        per_client = self.config['DOWNLOAD_PER_CLIENT']
+        with self._cond:
+            if per_client and client is not None and self._clients.get(client, 0) >= per_client:
+                raise AdmissionRejected('client_limit', 429)
+            if self.active < max_active and not self._waiting:
+                self._admit(client)
+                return 0.0
+            if len(self._waiting) >= max_queue:
+                raise AdmissionRejected('queue_full', 503)
+
+            ticket = object()
+            self._waiting.append(ticket)
+            self._clients[client] = self._clients.get(client, 0) + 1
+            DOWNLOADS_QUEUED.inc()
+            started = time.monotonic()
+            deadline = started + self.config['DOWNLOAD_QUEUE_TIMEOUT']
+            try:
+                while not (self._waiting[0] is ticket and self.active < max_active):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._waiting.remove(ticket)
+                        self._forget_client(client)
+                        # 队首离开后，后面的请求可能已经可以开始
+                        self._cond.notify_all()
+                        raise AdmissionRejected('queue_timeout', 503)
+                    self._cond.wait(remaining)
+                self._waiting.popleft()
+                self._forget_client(client)
+                self._admit(client)
+                self._cond.notify_all()
+                return time.monotonic() - started
+            finally:
+                DOWNLOADS_QUEUED.dec()
+
+    def _admit(self, client):
+        self.active += 1
+        self._clients[client] = self._clients.get(client, 0) + 1
+        DOWNLOADS_ACTIVE.inc()
+
+    def _forget_client(self, client):
+        count = self._clients.get(client, 0) - 1
+        if count > 0:
+            self._clients[client] = count
+        else:
+            self._clients.pop(client, None)
+
+    def release(self, client):
+        with self._cond:
+            self.active -= 1
+            self._forget_client(client)
+            self._cond.notify_all()
+        DOWNLOADS_ACTIVE.dec()
+
+    def retry_after(self):
+        """带 ±50% 随机抖动的重试等待秒数"""
+        return max(1, int(self.config['DOWNLOAD_RETRY_AFTER'] * random.uniform(0.5, 1.5)))
+
+    def admit(self, response):
+        """
+        为发送文件内容的响应申请下载名额：取得后包装响应体 (限速)，并在响应体关闭 (发送结束或连接断开) 时归还名额；
+        无法取得时关闭文件，返回 429 / 503 响应。
+        """
+        if (request.method != 'GET' or response.status_code not in (200, 206)
+                or current_app.config.get('FILE_OFFLOAD')):
+            return response
+        client = client_address(request.remote_addr, request.headers.get('X-Forwarded-For'),
+                                self.config['DOWNLOAD_TRUSTED_PROXIES'])
+        try:
+            waited = self.acquire(client, request.environ.get(THREADS_ENVIRON_KEY))
+        except AdmissionRejected as e:
+            response.close()
+            DOWNLOAD_REJECTIONS.inc((e.reason,))
+            rejected = jsonify({'error': 'Too many concurrent downloads, retry later', 'reason': e.reason})
+            rejected.status_code = e.status
+            rejected.headers['Retry-After'] = str(self.retry_after())
+            return rejected
+        DOWNLOAD_QUEUE_WAIT.observe((), waited)
+
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                self.release(client)
+
+        buckets = [bucket for bucket in (self._global_bucket, self._client_bucket()) if bucket is not None]
+        if buckets:
+            response.response = ShapedBody(response.response, buckets, release)
+        else:
+            response.response = hook_close(response.response, release)
+        return response
+
+    def _client_bucket(self):
+        rate = parse_size(self.config['DOWNLOAD_CLIENT_RATE_LIMIT'])
+        return TokenBucket(rate, burst=rate // 4 or None) if rate > 0 else None
+
+
+def init_download_admission(app):
+    """读取环境变量设置默认配置，返回 DownloadAdmission"""
+    for key, default in DEFAULT_ADMISSION_CONFIG.items():
+        value = os.environ.get(f'APPSTORE_{key}')
+        if value is not None and not key.endswith('RATE_LIMIT'):
+            # 限速保留字符串 (支持 K / M 后缀)，其余按默认值的类型转换
+            value = type(default)(value)
+        app.config.setdefault(key, default if value is None else value)
+    return DownloadAdmission(app.config)
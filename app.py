@@ -1,44 +1,101 @@
-import sqlite3
 import os
 import re
 import base64
-import uuid
-from flask import Flask, jsonify, request, g, redirect, url_for, send_from_directory, abort
+import click
+from flask import Flask, jsonify, request, g, redirect, url_for, send_from_directory, abort, Response
 # 导入 CORS 和 cross_origin
 from flask_cors import CORS, cross_origin 
 from werkzeug.utils import secure_filename
+from catalog_db import get_connection_pool, ensure_index, init_catalog_schema, get_catalog_revision, read_catalog_rows, read_catalog_changes, compact_change_log, select_software_columns
+from catalog_db import init_version_history, list_software_versions, latest_software_versions
+from catalog_cache import CatalogSnapshotCache, snapshot_response
+from logo_store import send_logo, generate_thumbnails, backfill_thumbnails, thumbnails_available, THUMBNAIL_ERRORS
+from logo_store import LogoSpriteCache, sprite_request_args, SPRITE_MAX_AGE
+from logo_store import store_logo_chunks, iter_stream, iter_base64_chunks, LogoTooLargeError, MAX_LOGO_BYTES
+from logo_store import logo_relative_path, load_logo_references, collect_orphan_logos, OrphanLogoCollector
+from package_store import find_package, send_package, init_package_schema, update_package_checksums, store_package, find_software_for_package, PackageHasher, PACKAGE_CHUNK_SIZE
+from package_store import restore_software_with_package, PackageVersionUnavailable
+from package_delta import init_delta_schema, refresh_package_deltas, deltas_available, DELTA_CLI_MAX_BYTES
+from file_offload import init_file_offload, check_file_offload
+from compression import init_compression, negotiate_encoding, PrecompressedCache, apply_encoding
+from admin_list import admin_page_args, admin_page_key, read_admin_page, RowFragmentCache, ADMIN_SORT_LABELS
+from http_cache import catalog_etag, is_not_modified, not_modified_response, query_variant, set_cache_validators
+from metrics import init_metrics, metrics_response, flush_metrics, registry as metrics_registry
+from profiling import init_profiling
+from admission import init_download_admission
 
 # --- 全局配置 ---
 app = Flask(__name__)
 app.config['DATABASE'] = 'appstore.db'
 
 # 启用 CORS，允许所有域名的前端访问 API 接口
-CORS(app) 
+CORS(app, expose_headers=['ETag', 'X-Catalog-Revision', 'X-Next-Cursor', 'Link']) 
 
 # --- 图片存储配置 ---
 APP_ROOT = os.path.dirname(os.path.abspath(__file__))
 UPLOAD_FOLDER = os.path.join(APP_ROOT, 'logos')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# 单个 Logo 上传的大小上限 (字节)，超出时返回 413
+app.config['MAX_LOGO_BYTES'] = MAX_LOGO_BYTES
 
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
+# --- 安装包存储配置 ---
+# /download/<文件名> 优先从该目录提供真实安装包，找不到时返回占位文件
+PACKAGE_FOLDER = os.path.join(APP_ROOT, 'packages')
+app.config['PACKAGE_FOLDER'] = PACKAGE_FOLDER
+
+if not os.path.exists(PACKAGE_FOLDER):
+    os.makedirs(PACKAGE_FOLDER)
+
+# 按需分析单个请求 (X-Profile 请求头，仅限本机或令牌)，结果见 /debug/profiles；需最先注册
+init_profiling(app)
+# 请求计时和数据库语句计时 (/metrics)，需在 init_compression 之前注册
+init_metrics(app)
+# 按 Accept-Encoding 压缩较大的文本响应 (gzip，安装 brotli 后优先 br)
+init_compression(app)
+# 安装包和 Logo 可交给 nginx (X-Accel-Redirect) 或 Apache (X-Sendfile) 发送，见 file_offload.py
+init_file_offload(app)
+# 下载准入控制：限制同时发送的安装包数和每个客户端的并发数，可选限速
+download_admission = init_download_admission(app)
+
+# 后台计算安装包校验和的线程
+package_hasher = PackageHasher(after_update=refresh_package_deltas)
+# 已编码的 /api/software 响应快照，写操作提交后失效
+catalog_snapshot = CatalogSnapshotCache()
+# 后台列表页 (无搜索词时) 各分页的 HTML 及其压缩版本，按目录版本号缓存
+admin_page_cache = PrecompressedCache(max_entries=64)
+# 后台列表每一行的 HTML，按行版本号缓存
+row_fragments = RowFragmentCache()
+# 按目录版本缓存的 Logo 雪碧图
+logo_sprites = LogoSpriteCache()
+
+# 缓存命中率由 /metrics 输出
+metrics_registry.register_cache('catalog_snapshot', catalog_snapshot)
+metrics_registry.register_cache('admin_page', admin_page_cache)
+metrics_registry.register_cache('admin_row', row_fragments)
+metrics_registry.register_cache('logo_sprite', logo_sprites)
+# /api/software 分页时每页的最大条数
+CATALOG_PAGE_MAX = 500
+# 版本历史接口每页的最大条数
+VERSIONS_PAGE_MAX = 100
+
 # --- 数据库连接管理 (省略，保持不变) ---
 
 def get_db_connection():
-    """建立数据库连接，并在 g 对象上缓存"""
+    """从连接池取出数据库连接 (WAL 模式，行工厂为 sqlite3.Row)，并在 g 对象上缓存"""
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(app.config['DATABASE'])
-        db.row_factory = sqlite3.Row
+        db = g._database = get_connection_pool(app.config['DATABASE']).acquire()
     return db
 
 @app.teardown_appcontext
 def close_connection(exception):
-    """请求结束后关闭数据库连接"""
-    db = getattr(g, '_database', None)
+    """请求结束后把数据库连接归还连接池"""
+    db = g.pop('_database', None)
     if db is not None:
-        db.close()
+        get_connection_pool(app.config['DATABASE']).release(db)
 
 def init_db():
     """初始化数据库表结构"""
@@ -56,6 +113,16 @@ def init_db():
                 silent_args TEXT
             );
         ''')
+        # 支持 ORDER BY name / WHERE name = ? 的索引 (name 已有 UNIQUE 索引时跳过)
+        ensure_index(db, 'idx_software_name', 'software', ('name',))
+        # 目录版本号表及触发器，供 /api/software 的条件请求使用
+        init_catalog_schema(db)
+        # 安装包的 sha256 / size_bytes 列
+        init_package_schema(db)
+        # 相邻版本之间的差分补丁
+        init_delta_schema(db)
+        # 版本历史表 (每次发布追加一行)
+        init_version_history(db)
         # 检查是否需要插入初始数据
         if db.execute('SELECT COUNT(*) FROM software').fetchone()[0] == 0:
             initial_data = [
@@ -71,22 +138,102 @@ def init_db():
             """, initial_data)
         db.commit()
 
-# 在应用启动时初始化数据库
-init_db()
+# 占位 Logo (1x1 透明像素的 PNG)
+DEFAULT_PNG_DATA = b'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=='
+
+def bootstrap():
+    """
+    启动前的一次性初始化：占位下载文件、默认 Logo、数据库表结构和安装包校验和。
+    由 serve.py 在主进程中调用 (或 python app.py 启动开发服务器前)，fork 出的 worker 不再重复；
+    校验和在这里同步计算，避免主进程 fork 时还有后台线程在运行。
+    """
+    # 确保 placeholder.txt 存在，用于虚拟下载
+    placeholder_path = os.path.join(APP_ROOT, 'placeholder.txt')
+    if not os.path.exists(placeholder_path):
+        with open(placeholder_path, 'w', encoding='utf-8') as f:
+            f.write('This is a placeholder file for software download demonstration.')
+
+    # 确保默认 logo 存在
+    default_logo_path = os.path.join(UPLOAD_FOLDER, 'default.png')
+    if not os.path.exists(default_logo_path):
+        try:
+            with open(default_logo_path, 'wb') as f:
+                f.write(base64.b64decode(DEFAULT_PNG_DATA))
+        except Exception as e:
+            print(f"Could not create default logo: {e}")
+
+    init_db()
+    with app.app_context():
+        # 为尚未计算校验和的本地安装包补算 sha256 / size_bytes，并生成差分补丁
+        conn = get_db_connection()
+        update_package_checksums(conn, app.config['PACKAGE_FOLDER'])
+        refresh_package_deltas(conn, app.config['PACKAGE_FOLDER'])
+
+
+def worker_exit():
+    """serve.py 的 worker 退出前调用：写出最后一份运行指标快照"""
+    flush_metrics()
+
 
 # --- 辅助函数：Logo/Download URL 处理 ---
 
-@app.route('/download/<filename>', methods=['GET'])
+@app.route('/download/<path:filename>', methods=['GET'])
 def download_file(filename):
-    """虚拟下载路由，返回一个占位符文件"""
-    return send_from_directory(APP_ROOT, 'placeholder.txt', as_attachment=True, download_name=filename)
+    """下载安装包：packages 目录中存在时流式发送 (支持 Range 断点续传和 ETag)，否则返回占位符文件"""
+    if find_package(app.config['PACKAGE_FOLDER'], filename):
+        # 同时发送的安装包数有上限，超出时排队或返回 503 + Retry-After (见 admission.py)
+        return download_admission.admit(send_package(app.config['PACKAGE_FOLDER'], filename))
+    return send_from_directory(APP_ROOT, 'placeholder.txt', as_attachment=True, download_name=os.path.basename(filename))
+
+
+@app.route('/api/packages/<path:filename>', methods=['PUT'])
+def upload_package(filename):
+    """API：上传安装包到 packages 目录 (请求体为文件原始字节)，边写边计算 SHA-256，并更新引用它的软件"""
+    try:
+        sha256, size_bytes = store_package(app.config['PACKAGE_FOLDER'], filename, iter_stream(request.stream, PACKAGE_CHUNK_SIZE))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # 只更新下载链接指向这个文件的软件；store_package 已把摘要放入缓存，这里不会重新读取文件
+    conn = get_db_connection()
+    update_package_checksums(conn, app.config['PACKAGE_FOLDER'], find_software_for_package(conn, filename))
+    # 校验和已更新，后台只需为新版本生成差分补丁
+    package_hasher.schedule(app.config['DATABASE'], app.config['PACKAGE_FOLDER'], [])
+    return jsonify({
+        'filename': filename,
+        'download_url': f"{get_base_url()}/download/{filename}",
+        'sha256': sha256,
+        'size_bytes': size_bytes,
+    }), 201
 
 
-@app.route('/logos/<filename>', methods=['GET'])
+@app.route('/logos/<path:filename>', methods=['GET'])
 @cross_origin() # <--- 关键修复: 显式启用 Logo 路由的 CORS
 def serve_logo(filename):
-    """提供存储在 'logos' 文件夹中的 Logo 文件"""
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    """提供存储在 'logos' 文件夹中的 Logo 文件，?size=40 等参数返回对应尺寸的缩略图"""
+    return send_logo(app.config['UPLOAD_FOLDER'], filename)
+
+def create_logo_thumbnails(filename):
+    """上传后立即生成缩略图；图片无法解析时只记录日志，原文件仍可使用"""
+    try:
+        generate_thumbnails(app.config['UPLOAD_FOLDER'], filename)
+    except THUMBNAIL_ERRORS as e:
+        app.logger.warning(f"Thumbnail generation failed for {filename}: {e}")
+
+def save_logo(chunks, ext):
+    """分块写入并按内容哈希保存 Logo，相同内容只保存一份；新文件立即生成缩略图。返回 /logos/ 开头的相对 URL"""
+    relpath, created = store_logo_chunks(app.config['UPLOAD_FOLDER'], chunks, ext, app.config['MAX_LOGO_BYTES'])
+    if created:
+        create_logo_thumbnails(relpath)
+    return f"/logos/{relpath}"
+
+def load_logo_references_for_gc():
+    """后台清理线程中读取当前被引用的 Logo"""
+    with app.app_context():
+        return load_logo_references(get_db_connection())
+
+# 修改或删除软件后在后台清理不再被引用的 Logo
+logo_collector = OrphanLogoCollector(load_logo_references_for_gc)
 
 def get_base_url():
     """获取应用的根 URL (用于构建绝对链接)"""
@@ -97,73 +244,202 @@ def get_base_url():
 
 @app.route('/api/upload_logo', methods=['POST'])
 def upload_logo():
-    """处理 Logo 文件上传和 Base64 截图粘贴上传。"""
-    if 'file' in request.files and request.files['file'].filename:
-        # 1. 处理文件上传 (来自 <input type="file">)
-        file = request.files['file']
-        filename = secure_filename(file.filename)
-        unique_filename = str(uuid.uuid4()) + os.path.splitext(filename)[1]
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        try:
-            file.save(filepath)
-            logo_url = f"/logos/{unique_filename}"
-            return jsonify({'logo_url': logo_url, 'message': '文件上传成功'})
-        except Exception as e:
-            print(f"File save error: {e}")
-            return jsonify({'error': f'文件保存失败: {str(e)}'}), 500
+    """处理 Logo 上传：原始二进制 (Content-Type: image/*)、文件表单上传和 Base64 截图粘贴。"""
+    max_bytes = app.config['MAX_LOGO_BYTES']
+    if request.content_length is not None and request.content_length > max_bytes:
+        # 声明的长度已超限，不读取请求体直接拒绝
+        return jsonify({'error': f'Logo 文件不能超过 {max_bytes // (1024 * 1024)} MB'}), 413
 
-    elif 'base64_image' in request.form:
-        # 2. 处理 Base64 数据上传 (来自剪贴板粘贴)
-        base64_data = request.form['base64_image']
-        
-        if ',' in base64_data:
-            base64_data = base64_data.split(',', 1)[1]
-        
-        try:
-            image_data = base64.b64decode(base64_data)
-            unique_filename = str(uuid.uuid4()) + '.png'
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-            
-            with open(filepath, 'wb') as f:
-                f.write(image_data)
+    try:
+        if request.mimetype.startswith('image/'):
+            # 1. 原始二进制上传 (后台页面上传文件和粘贴截图都走这里)，分块写入磁盘
+            ext = request.mimetype.split('/')[-1].split('+')[0]
+            logo_url = save_logo(iter_stream(request.stream), ext)
+            return jsonify({'logo_url': logo_url, 'message': '上传成功'})
+
+        if 'file' in request.files and request.files['file'].filename:
+            # 2. 处理文件表单上传 (multipart/form-data)
+            file = request.files['file']
+            filename = secure_filename(file.filename)
+            logo_url = save_logo(iter_stream(file.stream), os.path.splitext(filename)[1])
+            return jsonify({'logo_url': logo_url, 'message': '文件上传成功'})
 
-            logo_url = f"/logos/{unique_filename}"
+        if 'base64_image' in request.form:
+            # 3. 处理 Base64 数据上传 (兼容旧页面)，逐段解码，不再整体复制字符串
+            base64_data = request.form['base64_image']
+            start = base64_data.find(',', 0, 256) + 1
+            logo_url = save_logo(iter_base64_chunks(base64_data, start), 'png')
             return jsonify({'logo_url': logo_url, 'message': '截图粘贴成功'})
-            
-        except Exception as e:
-            print(f"Base64 decode or file write error: {e}")
-            return jsonify({'error': '无效的 Base64 图像数据或写入失败'}), 400
-            
+    except LogoTooLargeError:
+        return jsonify({'error': f'Logo 文件不能超过 {max_bytes // (1024 * 1024)} MB'}), 413
+    except ValueError as e:
+        return jsonify({'error': f'无效的图像数据: {e}'}), 400
+    except OSError as e:
+        print(f"File save error: {e}")
+        return jsonify({'error': f'文件保存失败: {str(e)}'}), 500
+
     return jsonify({'error': '没有找到文件或 Base64 数据'}), 400
 
 
 # --- API 路由 ---
 
+def serialize_software(row, base_url):
+    """将数据库行转换为 API 输出的字典，Logo 和下载链接改写为绝对路径"""
+    soft = dict(row)
+    # 确保 logo 和下载链接是绝对路径，方便前端 PWA 使用
+    if soft.get('logo_url'):
+        # 无论存储的是否是 http 链接，我们都使用 base_url 重新构建绝对路径，
+        # 以应对前端 PWA 跨域访问需求。
+        # 注意：这里我们提取了 Logo URL 在 logos 目录下的路径 (按哈希分目录存储)
+        logo_path = logo_relative_path(soft['logo_url']) or os.path.basename(soft['logo_url'])
+        soft['logo_url'] = f"{base_url}/logos/{logo_path}"
+        
+    if soft.get('download_url') and not soft['download_url'].startswith('http'):
+        soft['download_url'] = f"{base_url}/download/{os.path.basename(soft['download_url'])}"
+    if soft.get('delta_url'):
+        soft['delta_url'] = f"{base_url}{soft['delta_url']}"
+    return soft
+
+def build_catalog_snapshot():
+    """查询并编码完整的软件列表，供 catalog_snapshot 缓存"""
+    conn = get_db_connection()
+    revision, updated_at, software_list = read_catalog_rows(conn, 'SELECT * FROM software ORDER BY id DESC')
+    base_url = get_base_url()
+    result = [serialize_software(row, base_url) for row in software_list]
+    body = (app.json.dumps(result) + "\n").encode('utf-8')
+    return revision, updated_at, body
+
 @app.route('/api/software', methods=['GET'])
 def get_software_list():
-    """API：获取所有软件列表"""
+    """API：获取所有软件列表 (支持 ETag 条件请求)"""
+    if any(key in request.args for key in ('limit', 'after', 'fields')):
+        return get_software_page()
+
     conn = get_db_connection()
-    software_list = conn.execute('SELECT * FROM software ORDER BY id DESC').fetchall()
-    
-    result = []
+    revision, _ = get_catalog_revision(conn)
+    encoding = negotiate_encoding()
+    etag = catalog_etag(revision, encoding)
+    if is_not_modified(etag):
+        # 目录未变化，直接返回 304，不再查询和序列化软件表
+        return not_modified_response(etag)
+
+    # 目录有变化时也只在快照过期后重建一次，其余请求直接复用已编码的字节
+    snapshot = catalog_snapshot.get(revision, build_catalog_snapshot)
+    return snapshot_response(snapshot, encoding)
+
+def get_software_page():
+    """按游标分页并按需选择字段返回软件列表 (?limit=&after=&fields=)，游标为上一页最后一条的 id"""
+    # 不能用 default=：type=int 转换失败时 get 返回默认值，?limit=abc 会变成一整页
+    limit = request.args.get('limit', type=int)
+    after = request.args.get('after', type=int)
+    if ('limit' in request.args and (limit is None or limit < 1)) or ('after' in request.args and after is None):
+        return jsonify({'error': 'Invalid parameter: limit or after'}), 400
+    limit = min(limit or CATALOG_PAGE_MAX, CATALOG_PAGE_MAX)
+
+    conn = get_db_connection()
+    revision, _ = get_catalog_revision(conn)
+    etag = catalog_etag(revision, query_variant())
+    if is_not_modified(etag):
+        return not_modified_response(etag)
+
+    columns = ', '.join(select_software_columns(conn, request.args.get('fields')))
+    # id 是主键 (rowid)，按 id 倒序的游标分页直接走主键索引，与页码无关
+    if after is not None:
+        sql, params = f'SELECT {columns} FROM software WHERE id < ? ORDER BY id DESC LIMIT ?', (after, limit)
+    else:
+        sql, params = f'SELECT {columns} FROM software ORDER BY id DESC LIMIT ?', (limit,)
+    revision, updated_at, software_list = read_catalog_rows(conn, sql, params)
+
     base_url = get_base_url()
-    
-    for row in software_list:
-        soft = dict(row)
-        # 确保 logo 和下载链接是绝对路径，方便前端 PWA 使用
-        if soft.get('logo_url'):
-            # 无论存储的是否是 http 链接，我们都使用 base_url 重新构建绝对路径，
-            # 以应对前端 PWA 跨域访问需求。
-            # 注意：这里我们提取了 Logo URL 的文件名部分
-            logo_filename = os.path.basename(soft['logo_url'])
-            soft['logo_url'] = f"{base_url}/logos/{logo_filename}"
-            
-        if soft.get('download_url') and not soft['download_url'].startswith('http'):
-            soft['download_url'] = f"{base_url}/download/{os.path.basename(soft['download_url'])}"
-            
-        result.append(soft)
-        
-    return jsonify(result)
+    response = jsonify([serialize_software(row, base_url) for row in software_list])
+    if len(software_list) == limit:
+        next_cursor = software_list[-1]['id']
+        next_args = dict(request.args, after=next_cursor)
+        response.headers['X-Next-Cursor'] = str(next_cursor)
+        response.headers['Link'] = f'<{url_for("get_software_list", **next_args)}>; rel="next"'
+    response.headers['X-Catalog-Revision'] = str(revision)
+    return set_cache_validators(response, catalog_etag(revision, query_variant()))
+
+@app.route('/api/software/changes', methods=['GET'])
+def get_software_changes():
+    """API：返回 since 版本之后新增/修改/删除的软件 (增量同步)"""
+    since = request.args.get('since', type=int)
+    if since is None:
+        return jsonify({'error': 'Missing or invalid parameter: since'}), 400
+
+    conn = get_db_connection()
+    revision, rows, deleted_ids, full = read_catalog_changes(
+        conn, since, 'SELECT * FROM software ORDER BY id DESC'
+    )
+    base_url = get_base_url()
+    software = [serialize_software(row, base_url) for row in rows]
+    if full:
+        # 变更日志已被清理或版本号无效，退回全量列表
+        return jsonify({'revision': revision, 'full': True, 'software': software})
+    return jsonify({'revision': revision, 'full': False, 'upserted': software, 'deleted': deleted_ids})
+
+@app.route('/api/software/logo-sprite', methods=['GET'])
+def get_logo_sprite_map():
+    """API：当前目录全部 Logo 缩略图拼成的雪碧图的坐标表 (?size=40&format=png|webp)，客户端只需再请求一张图片"""
+    if not thumbnails_available():
+        return jsonify({'error': '服务端未安装 Pillow，无法生成雪碧图'}), 501
+
+    conn = get_db_connection()
+    revision, _ = get_catalog_revision(conn)
+    size, ext = sprite_request_args()
+    etag = catalog_etag(revision, f'sprite-{size}-{ext}')
+    if is_not_modified(etag):
+        return not_modified_response(etag)
+
+    sprite = logo_sprites.get(conn, app.config['UPLOAD_FOLDER'], revision, size, ext)
+    response = jsonify({
+        'revision': sprite.revision,
+        'size': sprite.size,
+        # 图片地址带版本号，内容不会再变，客户端可以长期缓存
+        'image': url_for('get_logo_sprite_image', ext=sprite.ext, size=sprite.size, rev=sprite.revision),
+        'tiles': sprite.tiles,
+    })
+    response.headers['X-Catalog-Revision'] = str(sprite.revision)
+    return set_cache_validators(response, catalog_etag(sprite.revision, f'sprite-{size}-{ext}'))
+
+def sprite_revision_outdated(revision):
+    """请求的雪碧图版本已不是当前版本"""
+    response = jsonify({'error': 'Logo sprite revision is outdated, reload the sprite map', 'revision': revision})
+    response.status_code = 404
+    response.cache_control.no_store = True
+    return response
+
+@app.route('/api/software/logo-sprite.<any(png, webp):ext>', methods=['GET'])
+def get_logo_sprite_image(ext):
+    """
+    API：雪碧图图片本身。带 ?rev= 的地址允许长期缓存，因此只返回该版本的图片：
+    目录已更新时返回 404，客户端需重新获取坐标表，避免旧坐标配上新图片
+    """
+    if not thumbnails_available():
+        abort(404)
+
+    conn = get_db_connection()
+    revision, _ = get_catalog_revision(conn)
+    rev = request.args.get('rev', type=int)
+    if rev is not None and rev != revision:
+        return sprite_revision_outdated(revision)
+    size, _ = sprite_request_args()
+    etag = catalog_etag(revision, f'sprite-{size}.{ext}')
+    if is_not_modified(etag):
+        return not_modified_response(etag)
+
+    sprite = logo_sprites.get(conn, app.config['UPLOAD_FOLDER'], revision, size, ext)
+    if rev is not None and rev != sprite.revision:
+        # 读取版本号之后目录又被修改
+        return sprite_revision_outdated(sprite.revision)
+    response = Response(sprite.image, mimetype=f'image/{ext}')
+    set_cache_validators(response, catalog_etag(sprite.revision, f'sprite-{size}.{ext}'))
+    if rev is not None:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = SPRITE_MAX_AGE
+        response.cache_control.immutable = True
+    return response
 
 @app.route('/api/software', methods=['POST'])
 def add_software():
@@ -174,11 +450,13 @@ def add_software():
         return jsonify({'error': 'Missing fields'}), 400
 
     conn = get_db_connection()
-    conn.execute("""
+    cursor = conn.execute("""
         INSERT INTO software (name, version, install_type, description, download_url, logo_url, silent_args) 
         VALUES (?, ?, ?, ?, ?, ?, ?)
     """, (data['name'], data['version'], data['install_type'], data['description'], data['download_url'], data['logo_url'], data['silent_args']))
     conn.commit()
+    catalog_snapshot.invalidate()
+    package_hasher.schedule(app.config['DATABASE'], app.config['PACKAGE_FOLDER'], [cursor.lastrowid])
     return jsonify({'message': 'Software added successfully'}), 201
 
 @app.route('/api/software/<int:software_id>', methods=['PUT'])
@@ -193,10 +471,13 @@ def update_software(software_id):
     """, (data.get('name'), data.get('version'), data.get('install_type'), data.get('description'), 
           data.get('download_url'), data.get('logo_url'), data.get('silent_args'), software_id))
     conn.commit()
+    catalog_snapshot.invalidate()
+    logo_collector.schedule(app.config['UPLOAD_FOLDER'])
     
     if cursor.rowcount == 0:
         return jsonify({'error': 'Software not found'}), 404
         
+    package_hasher.schedule(app.config['DATABASE'], app.config['PACKAGE_FOLDER'], [software_id])
     return jsonify({'message': 'Software updated successfully'}), 200
 
 @app.route('/api/software/<int:software_id>', methods=['DELETE'])
@@ -205,25 +486,85 @@ def delete_software(software_id):
     conn = get_db_connection()
     cursor = conn.execute("DELETE FROM software WHERE id = ?", (software_id,))
     conn.commit()
+    catalog_snapshot.invalidate()
+    logo_collector.schedule(app.config['UPLOAD_FOLDER'])
     
     if cursor.rowcount == 0:
         return jsonify({'error': 'Software not found'}), 404
         
     return jsonify({'message': 'Software deleted successfully'}), 200
 
+@app.route('/api/software/<int:software_id>/versions', methods=['GET'])
+def get_software_versions(software_id):
+    """API：某个软件的历史版本，按发布时间倒序分页 (?limit=&before=<版本 id>)"""
+    limit = min(request.args.get('limit', default=VERSIONS_PAGE_MAX, type=int), VERSIONS_PAGE_MAX)
+    before = request.args.get('before', type=int)
+    if limit < 1:
+        return jsonify({'error': 'Invalid parameter: limit'}), 400
+
+    conn = get_db_connection()
+    if conn.execute('SELECT 1 FROM software WHERE id = ?', (software_id,)).fetchone() is None:
+        return jsonify({'error': 'Software not found'}), 404
+    versions = list_software_versions(conn, software_id, limit, before)
+
+    response = jsonify([dict(row) for row in versions])
+    if len(versions) == limit:
+        next_cursor = versions[-1]['id']
+        response.headers['X-Next-Cursor'] = str(next_cursor)
+        response.headers['Link'] = f'<{url_for("get_software_versions", software_id=software_id, limit=limit, before=next_cursor)}>; rel="next"'
+    return response
+
+@app.route('/api/software/versions/latest', methods=['GET'])
+def get_latest_versions():
+    """API：每个软件最新一次发布的记录 (含发布时间)，不受历史版本数量影响"""
+    conn = get_db_connection()
+    return jsonify([dict(row) for row in latest_software_versions(conn)])
+
+@app.route('/api/software/<int:software_id>/versions/<int:version_id>/restore', methods=['POST'])
+def restore_software_version_route(software_id, version_id):
+    """
+    API：回滚到某个历史版本 (恢复版本号、下载链接和安装参数，并记为一次新的发布)。
+    本地安装包按记录的摘要从 packages/_versions 恢复，该版本的文件已无法恢复时返回 409
+    """
+    conn = get_db_connection()
+    try:
+        software_ids = restore_software_with_package(conn, app.config['PACKAGE_FOLDER'], software_id, version_id)
+    except PackageVersionUnavailable as e:
+        return jsonify({'error': str(e)}), 409
+    if software_ids is None:
+        return jsonify({'error': 'Version not found'}), 404
+    catalog_snapshot.invalidate()
+    package_hasher.schedule(app.config['DATABASE'], app.config['PACKAGE_FOLDER'], software_ids)
+    return jsonify({'message': 'Software version restored successfully'}), 200
+
+# --- 运行指标 ---
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 文本格式的运行指标 (请求延迟、数据库耗时、缓存命中等，见 metrics.py)"""
+    conn = get_db_connection()
+    revision, _ = get_catalog_revision(conn)
+    count, package_bytes = conn.execute('SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM software').fetchone()
+    return metrics_response([
+        ('appstore_catalog_software', '目录中的软件数', count),
+        ('appstore_catalog_package_bytes', '已计算校验和的安装包总字节数', package_bytes),
+        ('appstore_catalog_revision', '目录版本号', revision),
+    ])
+
 # --- 网页后台路由 (HTML 模板不变，保持原有风格) ---
 
-def get_software_list_html(software_list, search_query=''):
-    """生成软件列表页面 HTML (新增搜索功能)"""
-    rows = ""
-    for soft in software_list:
-        logo_url = soft['logo_url']
-        if logo_url and not logo_url.startswith('http'):
-            logo_url = f"/logos/{os.path.basename(logo_url)}"
-        
-        rows += f"""
+def render_software_row(soft):
+    """渲染列表中的一行 (结果按行版本号缓存在 row_fragments 中)"""
+    logo_url = soft['logo_url']
+    if logo_url and not logo_url.startswith('http'):
+        logo_url = f"/logos/{logo_relative_path(logo_url) or os.path.basename(logo_url)}"
+    if logo_url and '/logos/' in logo_url:
+        # 列表只显示 40px 图标，使用服务端预生成的缩略图
+        logo_url += '?size=40'
+
+    return f"""
         <tr class="align-middle">
-            <td class="text-center"><img src="{logo_url}" alt="{soft['name']} Logo" style="width: 40px; height: 40px; border-radius: 8px;"></td>
+            <td class="text-center"><img src="{logo_url}" alt="{soft['name']} Logo" loading="lazy" decoding="async" width="40" height="40" style="width: 40px; height: 40px; border-radius: 8px;"></td>
             <td>{soft['name']}</td>
             <td>{soft['version']}</td>
             <td><span class="badge bg-{'success' if soft['install_type'] == 'silent' else 'info'}">{soft['install_type'].capitalize()}</span></td>
@@ -235,6 +576,38 @@ def get_software_list_html(software_list, search_query=''):
         </tr>
         """
 
+def render_software_rows(software_list):
+    """渲染所有行；分页列表的行带 row_revision 列，使用片段缓存"""
+    return ''.join(
+        row_fragments.render(row, render_software_row) if 'row_revision' in row.keys() else render_software_row(dict(row))
+        for row in software_list
+    )
+
+def get_pagination_html(page):
+    """排序下拉框和上一页/下一页链接"""
+    options = ''.join(
+        f'<option value="{sort}"{" selected" if sort == page.sort else ""}>{label}</option>'
+        for sort, label in ADMIN_SORT_LABELS.items()
+    )
+    prev_link = (f'<a class="btn btn-outline-secondary btn-sm me-2" href="{url_for("list_software_page", sort=page.sort, before=page.prev_cursor)}">上一页</a>'
+                 if page.prev_cursor else '')
+    next_link = (f'<a class="btn btn-outline-secondary btn-sm" href="{url_for("list_software_page", sort=page.sort, after=page.next_cursor)}">下一页</a>'
+                 if page.next_cursor else '')
+    return f"""
+        <div class="d-flex justify-content-between align-items-center my-3">
+            <form method="GET" action="/" class="d-flex align-items-center">
+                <label class="me-2 text-nowrap" for="sort">排序:</label>
+                <select class="form-select form-select-sm" id="sort" name="sort" onchange="this.form.submit()">{options}</select>
+            </form>
+            <div>{prev_link}{next_link}</div>
+        </div>
+        """
+
+def get_software_list_html(software_list, search_query='', page=None):
+    """生成软件列表页面 HTML (新增搜索功能)；page 为分页信息 (搜索结果不分页)"""
+    rows = render_software_rows(software_list)
+    pagination = get_pagination_html(page) if page is not None else ''
+
     return f"""
 <!DOCTYPE html>
 <html lang="zh-CN">
@@ -274,6 +647,7 @@ def get_software_list_html(software_list, search_query=''):
                 </tbody>
             </table>
         </div>
+        {pagination}
     </div>
     
     <!-- Confirmation Modal (用于删除确认) -->
@@ -385,7 +759,7 @@ def get_software_form_html(software=None):
     
     # 确保 Logo URL 是相对路径，以便预览正确显示
     if logo_url and logo_url.startswith(('http', get_base_url())):
-        logo_url = "/" + logo_url.split("/logos/")[-1]
+        logo_url = "/logos/" + logo_url.split("/logos/")[-1]
     
     # 安装类型选项
     silent_checked = 'checked' if install_type == 'silent' else ''
@@ -510,26 +884,20 @@ def get_software_form_html(software=None):
         }}
         
         // --- 上传处理函数 ---
-        function handleUpload(data, isBase64 = false) {{
-            const formData = new FormData();
-            
-            if (isBase64) {{
-                formData.append('base64_image', data);
-            }} else {{
-                formData.append('file', data);
-            }}
-
+        // 直接以图片原始字节作为请求体上传 (Content-Type: image/*)，不再转换为 Base64
+        function handleUpload(blob) {{
             // 临时设置预览，直到上传完成
             logoUrlHidden.value = 'Uploading...'; 
 
             fetch('/api/upload_logo', {{
                 method: 'POST',
-                body: formData 
+                headers: {{ 'Content-Type': blob.type || 'image/png' }},
+                body: blob 
             }})
             .then(response => response.json())
             .then(data => {{
                 if (data.logo_url) {{
-                    // data.logo_url 是 /logos/uuid.png 这样的相对路径
+                    // data.logo_url 是 /logos/ab/<sha256>.png 这样的相对路径
                     logoUrlHidden.value = data.logo_url; 
                     // 确保预览图使用的是新的 URL
                     logoPreview.src = data.logo_url;
@@ -549,7 +917,7 @@ def get_software_form_html(software=None):
         // 1. 文件上传监听
         logoUploadInput.addEventListener('change', function() {{
             if (this.files.length > 0) {{
-                handleUpload(this.files[0], false);
+                handleUpload(this.files[0]);
             }}
         }});
 
@@ -564,20 +932,9 @@ def get_software_form_html(software=None):
                     imageFound = true;
                     const blob = items[i].getAsFile();
                     
-                    // 立即在本地预览
-                    const reader = new FileReader();
-                    reader.onload = function(event) {{
-                        logoPreview.src = event.target.result;
-                    }};
-                    reader.readAsDataURL(blob);
-
-                    // 转换为 Base64 上传
-                    const base64Reader = new FileReader();
-                    base64Reader.onloadend = function() {{
-                        const base64Data = base64Reader.result;
-                        handleUpload(base64Data, true);
-                    }};
-                    base64Reader.readAsDataURL(blob);
+                    // 立即在本地预览，并上传原始图片数据
+                    logoPreview.src = URL.createObjectURL(blob);
+                    handleUpload(blob);
                     
                     break;
                 }}
@@ -651,11 +1008,26 @@ def list_software_page():
             'SELECT * FROM software WHERE name LIKE ? OR description LIKE ? ORDER BY id DESC', 
             (like_query, like_query)
         ).fetchall()
-    else:
-        software_list = conn.execute('SELECT * FROM software ORDER BY id DESC').fetchall()
-    
-    result = [dict(row) for row in software_list]
-    return get_software_list_html(result, search_query)
+        result = [dict(row) for row in software_list]
+        return get_software_list_html(result, search_query)
+
+    # 没有搜索词时每一页只取决于目录版本和分页参数：按版本缓存 HTML 和压缩结果，并支持 304
+    sort, after, before = admin_page_args()
+    page_key = admin_page_key(sort, after, before)
+    revision, _ = get_catalog_revision(conn)
+    encoding = negotiate_encoding()
+    etag = catalog_etag(revision, f"html-{query_variant()}-{encoding}" if encoding else f"html-{query_variant()}")
+    if is_not_modified(etag):
+        return not_modified_response(etag)
+
+    def build_page():
+        # 每页固定行数，沿索引读取；未变化的行直接复用缓存的 HTML 片段
+        admin_page = read_admin_page(conn, sort, after, before)
+        return get_software_list_html(admin_page.rows, page=admin_page).encode('utf-8')
+
+    page = admin_page_cache.get(page_key, revision, build_page)
+    response = apply_encoding(Response(mimetype='text/html'), page.variant(encoding), encoding)
+    return set_cache_validators(response, etag)
 
 @app.route('/add', methods=['GET'])
 def add_software_page():
@@ -673,21 +1045,73 @@ def edit_software_page(software_id):
         
     return get_software_form_html(dict(software))
 
+# --- 命令行维护命令 (flask --app app ...) ---
+
+@app.cli.command('compact-changes')
+def compact_changes_command():
+    """清理变更日志中较旧的删除记录"""
+    removed = compact_change_log(get_db_connection())
+    print(f"已清理 {removed} 条删除记录。")
+
+@app.cli.command('backfill-thumbnails')
+@click.option('--force', is_flag=True, help='重新生成已存在的缩略图')
+def backfill_thumbnails_command(force):
+    """为 logos 目录中已有的图片生成缩略图"""
+    if not thumbnails_available():
+        print("未安装 Pillow (pip install pillow)，无法生成缩略图。")
+        return
+    generated, failed = backfill_thumbnails(app.config['UPLOAD_FOLDER'], force=force)
+    print(f"已生成 {generated} 个文件的缩略图。")
+    for filename in failed:
+        print(f"无法处理: {filename}")
+
+@app.cli.command('hash-packages')
+@click.option('--all', 'recompute', is_flag=True, help='重新检查全部软件 (安装包被同名替换后使用)')
+def hash_packages_command(recompute):
+    """为下载链接指向本地安装包的软件计算 sha256 / size_bytes"""
+    updated = update_package_checksums(get_db_connection(), app.config['PACKAGE_FOLDER'], recompute=recompute)
+    print(f"已更新 {updated} 个软件的校验和。")
+
+@app.cli.command('build-deltas')
+@click.option('--max-mb', default=DELTA_CLI_MAX_BYTES // (1024 * 1024), show_default=True,
+              help='只为不超过这个大小 (MB) 的安装包生成补丁，内存占用约为它的 17 倍')
+def build_deltas_command(max_mb):
+    """为安装包的相邻版本生成 bsdiff 差分补丁 (包括服务进程内跳过的大安装包)，并清理不再需要的历史版本和补丁"""
+    if not deltas_available():
+        print("未安装 bsdiff4 (pip install bsdiff4)，只清理历史版本。")
+    conn = get_db_connection()
+    update_package_checksums(conn, app.config['PACKAGE_FOLDER'])
+    built, removed = refresh_package_deltas(conn, app.config['PACKAGE_FOLDER'], max_mb * 1024 * 1024)
+    print(f"已生成 {built} 个补丁，删除 {removed} 个不再需要的文件。")
+
+@app.cli.command('check-file-offload')
+@click.argument('package')
+@click.argument('logo', default='default.png')
+def check_file_offload_command(package, logo):
+    """检查 X-Accel-Redirect / X-Sendfile / 进程内发送三种模式下的响应头 (PACKAGE 为 packages 目录中的文件名)"""
+    results = check_file_offload(app, package, logo)
+    for name, ok, detail in results:
+        print(f"{'PASS' if ok else 'FAIL'}  {name}  {detail}")
+    if not all(ok for _, ok, _ in results):
+        raise SystemExit(1)
+
+@app.cli.command('gc-logos')
+@click.option('--grace', default=3600, show_default=True, help='保留最近多少秒内上传、尚未被引用的文件')
+def gc_logos_command(grace):
+    """删除 logos 目录中不再被任何软件引用的图片及其缩略图"""
+    referenced = load_logo_references(get_db_connection())
+    removed = collect_orphan_logos(app.config['UPLOAD_FOLDER'], referenced, grace_seconds=grace)
+    for relpath in removed:
+        print(f"已删除: {relpath}")
+    print(f"共删除 {len(removed)} 个未引用的 Logo。")
+
+@app.cli.command('init-db')
+def init_db_command():
+    """初始化数据库和占位文件 (使用 flask run 或直接执行 CLI 命令前运行一次)"""
+    bootstrap()
+    print("数据库已初始化。")
+
 if __name__ == '__main__':
-    # 确保 placeholder.txt 存在，用于虚拟下载
-    if not os.path.exists('placeholder.txt'):
-        with open('placeholder.txt', 'w', encoding='utf-8') as f:
-            f.write('This is a placeholder file for software download demonstration.')
-            
-    # 确保默认 logo 存在
-    default_logo_path = os.path.join(UPLOAD_FOLDER, 'default.png')
-    if not os.path.exists(default_logo_path):
-        # 创建一个简单的占位符 PNG 文件 (1x1 透明像素)
-        default_png_data = b'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=='
-        try:
-            with open(default_logo_path, 'wb') as f:
-                f.write(base64.b64decode(default_png_data))
-        except Exception as e:
-            print(f"Could not create default logo: {e}")
-            
+    # 开发服务器；生产环境请使用 python serve.py app
+    bootstrap()
     app.run(debug=True)
@@ -1,8 +1,28 @@
 import sqlite3
 import os
-import re
-import base64
-from flask import Flask, jsonify, request, g, redirect, url_for, send_from_directory, abort
+import io
+import json
+import click
+from flask import Flask, jsonify, request, g, redirect, url_for, abort, Response, stream_with_context
+from catalog_db import get_connection_pool, ensure_index, read_transaction
+from catalog_db import init_catalog_schema, get_catalog_revision, read_catalog_rows, read_catalog_changes, compact_change_log
+from catalog_db import select_software_columns, encode_cursor, decode_cursor
+from catalog_db import init_version_history, list_software_versions, latest_software_versions
+from catalog_db import init_search_index, rebuild_search_index, search_software, has_search_index
+from catalog_cache import CatalogSnapshotCache, snapshot_response
+from logo_store import send_logo, generate_thumbnails, backfill_thumbnails, thumbnails_available, THUMBNAIL_ERRORS
+from logo_store import LogoSpriteCache, sprite_request_args, SPRITE_MAX_AGE
+from logo_store import store_logo_chunks, iter_stream, parse_image_data_uri, iter_base64_chunks, LogoTooLargeError, MAX_LOGO_BYTES
+from logo_store import load_logo_references, collect_orphan_logos, discard_logos, OrphanLogoCollector
+from file_offload import init_file_offload
+from package_store import init_package_schema, update_package_checksums, PackageHasher
+from package_store import restore_software_with_package, PackageVersionUnavailable
+from package_delta import init_delta_schema, refresh_package_deltas
+from compression import init_compression, negotiate_encoding, PrecompressedCache, apply_encoding
+from admin_list import admin_page_args, admin_page_key, read_admin_page, RowFragmentCache, ADMIN_SORT_LABELS
+from http_cache import catalog_etag, is_not_modified, not_modified_response, query_variant, set_cache_validators
+from metrics import init_metrics, metrics_response, flush_metrics, registry as metrics_registry
+from profiling import init_profiling
 
 # --- 全局配置 ---
 app = Flask(__name__)
@@ -14,28 +34,62 @@ APP_ROOT = os.path.dirname(os.path.abspath(__file__))
 # Logo 图片将保存在项目根目录下的 'logos' 文件夹中
 UPLOAD_FOLDER = os.path.join(APP_ROOT, 'logos')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# 单个 Logo 上传的大小上限 (字节)，超出时返回 413
+app.config['MAX_LOGO_BYTES'] = MAX_LOGO_BYTES
 
 # 确保 logo 文件夹存在
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
+# 安装包目录 (与 app.py 共用)，用于计算 sha256 / size_bytes
+app.config['PACKAGE_FOLDER'] = os.path.join(APP_ROOT, 'packages')
+
+# 按需分析单个请求 (X-Profile 请求头，仅限本机或令牌)，结果见 /debug/profiles；需最先注册
+init_profiling(app)
+# 请求计时和数据库语句计时 (/metrics)，需在 init_compression 之前注册
+init_metrics(app)
+# 按 Accept-Encoding 压缩较大的文本响应 (gzip，安装 brotli 后优先 br)
+init_compression(app)
+# 安装包和 Logo 可交给 nginx (X-Accel-Redirect) 或 Apache (X-Sendfile) 发送，见 file_offload.py
+init_file_offload(app)
+
+# 后台计算安装包校验和的线程
+package_hasher = PackageHasher(after_update=refresh_package_deltas)
+# 已编码的 /api/software 响应快照，写操作提交后失效
+catalog_snapshot = CatalogSnapshotCache()
+# 按目录版本缓存的 Logo 雪碧图
+logo_sprites = LogoSpriteCache()
+# /api/software 分页时每页的最大条数
+CATALOG_PAGE_MAX = 500
+# 版本历史接口每页的最大条数
+VERSIONS_PAGE_MAX = 100
+# 后台列表页 (无搜索词时) 各分页的 HTML 及其压缩版本，按目录版本号缓存
+admin_page_cache = PrecompressedCache(max_entries=64)
+# 后台列表每一行的 HTML，按行版本号缓存
+row_fragments = RowFragmentCache()
+# 缓存命中率由 /metrics 输出
+metrics_registry.register_cache('catalog_snapshot', catalog_snapshot)
+metrics_registry.register_cache('admin_page', admin_page_cache)
+metrics_registry.register_cache('admin_row', row_fragments)
+metrics_registry.register_cache('logo_sprite', logo_sprites)
+# NDJSON 批量导入时每个事务写入的行数
+IMPORT_BATCH_SIZE = 1000
+
 # --- 数据库连接管理 ---
 
 def get_db_connection():
-    """建立数据库连接，并在 g 对象上缓存"""
+    """从连接池取出数据库连接 (WAL 模式，行工厂为 sqlite3.Row)，并在 g 对象上缓存"""
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(app.config['DATABASE'])
-        # 设置行工厂，使查询结果可以像字典一样访问
-        db.row_factory = sqlite3.Row
+        db = g._database = get_connection_pool(app.config['DATABASE']).acquire()
     return db
 
 @app.teardown_appcontext
 def close_connection(exception):
-    """请求结束后关闭数据库连接"""
-    db = getattr(g, '_database', None)
+    """请求结束后把数据库连接归还连接池"""
+    db = g.pop('_database', None)
     if db is not None:
-        db.close()
+        get_connection_pool(app.config['DATABASE']).release(db)
 
 def init_db():
     """初始化数据库，创建 software 表（如果不存在）"""
@@ -57,50 +111,110 @@ def init_db():
             )
         ''')
         conn.commit()
+        # 支持 ORDER BY name / WHERE name = ? 的索引 (name 已有 UNIQUE 索引时跳过)
+        ensure_index(conn, 'idx_software_name', 'software', ('name',))
+        # 目录版本号表及触发器，供 /api/software 的条件请求使用
+        init_catalog_schema(conn)
+        # 安装包的 sha256 / size_bytes 列
+        init_package_schema(conn)
+        # 相邻版本之间的差分补丁
+        init_delta_schema(conn)
+        # 版本历史表 (每次发布追加一行)
+        init_version_history(conn)
+        # 后台搜索使用的 FTS5 全文索引，由触发器与 software 表保持同步
+        if not init_search_index(conn):
+            app.logger.warning("当前 SQLite 不支持 FTS5 trigram 分词，后台搜索将使用 LIKE 查询。")
+
+def bootstrap():
+    """
+    启动前的一次性初始化：数据库表结构和安装包校验和。
+    由 serve.py 在主进程中调用，fork 出的 worker 不再重复。
+    """
+    init_db()
+    with app.app_context():
+        # 为尚未计算校验和的本地安装包补算 sha256 / size_bytes，并生成差分补丁
+        conn = get_db_connection()
+        update_package_checksums(conn, app.config['PACKAGE_FOLDER'])
+        refresh_package_deltas(conn, app.config['PACKAGE_FOLDER'])
+
+
+def worker_exit():
+    """serve.py 的 worker 退出前调用：写出最后一份运行指标快照"""
+    flush_metrics()
+
 
 # --- 辅助函数：处理 Base64 图片上传/粘贴逻辑 ---
 
-def save_base64_image(base64_data, software_name):
-    """将 Base64 数据解码并保存为文件"""
+def save_logo_chunks(chunks, ext, new_files=None):
+    """
+    分块写入并按内容哈希保存 Logo，相同图片只保存一份；返回可访问的 URL 路径。
+    传入 new_files 列表时，本次新写入的文件 (相对路径) 会追加到其中，便于失败时用 discard_logos 删除。
+    """
+    # 以 SHA-256 作为文件名并按前两位分目录：重复粘贴同一张图不会产生新文件
+    filename, created = store_logo_chunks(app.config['UPLOAD_FOLDER'], chunks, ext, app.config['MAX_LOGO_BYTES'])
+
+    if created and new_files is not None:
+        new_files.append(filename)
+    if created:
+        # 一次性生成列表显示用的缩略图；图片无法解析时只记录日志，原文件仍可使用
+        try:
+            generate_thumbnails(app.config['UPLOAD_FOLDER'], filename)
+        except THUMBNAIL_ERRORS as e:
+            app.logger.warning(f"Thumbnail generation failed for {filename}: {e}")
     
-    # 查找 Base64 数据头 (e.g., data:image/png;base64,)
-    match = re.search(r'data:(?P<mime>image/.*?);base64,(?P<data>.*)', base64_data)
-    if not match:
-        raise ValueError("Invalid Base64 image format. Data URI prefix (data:image/...) not found.")
+    # 返回可访问的 URL 路径 (例如: /logos/ab/<sha256>.png)
+    return url_for('uploaded_file', filename=filename, _external=False)
+
+
+def save_base64_image(base64_data, new_files=None):
+    """将 data:image/...;base64, 数据逐段解码并保存为文件，内存中不会同时存在整张图片的解码结果"""
     
-    # 提取 MIME 类型和实际数据
-    mime_type = match.group('mime')
+    # 只解析开头的 Data URI 前缀 (e.g., data:image/png;base64,)，提取 MIME 类型
+    mime_type, start = parse_image_data_uri(base64_data)
     ext = mime_type.split('/')[-1].split('+')[0] 
-    img_data = match.group('data')
     
-    if not img_data:
+    if start >= len(base64_data):
         return None
 
-    try:
-        # 尝试解码 Base64 数据
-        binary_data = base64.b64decode(img_data)
-    except Exception as e:
-        raise ValueError(f"Base64 decoding failed: {e}")
+    return save_logo_chunks(iter_base64_chunks(base64_data, start), ext, new_files)
 
-    # 清理文件名并生成唯一文件名
-    safe_name = re.sub(r'[^a-zA-Z0-9]', '_', software_name)
-    # 使用随机字符串确保文件名的唯一性
-    filename = f"{safe_name}_{os.urandom(4).hex()}.{ext}"
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
 
-    # 保存二进制数据到文件
-    with open(filepath, 'wb') as f:
-        f.write(binary_data)
-    
-    # 返回可访问的 URL 路径 (例如: /logos/filename.png)
-    return url_for('uploaded_file', filename=filename, _external=False)
+def load_logo_references_for_gc():
+    """后台清理线程中读取当前被引用的 Logo"""
+    with app.app_context():
+        return load_logo_references(get_db_connection())
+
+# 修改或删除软件后在后台清理不再被引用的 Logo
+logo_collector = OrphanLogoCollector(load_logo_references_for_gc)
+
+
+# --- API 路由：上传 Logo (原始二进制) ---
+
+@app.route('/api/upload_logo', methods=['POST'])
+def upload_logo():
+    """API：以原始图片字节作为请求体上传 Logo (Content-Type: image/*)，分块写入磁盘，返回 logo_url"""
+    max_bytes = app.config['MAX_LOGO_BYTES']
+    if not request.mimetype.startswith('image/'):
+        return jsonify({'error': 'Content-Type must be image/*'}), 415
+    if request.content_length is not None and request.content_length > max_bytes:
+        # 声明的长度已超限，不读取请求体直接拒绝
+        return jsonify({'error': f'Logo exceeds the {max_bytes} byte limit'}), 413
+
+    ext = request.mimetype.split('/')[-1].split('+')[0]
+    try:
+        logo_url = save_logo_chunks(iter_stream(request.stream), ext)
+    except LogoTooLargeError as e:
+        return jsonify({'error': str(e)}), 413
+    except ValueError as e:
+        return jsonify({'error': f'Logo Error: {e}'}), 400
+    return jsonify({'logo_url': logo_url}), 201
 
 
 # --- 辅助函数：Logo 文件服务路由 ---
-@app.route('/logos/<filename>')
+@app.route('/logos/<path:filename>')
 def uploaded_file(filename):
-    """用于通过 URL 访问上传的 Logo 文件"""
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    """用于通过 URL 访问上传的 Logo 文件，?size=40 等参数返回对应尺寸的缩略图"""
+    return send_logo(app.config['UPLOAD_FOLDER'], filename)
 
 
 # --- 辅助函数：生成 HTML 表单 (用于 /add 和 /edit) ---
@@ -240,7 +354,7 @@ def get_software_form_html(software=None):
             const apiEndpoint = "{api_url}";
 
             function updatePreview(value) {{
-                if (value && (value.startsWith('data:image') || value.startsWith('http'))) {{
+                if (value && (value.startsWith('data:image') || value.startsWith('http') || value.startsWith('/logos/') || value.startsWith('blob:'))) {{
                     logoPreview.src = value;
                     logoPreview.style.display = 'block';
                 }} else {{
@@ -252,17 +366,37 @@ def get_software_form_html(software=None):
             // 1. 监听 Logo URL/Base64 输入框变化
             logoInput.addEventListener('input', (e) => updatePreview(e.target.value));
 
-            // 2. 监听 文件选择 (将文件转换为 Base64)
+            // 以原始字节上传图片 (不转换为 Base64)，上传完成后把返回的 /logos/ 地址填入输入框
+            function uploadLogo(file) {{
+                updatePreview(URL.createObjectURL(file));
+                messageElement.textContent = '正在上传 Logo...';
+                messageElement.style.color = 'gray';
+                fetch('/api/upload_logo', {{
+                    method: 'POST',
+                    headers: {{ 'Content-Type': file.type || 'image/png' }},
+                    body: file
+                }})
+                .then(response => response.json().then(result => ({{ ok: response.ok, result }})))
+                .then(({{ ok, result }}) => {{
+                    if (!ok) {{
+                        throw new Error(result.error || 'Logo 上传失败');
+                    }}
+                    logoInput.value = result.logo_url;
+                    updatePreview(result.logo_url);
+                    messageElement.textContent = 'Logo 上传成功。';
+                    messageElement.style.color = 'green';
+                }})
+                .catch(error => {{
+                    messageElement.textContent = `Logo 上传失败: ${{error.message}}`;
+                    messageElement.style.color = 'red';
+                }});
+            }}
+
+            // 2. 监听 文件选择
             logoFileInput.addEventListener('change', function(e) {{
                 const file = e.target.files[0];
                 if (file) {{
-                    const reader = new FileReader();
-                    reader.onload = function(readerEvent) {{
-                        const base64Data = readerEvent.target.result;
-                        logoInput.value = base64Data; // 将 Base64 填入文本输入框
-                        updatePreview(base64Data);
-                    }};
-                    reader.readAsDataURL(file);
+                    uploadLogo(file);
                 }}
             }});
 
@@ -274,13 +408,7 @@ def get_software_form_html(software=None):
                     
                     const file = e.clipboardData.files[0];
                     if (file.type.startsWith('image/')) {{
-                        const reader = new FileReader();
-                        reader.onload = function(readerEvent) {{
-                            const base64Data = readerEvent.target.result;
-                            logoInput.value = base64Data; // 将 Base64 填入输入框
-                            updatePreview(base64Data);
-                        }};
-                        reader.readAsDataURL(file);
+                        uploadLogo(file);
                     }}
                 }}
                 // 如果粘贴的是文本（Base64 字符串或 URL），则由 input 事件处理
@@ -339,27 +467,18 @@ def get_software_form_html(software=None):
 
 # --- 辅助函数：生成软件列表 HTML (用于 / 路径) ---
 
-def get_software_list_html(software_list, search_query=""):
-    """生成包含软件列表和删除、修改功能的 HTML 页面"""
-    
-    table_rows = ""
-    if not software_list:
-        if search_query:
-             table_rows = f"<tr><td colspan='7' style='text-align: center; padding: 20px;'>没有找到与 '{search_query}' 匹配的软件。</td></tr>"
-        else:
-            table_rows = "<tr><td colspan='7' style='text-align: center; padding: 20px;'>数据库中没有软件。请 <a href='/add'>添加新软件</a>。</td></tr>"
-    else:
-        for soft in software_list:
-            # 使用一个默认的空字符串来避免空 Logo URL 导致图片标签出错
-            logo_src = soft['logo_url'] if soft['logo_url'] else "" 
-            table_rows += f"""
+def render_software_row(soft):
+    """渲染列表中的一行 (结果按行版本号缓存在 row_fragments 中)"""
+    # 使用一个默认的空字符串来避免空 Logo URL 导致图片标签出错
+    logo_src = soft['logo_url'] if soft['logo_url'] else "" 
+    return f"""
             <tr id="row-{soft['id']}">
                 <td>{soft['id']}</td>
                 <td><strong>{soft['name']}</strong></td>
                 <td>{soft['version']}</td>
                 <td>{soft['category']}</td>
                 <td>{soft['install_type']}</td>
-                <td><img src="{logo_src}" style="max-height: 40px; max-width: 40px; border-radius: 5px;"></td>
+                <td><img src="{logo_src}{'?size=40' if logo_src.startswith('/logos/') else ''}" loading="lazy" decoding="async" width="40" height="40" style="max-height: 40px; max-width: 40px; border-radius: 5px;"></td>
                 <td>
                     <a href="{url_for('edit_software_page', software_id=soft['id'])}" style="background-color: #ffc107; color: black; border: none; padding: 5px 10px; cursor: pointer; border-radius: 3px; text-decoration: none; margin-right: 5px;">修改</a>
                     <button onclick="deleteSoftware({soft['id']}, '{soft['name']}')" style="background-color: #dc3545; color: white; border: none; padding: 5px 10px; cursor: pointer; border-radius: 3px;">删除</button>
@@ -367,6 +486,43 @@ def get_software_list_html(software_list, search_query=""):
             </tr>
             """
 
+def get_pagination_html(page):
+    """排序下拉框和上一页/下一页链接"""
+    options = ''.join(
+        f'<option value="{sort}"{" selected" if sort == page.sort else ""}>{label}</option>'
+        for sort, label in ADMIN_SORT_LABELS.items()
+    )
+    prev_link = (f'<a href="{url_for("list_software_page", sort=page.sort, before=page.prev_cursor)}">&laquo; 上一页</a>'
+                 if page.prev_cursor else '')
+    next_link = (f'<a href="{url_for("list_software_page", sort=page.sort, after=page.next_cursor)}">下一页 &raquo;</a>'
+                 if page.next_cursor else '')
+    return f"""
+            <div class="pagination">
+                <form method="GET" action="/">
+                    排序:
+                    <select name="sort" onchange="this.form.submit()">{options}</select>
+                </form>
+                <div>{prev_link}{next_link}</div>
+            </div>
+            """
+
+def get_software_list_html(software_list, search_query="", page=None):
+    """生成包含软件列表和删除、修改功能的 HTML 页面；page 为分页信息 (搜索结果不分页)"""
+    
+    table_rows = ""
+    if not software_list:
+        if search_query:
+             table_rows = f"<tr><td colspan='7' style='text-align: center; padding: 20px;'>没有找到与 '{search_query}' 匹配的软件。</td></tr>"
+        else:
+            table_rows = "<tr><td colspan='7' style='text-align: center; padding: 20px;'>数据库中没有软件。请 <a href='/add'>添加新软件</a>。</td></tr>"
+    else:
+        # 分页列表的行带 row_revision 列，未变化的行直接复用缓存的 HTML 片段
+        table_rows = ''.join(
+            row_fragments.render(row, render_software_row) if 'row_revision' in row.keys() else render_software_row(dict(row))
+            for row in software_list
+        )
+    pagination = get_pagination_html(page) if page is not None else ''
+
     return f"""
     <!DOCTYPE html>
     <html>
@@ -450,6 +606,17 @@ def get_software_list_html(software_list, search_query=""):
             .search-form a.clear-btn {{
                 background-color: #6c757d;
             }}
+            .pagination {{
+                display: flex;
+                justify-content: space-between;
+                align-items: center;
+                margin-top: 15px;
+            }}
+            .pagination a {{
+                margin-left: 10px;
+                color: #007bff;
+                text-decoration: none;
+            }}
             .message-box {{ 
                 padding: 10px; 
                 margin-top: 10px; 
@@ -500,6 +667,7 @@ def get_software_list_html(software_list, search_query=""):
                     {table_rows}
                 </tbody>
             </table>
+            {pagination}
         </div>
 
         <script>
@@ -561,14 +729,143 @@ def get_software_list_html(software_list, search_query=""):
 
 # --- API 路由：获取软件列表 ---
 
+def build_catalog_snapshot():
+    """查询并编码完整的软件列表，供 catalog_snapshot 缓存"""
+    conn = get_db_connection()
+    revision, updated_at, software_list = read_catalog_rows(conn, 'SELECT * FROM software ORDER BY name')
+    result = [dict(row) for row in software_list]
+    body = (app.json.dumps(result) + "\n").encode('utf-8')
+    return revision, updated_at, body
+
 @app.route('/api/software', methods=['GET'])
 def get_software():
-    """API：获取所有软件列表 (供桌面客户端使用)"""
+    """API：获取所有软件列表 (供桌面客户端使用，支持 ETag 条件请求)"""
+    if any(key in request.args for key in ('limit', 'after', 'fields')):
+        return get_software_page()
+
     conn = get_db_connection()
-    software_list = conn.execute('SELECT * FROM software ORDER BY name').fetchall()
-    
-    result = [dict(row) for row in software_list]
-    return jsonify(result)
+    revision, _ = get_catalog_revision(conn)
+    encoding = negotiate_encoding()
+    etag = catalog_etag(revision, encoding)
+    if is_not_modified(etag):
+        # 目录未变化，直接返回 304，不再查询和序列化软件表
+        return not_modified_response(etag)
+
+    # 目录有变化时也只在快照过期后重建一次，其余请求直接复用已编码的字节
+    snapshot = catalog_snapshot.get(revision, build_catalog_snapshot)
+    return snapshot_response(snapshot, encoding)
+
+def get_software_page():
+    """按游标分页并按需选择字段返回软件列表 (?limit=&after=&fields=)，游标由上一页最后一条的名称编码而来"""
+    # 不能用 default=：type=int 转换失败时 get 返回默认值，?limit=abc 会变成一整页
+    limit = request.args.get('limit', type=int)
+    after = decode_cursor(request.args['after']) if 'after' in request.args else None
+    if ('limit' in request.args and (limit is None or limit < 1)) or ('after' in request.args and after is None):
+        return jsonify({'error': 'Invalid parameter: limit or after'}), 400
+    limit = min(limit or CATALOG_PAGE_MAX, CATALOG_PAGE_MAX)
+
+    conn = get_db_connection()
+    revision, _ = get_catalog_revision(conn)
+    etag = catalog_etag(revision, query_variant())
+    if is_not_modified(etag):
+        return not_modified_response(etag)
+
+    columns = ', '.join(select_software_columns(conn, request.args.get('fields'), required=('id', 'name')))
+    # name 列有 UNIQUE 索引，按名称的游标分页沿索引顺序读取，与页码无关
+    if after is not None:
+        sql, params = f'SELECT {columns} FROM software WHERE name > ? ORDER BY name LIMIT ?', (after, limit)
+    else:
+        sql, params = f'SELECT {columns} FROM software ORDER BY name LIMIT ?', (limit,)
+    revision, updated_at, software_list = read_catalog_rows(conn, sql, params)
+
+    response = jsonify([dict(row) for row in software_list])
+    if len(software_list) == limit:
+        next_cursor = encode_cursor(software_list[-1]['name'])
+        next_args = dict(request.args, after=next_cursor)
+        response.headers['X-Next-Cursor'] = next_cursor
+        response.headers['Link'] = f'<{url_for("get_software", **next_args)}>; rel="next"'
+    response.headers['X-Catalog-Revision'] = str(revision)
+    return set_cache_validators(response, catalog_etag(revision, query_variant()))
+
+@app.route('/api/software/changes', methods=['GET'])
+def get_software_changes():
+    """API：返回 since 版本之后新增/修改/删除的软件 (增量同步)"""
+    since = request.args.get('since', type=int)
+    if since is None:
+        return jsonify({'error': 'Missing or invalid parameter: since'}), 400
+
+    conn = get_db_connection()
+    revision, rows, deleted_ids, full = read_catalog_changes(
+        conn, since, 'SELECT * FROM software ORDER BY name'
+    )
+    software = [dict(row) for row in rows]
+    if full:
+        # 变更日志已被清理或版本号无效，退回全量列表
+        return jsonify({'revision': revision, 'full': True, 'software': software})
+    return jsonify({'revision': revision, 'full': False, 'upserted': software, 'deleted': deleted_ids})
+
+@app.route('/api/software/logo-sprite', methods=['GET'])
+def get_logo_sprite_map():
+    """API：当前目录全部 Logo 缩略图拼成的雪碧图的坐标表 (?size=40&format=png|webp)，客户端只需再请求一张图片"""
+    if not thumbnails_available():
+        return jsonify({'error': '服务端未安装 Pillow，无法生成雪碧图'}), 501
+
+    conn = get_db_connection()
+    revision, _ = get_catalog_revision(conn)
+    size, ext = sprite_request_args()
+    etag = catalog_etag(revision, f'sprite-{size}-{ext}')
+    if is_not_modified(etag):
+        return not_modified_response(etag)
+
+    sprite = logo_sprites.get(conn, app.config['UPLOAD_FOLDER'], revision, size, ext)
+    response = jsonify({
+        'revision': sprite.revision,
+        'size': sprite.size,
+        # 图片地址带版本号，内容不会再变，客户端可以长期缓存
+        'image': url_for('get_logo_sprite_image', ext=sprite.ext, size=sprite.size, rev=sprite.revision),
+        'tiles': sprite.tiles,
+    })
+    response.headers['X-Catalog-Revision'] = str(sprite.revision)
+    return set_cache_validators(response, catalog_etag(sprite.revision, f'sprite-{size}-{ext}'))
+
+def sprite_revision_outdated(revision):
+    """请求的雪碧图版本已不是当前版本"""
+    response = jsonify({'error': 'Logo sprite revision is outdated, reload the sprite map', 'revision': revision})
+    response.status_code = 404
+    response.cache_control.no_store = True
+    return response
+
+@app.route('/api/software/logo-sprite.<any(png, webp):ext>', methods=['GET'])
+def get_logo_sprite_image(ext):
+    """
+    API：雪碧图图片本身。带 ?rev= 的地址允许长期缓存，因此只返回该版本的图片：
+    目录已更新时返回 404，客户端需重新获取坐标表，避免旧坐标配上新图片
+    """
+    if not thumbnails_available():
+        abort(404)
+
+    conn = get_db_connection()
+    revision, _ = get_catalog_revision(conn)
+    rev = request.args.get('rev', type=int)
+    if rev is not None and rev != revision:
+        return sprite_revision_outdated(revision)
+    size, _ = sprite_request_args()
+    etag = catalog_etag(revision, f'sprite-{size}.{ext}')
+    if is_not_modified(etag):
+        return not_modified_response(etag)
+
+    sprite = logo_sprites.get(conn, app.config['UPLOAD_FOLDER'], revision, size, ext)
+    if rev is not None and rev != sprite.revision:
+        # 读取版本号之后目录又被修改
+        return sprite_revision_outdated(sprite.revision)
+    response = Response(sprite.image, mimetype=f'image/{ext}')
+    set_cache_validators(response, catalog_etag(sprite.revision, f'sprite-{size}.{ext}'))
+    if rev is not None:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = SPRITE_MAX_AGE
+        response.cache_control.immutable = True
+    return response
 
 # --- API 路由：添加软件 ---
 
@@ -588,7 +885,7 @@ def add_software():
     if logo_url and logo_url.startswith('data:image'):
         # 是 Base64 数据，保存为文件
         try:
-            logo_url = save_base64_image(logo_url, data['name'])
+            logo_url = save_base64_image(logo_url)
         except ValueError as e:
             return jsonify({'error': f'Logo Error: {e}'}), 400
     # 否则，如果它是 URL 或空字符串，则直接使用
@@ -613,9 +910,11 @@ def add_software():
              silent_args, category, logo_url, install_type)
         )
         conn.commit()
+        catalog_snapshot.invalidate()
         
         # 获取新插入的 ID
         new_id = conn.execute("SELECT id FROM software WHERE name=?", (data['name'],)).fetchone()[0]
+        package_hasher.schedule(app.config['DATABASE'], app.config['PACKAGE_FOLDER'], [new_id])
         return jsonify({'message': 'Software added successfully', 'id': new_id}), 201
         
     except sqlite3.IntegrityError:
@@ -642,7 +941,7 @@ def edit_software(software_id):
     if logo_url and logo_url.startswith('data:image'):
         # 是 Base64 数据，保存新文件
         try:
-            logo_url = save_base64_image(logo_url, data['name'])
+            logo_url = save_base64_image(logo_url)
         except ValueError as e:
             return jsonify({'error': f'Logo Error: {e}'}), 400
     # 否则，如果它是 URL 或空字符串，则直接使用
@@ -675,10 +974,13 @@ def edit_software(software_id):
              silent_args, category, logo_url, install_type, software_id)
         )
         conn.commit()
+        catalog_snapshot.invalidate()
+        logo_collector.schedule(app.config['UPLOAD_FOLDER'])
         
         if cursor.rowcount == 0:
             return jsonify({'error': 'Software not found for update'}), 404
             
+        package_hasher.schedule(app.config['DATABASE'], app.config['PACKAGE_FOLDER'], [software_id])
         return jsonify({'message': 'Software updated successfully'}), 200
         
     except sqlite3.IntegrityError:
@@ -687,6 +989,99 @@ def edit_software(software_id):
         app.logger.error(f"Database error during software update: {e}")
         return jsonify({'error': f'Database error: {e}'}), 500
 
+# --- API 路由：批量部分修改 (PATCH) ---
+
+# PATCH 允许修改的列；不能被清空的列
+PATCH_FIELDS = ('name', 'version', 'description', 'download_url', 'silent_args', 'category', 'logo_url', 'install_type')
+PATCH_REQUIRED_FIELDS = ('name', 'version', 'download_url')
+
+def require_text_fields(data, fields):
+    """检查 data 中给出的字段都是字符串 (或 null)，否则抛出 ValueError"""
+    for field in fields:
+        value = data.get(field)
+        if value is not None and not isinstance(value, str):
+            raise ValueError(f'Field {field} must be a string')
+
+def parse_patch_item(item):
+    """校验一条 {id, 字段...} 修改，返回 (software_id, {列: 值})，数据无效时抛出 ValueError"""
+    # bool 是 int 的子类，true / false 不能当作 id
+    if not isinstance(item, dict) or not isinstance(item.get('id'), int) or isinstance(item['id'], bool):
+        raise ValueError('Each item must be an object with an integer "id"')
+
+    changes = {key: value for key, value in item.items() if key != 'id'}
+    # 与 POST/PUT 保持一致，也接受 logo_base64 字段
+    if 'logo_base64' in changes:
+        changes['logo_url'] = changes.pop('logo_base64')
+    unknown = [key for key in changes if key not in PATCH_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown field(s): {', '.join(unknown)}")
+    if not changes:
+        raise ValueError('No fields to update')
+    require_text_fields(changes, PATCH_FIELDS)
+    for field in PATCH_REQUIRED_FIELDS:
+        if field in changes and not changes[field]:
+            raise ValueError(f'Empty required field: {field}')
+    if 'install_type' in changes and changes['install_type'] not in ['silent', 'manual']:
+        raise ValueError('Invalid install_type. Must be "silent" or "manual".')
+    logo_url = changes.get('logo_url')
+    if logo_url and logo_url.startswith('data:image'):
+        # 这里只检查前缀，图片在全部条目校验通过后才保存
+        parse_image_data_uri(logo_url)
+    return item['id'], changes
+
+@app.route('/api/software', methods=['PATCH'])
+def patch_software():
+    """API：批量部分修改 [{id, 要修改的字段...}, ...]，只更新给出的列，全部在一个事务中完成"""
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'Request body must be a non-empty JSON array'}), 400
+
+    updates = []
+    for index, item in enumerate(items):
+        try:
+            updates.append(parse_patch_item(item))
+        except ValueError as e:
+            return jsonify({'error': f'Item {index}: {e}'}), 400
+
+    # 全部条目校验通过后才保存 Logo；之后任何一步失败都删除本次新写入的文件，不留下孤立文件
+    new_logos = []
+    for index, (software_id, changes) in enumerate(updates):
+        logo_url = changes.get('logo_url')
+        if logo_url and logo_url.startswith('data:image'):
+            try:
+                changes['logo_url'] = save_base64_image(logo_url, new_logos)
+            except ValueError as e:
+                discard_logos(app.config['UPLOAD_FOLDER'], new_logos)
+                return jsonify({'error': f'Item {index}: {e}'}), 400
+
+    conn = get_db_connection()
+    try:
+        for software_id, changes in updates:
+            # 列名来自 PATCH_FIELDS 白名单，可以安全地拼入 SQL
+            assignments = ', '.join(f'{column} = ?' for column in changes)
+            cursor = conn.execute(
+                f'UPDATE software SET {assignments} WHERE id = ?', (*changes.values(), software_id)
+            )
+            if cursor.rowcount == 0:
+                conn.rollback()
+                discard_logos(app.config['UPLOAD_FOLDER'], new_logos)
+                return jsonify({'error': f'Software not found for update: {software_id}'}), 404
+        conn.commit()
+    except sqlite3.IntegrityError as e:
+        conn.rollback()
+        discard_logos(app.config['UPLOAD_FOLDER'], new_logos)
+        return jsonify({'error': f'Integrity error (duplicate name?): {e}'}), 409
+    except Exception as e:
+        conn.rollback()
+        discard_logos(app.config['UPLOAD_FOLDER'], new_logos)
+        app.logger.error(f"Database error during batch patch: {e}")
+        return jsonify({'error': f'Database error: {e}'}), 500
+
+    catalog_snapshot.invalidate()
+    logo_collector.schedule(app.config['UPLOAD_FOLDER'])
+    package_hasher.schedule(app.config['DATABASE'], app.config['PACKAGE_FOLDER'], [software_id for software_id, _ in updates])
+    return jsonify({'message': 'Software updated successfully', 'updated': len(updates)}), 200
+
 # --- API 路由：删除软件 (DELETE) ---
 
 @app.route('/api/software/<int:software_id>', methods=['DELETE'])
@@ -695,6 +1090,8 @@ def delete_software(software_id):
     conn = get_db_connection()
     cursor = conn.execute("DELETE FROM software WHERE id = ?", (software_id,))
     conn.commit()
+    catalog_snapshot.invalidate()
+    logo_collector.schedule(app.config['UPLOAD_FOLDER'])
     
     if cursor.rowcount == 0:
         # 如果没有行被删除，返回 404 (Software Not Found)
@@ -702,6 +1099,180 @@ def delete_software(software_id):
         
     return jsonify({'message': 'Software deleted successfully'}), 200
 
+# --- API 路由：版本历史 ---
+
+@app.route('/api/software/<int:software_id>/versions', methods=['GET'])
+def get_software_versions(software_id):
+    """API：某个软件的历史版本，按发布时间倒序分页 (?limit=&before=<版本 id>)"""
+    limit = min(request.args.get('limit', default=VERSIONS_PAGE_MAX, type=int), VERSIONS_PAGE_MAX)
+    before = request.args.get('before', type=int)
+    if limit < 1:
+        return jsonify({'error': 'Invalid parameter: limit'}), 400
+
+    conn = get_db_connection()
+    if conn.execute('SELECT 1 FROM software WHERE id = ?', (software_id,)).fetchone() is None:
+        return jsonify({'error': 'Software not found'}), 404
+    versions = list_software_versions(conn, software_id, limit, before)
+
+    response = jsonify([dict(row) for row in versions])
+    if len(versions) == limit:
+        next_cursor = versions[-1]['id']
+        response.headers['X-Next-Cursor'] = str(next_cursor)
+        response.headers['Link'] = f'<{url_for("get_software_versions", software_id=software_id, limit=limit, before=next_cursor)}>; rel="next"'
+    return response
+
+@app.route('/api/software/versions/latest', methods=['GET'])
+def get_latest_versions():
+    """API：每个软件最新一次发布的记录 (含发布时间)，不受历史版本数量影响"""
+    conn = get_db_connection()
+    return jsonify([dict(row) for row in latest_software_versions(conn)])
+
+@app.route('/api/software/<int:software_id>/versions/<int:version_id>/restore', methods=['POST'])
+def restore_software_version_route(software_id, version_id):
+    """
+    API：回滚到某个历史版本 (恢复版本号、下载链接和安装参数，并记为一次新的发布)。
+    本地安装包按记录的摘要从 packages/_versions 恢复，该版本的文件已无法恢复时返回 409
+    """
+    conn = get_db_connection()
+    try:
+        software_ids = restore_software_with_package(conn, app.config['PACKAGE_FOLDER'], software_id, version_id)
+    except PackageVersionUnavailable as e:
+        return jsonify({'error': str(e)}), 409
+    if software_ids is None:
+        return jsonify({'error': 'Version not found'}), 404
+    catalog_snapshot.invalidate()
+    package_hasher.schedule(app.config['DATABASE'], app.config['PACKAGE_FOLDER'], software_ids)
+    return jsonify({'message': 'Software version restored successfully'}), 200
+
+# --- 运行指标 ---
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 文本格式的运行指标 (请求延迟、数据库耗时、缓存命中等，见 metrics.py)"""
+    conn = get_db_connection()
+    revision, _ = get_catalog_revision(conn)
+    count, package_bytes = conn.execute('SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM software').fetchone()
+    return metrics_response([
+        ('appstore_catalog_software', '目录中的软件数', count),
+        ('appstore_catalog_package_bytes', '已计算校验和的安装包总字节数', package_bytes),
+        ('appstore_catalog_revision', '目录版本号', revision),
+    ])
+
+# --- API 路由：NDJSON 批量导出/导入 ---
+
+# 按 UNIQUE 的 name 列做 upsert：已存在的软件更新，不存在的新增
+IMPORT_UPSERT_SQL = """
+    INSERT INTO software (name, version, description, download_url, silent_args, category, logo_url, install_type)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(name) DO UPDATE SET
+        version = excluded.version,
+        description = excluded.description,
+        download_url = excluded.download_url,
+        silent_args = excluded.silent_args,
+        category = excluded.category,
+        logo_url = excluded.logo_url,
+        install_type = excluded.install_type
+"""
+
+# 导入时读取的文本字段，给出时必须是字符串或 null
+IMPORT_TEXT_FIELDS = ('name', 'version', 'description', 'download_url', 'silent_args', 'category',
+                      'logo_url', 'logo_base64', 'install_type')
+
+def parse_import_line(line):
+    """把 NDJSON 的一行解析为 upsert 参数元组，数据无效时抛出 ValueError"""
+    data = json.loads(line)
+    if not isinstance(data, dict):
+        raise ValueError('Each line must be a JSON object')
+    require_text_fields(data, IMPORT_TEXT_FIELDS)
+    for field in ('name', 'version', 'download_url'):
+        if not data.get(field):
+            raise ValueError(f'Missing or empty required field: {field}')
+
+    install_type = data.get('install_type', 'silent') or 'silent'
+    if install_type not in ['silent', 'manual']:
+        raise ValueError('Invalid install_type. Must be "silent" or "manual".')
+
+    # 与 POST/PUT 一致：logo 可以是 URL，也可以是 Base64 图片数据
+    logo_url = data.get('logo_url') or data.get('logo_base64') or ''
+    if logo_url.startswith('data:image'):
+        logo_url = save_base64_image(logo_url)
+
+    return (data['name'], data['version'], data.get('description', '') or '', data['download_url'],
+            data.get('silent_args', '') or '', data.get('category', '未分类') or '未分类', logo_url, install_type)
+
+def flush_import_batch(conn, batch, errors):
+    """在一个事务中写入一批记录；整批失败时逐行重试，以便定位出错的行。返回成功写入的行数"""
+    try:
+        conn.executemany(IMPORT_UPSERT_SQL, [params for _, params in batch])
+        conn.commit()
+        return len(batch)
+    except sqlite3.Error:
+        conn.rollback()
+
+    written = 0
+    for line_no, params in batch:
+        try:
+            conn.execute(IMPORT_UPSERT_SQL, params)
+            written += 1
+        except sqlite3.Error as e:
+            errors.append({'line': line_no, 'error': f'Database error: {e}'})
+    conn.commit()
+    return written
+
+@app.route('/api/software/export', methods=['GET'])
+def export_software():
+    """API：以 NDJSON 流式导出全部软件 (每行一个 JSON 对象)，不在内存中拼接完整列表"""
+    conn = get_db_connection()
+
+    def generate():
+        # 整个导出在一个读事务中完成，导出期间的写入不会造成前后不一致
+        with read_transaction(conn):
+            cursor = conn.execute('SELECT * FROM software ORDER BY id')
+            while True:
+                rows = cursor.fetchmany(500)
+                if not rows:
+                    break
+                yield ''.join(json.dumps(dict(row), ensure_ascii=False) + '\n' for row in rows)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={'Content-Disposition': 'attachment; filename=software.ndjson'}
+    )
+
+@app.route('/api/software/import', methods=['POST'])
+def import_software():
+    """API：流式读取 NDJSON 请求体，按名称分批 upsert，返回每一行的错误信息"""
+    conn = get_db_connection()
+    batch, errors = [], []
+    imported = 0
+
+    # request.stream 是无缓冲流，逐行迭代会一个字节一个字节地读取，需要加一层缓冲
+    stream = io.BufferedReader(request.stream, buffer_size=64 * 1024)
+    for line_no, raw_line in enumerate(stream, start=1):
+        line = raw_line.decode('utf-8', errors='replace').strip()
+        if not line:
+            continue
+        try:
+            batch.append((line_no, parse_import_line(line)))
+        except ValueError as e:
+            # json.JSONDecodeError 也是 ValueError 的子类
+            errors.append({'line': line_no, 'error': str(e)})
+            continue
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            imported += flush_import_batch(conn, batch, errors)
+            batch = []
+
+    if batch:
+        imported += flush_import_batch(conn, batch, errors)
+    if imported:
+        catalog_snapshot.invalidate()
+        logo_collector.schedule(app.config['UPLOAD_FOLDER'])
+        package_hasher.schedule(app.config['DATABASE'], app.config['PACKAGE_FOLDER'])
+
+    errors.sort(key=lambda error: error['line'])
+    return jsonify({'imported': imported, 'error_count': len(errors), 'errors': errors}), 200
+
 # --- 网页后台路由 ---
 
 @app.route('/', methods=['GET'])
@@ -712,27 +1283,30 @@ def list_software_page():
     # 接收搜索关键词
     search_query = request.args.get('q', '').strip()
     
-    # 构造 SQL 查询和参数
     if search_query:
-        # 使用 SQLite 的 LIKE 进行模糊搜索
-        search_term = '%' + search_query + '%'
-        sql_query = """
-            SELECT * FROM software 
-            WHERE name LIKE ? OR version LIKE ? OR description LIKE ? OR category LIKE ?
-            ORDER BY id DESC
-        """
-        # 参数列表需要包含搜索词的四次重复
-        params = (search_term, search_term, search_term, search_term)
-    else:
-        # 如果没有搜索词，查询所有
-        sql_query = 'SELECT * FROM software ORDER BY id DESC'
-        params = ()
+        # 使用 FTS5 全文索引搜索名称、版本、描述和分类，按相关度排序
+        software_list = search_software(conn, search_query)
+        result = [dict(row) for row in software_list]
+        # 将搜索词传递给 HTML 生成函数，以便在搜索框中保留
+        return get_software_list_html(result, search_query)
 
-    software_list = conn.execute(sql_query, params).fetchall()
-    
-    result = [dict(row) for row in software_list]
-    # 将搜索词传递给 HTML 生成函数，以便在搜索框中保留
-    return get_software_list_html(result, search_query)
+    # 没有搜索词时每一页只取决于目录版本和分页参数：按版本缓存 HTML 和压缩结果，并支持 304
+    sort, after, before = admin_page_args()
+    page_key = admin_page_key(sort, after, before)
+    revision, _ = get_catalog_revision(conn)
+    encoding = negotiate_encoding()
+    etag = catalog_etag(revision, f"html-{query_variant()}-{encoding}" if encoding else f"html-{query_variant()}")
+    if is_not_modified(etag):
+        return not_modified_response(etag)
+
+    def build_page():
+        # 每页固定行数，沿索引读取；未变化的行直接复用缓存的 HTML 片段
+        admin_page = read_admin_page(conn, sort, after, before)
+        return get_software_list_html(admin_page.rows, page=admin_page).encode('utf-8')
+
+    page = admin_page_cache.get(page_key, revision, build_page)
+    response = apply_encoding(Response(mimetype='text/html'), page.variant(encoding), encoding)
+    return set_cache_validators(response, etag)
 
 
 @app.route('/add', methods=['GET'])
@@ -753,10 +1327,53 @@ def edit_software_page(software_id):
     return get_software_form_html(dict(software))
 
 
+# --- 命令行维护命令 (flask --app app_server ...) ---
+
+@app.cli.command('compact-changes')
+def compact_changes_command():
+    """清理变更日志中较旧的删除记录"""
+    removed = compact_change_log(get_db_connection())
+    print(f"已清理 {removed} 条删除记录。")
+
+
+@app.cli.command('backfill-thumbnails')
+@click.option('--force', is_flag=True, help='重新生成已存在的缩略图')
+def backfill_thumbnails_command(force):
+    """为 logos 目录中已有的图片生成缩略图"""
+    if not thumbnails_available():
+        print("未安装 Pillow (pip install pillow)，无法生成缩略图。")
+        return
+    generated, failed = backfill_thumbnails(app.config['UPLOAD_FOLDER'], force=force)
+    print(f"已生成 {generated} 个文件的缩略图。")
+    for filename in failed:
+        print(f"无法处理: {filename}")
+
+
+@app.cli.command('gc-logos')
+@click.option('--grace', default=3600, show_default=True, help='保留最近多少秒内上传、尚未被引用的文件')
+def gc_logos_command(grace):
+    """删除 logos 目录中不再被任何软件引用的图片及其缩略图"""
+    referenced = load_logo_references(get_db_connection())
+    removed = collect_orphan_logos(app.config['UPLOAD_FOLDER'], referenced, grace_seconds=grace)
+    for relpath in removed:
+        print(f"已删除: {relpath}")
+    print(f"共删除 {len(removed)} 个未引用的 Logo。")
+
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """重建后台搜索使用的全文索引 (旧数据库升级或索引损坏时使用)"""
+    conn = get_db_connection()
+    if not has_search_index(conn) and not init_search_index(conn):
+        print("当前 SQLite 不支持 FTS5 trigram 分词，无法建立全文索引。")
+        return
+    rebuild_search_index(conn)
+    print("全文索引已重建。")
+
 # --- 启动应用 ---
 
 if __name__ == '__main__':
-    # 首次运行时初始化数据库
-    init_db() 
+    # 首次运行时初始化数据库；生产环境请使用 python serve.py app_server
+    bootstrap()
     # host='0.0.0.0' 允许从外部网络访问
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
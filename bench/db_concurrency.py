@@ -0,0 +1,155 @@
+"""
+数据库并发基准：对比旧的连接方式 (每次新建连接 + 默认回滚日志) 与
+连接池 + WAL 模式下，后台写事务进行时目录读取能否继续进行。
+
+写线程模拟耗时较长的后台写入 (如批量导入)：开启排他写事务后保持 hold 毫秒再提交。
+回滚日志模式下读请求会被阻塞甚至报 "database is locked"；
+WAL 模式下读取与写入并行，读延迟基本不受影响。
+
+用法：python bench/db_concurrency.py [--rows 5000] [--readers 4] [--seconds 5] [--hold-ms 50]
+结果以 JSON 输出到标准输出。
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog_db import ConnectionPool, init_catalog_schema  # noqa: E402
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS software (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE,
+        version TEXT NOT NULL,
+        description TEXT,
+        download_url TEXT NOT NULL,
+        silent_args TEXT,
+        category TEXT DEFAULT '未分类',
+        logo_url TEXT,
+        install_type TEXT DEFAULT 'silent'
+    )
+'''
+
+
+def seed_database(path, rows):
+    """创建测试数据库并写入 rows 条软件记录"""
+    conn = sqlite3.connect(path)
+    conn.execute(SCHEMA)
+    init_catalog_schema(conn)
+    conn.executemany(
+        'INSERT INTO software (name, version, description, download_url, silent_args, logo_url) VALUES (?, ?, ?, ?, ?, ?)',
+        [(f'Package {i}', f'{i % 20}.{i % 7}', '基准测试用的软件描述。' * 4,
+          f'http://localhost:5000/download/pkg{i}.exe', '/S', f'/logos/pkg{i}.png') for i in range(rows)]
+    )
+    conn.commit()
+    conn.close()
+
+
+def legacy_connect(path):
+    """与改造前的 get_db_connection 相同：每次新建连接，默认 PRAGMA"""
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run_mode(mode, path, readers, seconds, hold_ms):
+    if mode == 'legacy':
+        # 回滚日志模式
+        conn = sqlite3.connect(path)
+        conn.execute('PRAGMA journal_mode = DELETE')
+        conn.close()
+        acquire, release = (lambda: legacy_connect(path)), (lambda conn: conn.close())
+    else:
+        pool = ConnectionPool(path)
+        acquire, release = pool.acquire, pool.release
+
+    stop = threading.Event()
+    latencies, errors, writes = [], [0], [0]
+    lock = threading.Lock()
+
+    def reader():
+        local = []
+        while not stop.is_set():
+            started = time.perf_counter()
+            conn = acquire()
+            try:
+                # 目录首屏查询 (与 /api/software?limit=50 相同)
+                conn.execute('SELECT * FROM software ORDER BY name LIMIT 50').fetchall()
+                local.append(time.perf_counter() - started)
+            except sqlite3.OperationalError:
+                with lock:
+                    errors[0] += 1
+            finally:
+                release(conn)
+        with lock:
+            latencies.extend(local)
+
+    def writer():
+        while not stop.is_set():
+            conn = acquire()
+            try:
+                conn.execute('BEGIN EXCLUSIVE')
+                conn.execute("UPDATE software SET version = version || '' WHERE id = ?", (writes[0] % 100 + 1,))
+                time.sleep(hold_ms / 1000)
+                conn.commit()
+                writes[0] += 1
+            except sqlite3.OperationalError:
+                with lock:
+                    errors[0] += 1
+            finally:
+                release(conn)
+            time.sleep(hold_ms / 1000)
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)] + [threading.Thread(target=writer)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    return {
+        'mode': mode,
+        'reads': len(latencies),
+        'reads_per_sec': round(len(latencies) / seconds, 1),
+        'read_p50_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'read_p99_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        'read_max_ms': round(max(latencies) * 1000, 2) if latencies else None,
+        'writes': writes[0],
+        'lock_errors': errors[0],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--hold-ms', type=float, default=50)
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for mode in ('legacy', 'pool_wal'):
+            path = os.path.join(workdir, f'{mode}.db')
+            seed_database(path, args.rows)
+            results.append(run_mode(mode, path, args.readers, args.seconds, args.hold_ms))
+    print(json.dumps({'rows': args.rows, 'readers': args.readers, 'hold_ms': args.hold_ms, 'results': results},
+                     ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
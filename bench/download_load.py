@@ -0,0 +1,166 @@
+"""
+下载负载测试：对比 Flask 路径 (serve.py 的 pre-fork + 线程池) 与 download_server.py (asyncio)
+在大量慢速客户端同时下载同一个安装包时的表现。
+
+每个客户端按 --rate 字节/秒限速读取 (模拟广域网)，慢连接会占住线程池中的线程；
+asyncio 服务中每个连接只是一个协程。输出各模式的完成数、错误数、总耗时、
+首字节时间 (TTFB) 和单次下载耗时的分位数。
+
+用法：python bench/download_load.py [--clients 200] [--size-mb 2] [--rate 1048576]
+                                    [--workers 2] [--threads 8] [--modes flask,asyncio]
+结果以 JSON 输出到标准输出。
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PACKAGE_NAME = 'bench-installer.bin'
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def serve_flask(port, workdir, workers, threads):
+    """在子进程中运行：app.py + serve.py 的 pre-fork 线程池服务器"""
+    os.chdir(workdir)
+    import app as app_module
+    from serve import Arbiter, create_listen_socket, make_handler
+    app_module.app.config['PACKAGE_FOLDER'] = os.path.join(workdir, 'packages')
+    app_module.bootstrap()
+    options = {
+        'workers': workers, 'threads': threads, 'handler': make_handler(False),
+        'max_requests': 0, 'max_requests_jitter': 0, 'graceful_timeout': 5,
+    }
+    Arbiter(app_module.app, create_listen_socket('127.0.0.1', port, 2048), options).run()
+
+
+def serve_asyncio(port, workdir):
+    """在子进程中运行：download_server.py"""
+    import download_server
+    asyncio.run(download_server.serve('127.0.0.1', port, os.path.join(workdir, 'packages'),
+                                      os.path.join(ROOT, 'logos'), os.path.join(workdir, 'appstore.db'), 4096))
+
+
+async def download(port, size, rate, chunk_size):
+    """下载一次，返回 (首字节耗时, 总耗时)；读取速度限制在 rate 字节/秒"""
+    started = time.perf_counter()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write(f'GET /download/{PACKAGE_NAME} HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n'.encode())
+        await writer.drain()
+        head = await reader.readuntil(b'\r\n\r\n')
+        ttfb = time.perf_counter() - started
+        if not head.startswith(b'HTTP/1.1 200'):
+            raise RuntimeError(head.split(b'\r\n', 1)[0].decode())
+        received = 0
+        while received < size:
+            data = await reader.read(chunk_size)
+            if not data:
+                break
+            received += len(data)
+            await asyncio.sleep(len(data) / rate)
+        if received != size:
+            raise RuntimeError(f'short read: {received}/{size}')
+        return ttfb, time.perf_counter() - started
+    finally:
+        writer.close()
+
+
+async def run_clients(port, clients, size, rate, chunk_size):
+    results = await asyncio.gather(*(download(port, size, rate, chunk_size) for _ in range(clients)),
+                                   return_exceptions=True)
+    return [r for r in results if not isinstance(r, BaseException)], [r for r in results if isinstance(r, BaseException)]
+
+
+def wait_for_port(port, timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'server on port {port} did not start')
+
+
+def run_mode(mode, args, workdir):
+    port = free_port()
+    command = [sys.executable, os.path.abspath(__file__), '--serve', mode, '--port', str(port), '--workdir', workdir,
+               '--workers', str(args.workers), '--threads', str(args.threads)]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        size = args.size_mb * 1024 * 1024
+        started = time.perf_counter()
+        ok, failed = asyncio.run(run_clients(port, args.clients, size, args.rate, args.chunk_size))
+        elapsed = time.perf_counter() - started
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+    ttfbs = [ttfb for ttfb, _ in ok]
+    totals = [total for _, total in ok]
+    return {
+        'mode': mode,
+        'clients': args.clients,
+        'completed': len(ok),
+        'errors': len(failed),
+        'first_error': repr(failed[0]) if failed else None,
+        'wall_seconds': round(elapsed, 2),
+        'aggregate_mb_per_sec': round(len(ok) * args.size_mb / elapsed, 1),
+        'ttfb_p50_ms': round(percentile(ttfbs, 50) * 1000, 1) if ttfbs else None,
+        'ttfb_p95_ms': round(percentile(ttfbs, 95) * 1000, 1) if ttfbs else None,
+        'ttfb_p99_ms': round(percentile(ttfbs, 99) * 1000, 1) if ttfbs else None,
+        'download_p50_s': round(percentile(totals, 50), 2) if totals else None,
+        'download_p99_s': round(percentile(totals, 99), 2) if totals else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--size-mb', type=int, default=2)
+    parser.add_argument('--rate', type=int, default=1024 * 1024, help='每个客户端的读取速度 (字节/秒)')
+    parser.add_argument('--chunk-size', type=int, default=64 * 1024)
+    parser.add_argument('--workers', type=int, default=2, help='Flask 路径的 worker 进程数')
+    parser.add_argument('--threads', type=int, default=8, help='Flask 路径每个 worker 的线程数')
+    parser.add_argument('--modes', default='flask,asyncio')
+    parser.add_argument('--serve', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve == 'flask':
+        return serve_flask(args.port, args.workdir, args.workers, args.threads)
+    if args.serve == 'asyncio':
+        return serve_asyncio(args.port, args.workdir)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.makedirs(os.path.join(workdir, 'packages'))
+        with open(os.path.join(workdir, 'packages', PACKAGE_NAME), 'wb') as f:
+            f.write(os.urandom(args.size_mb * 1024 * 1024))
+        results = [run_mode(mode, args, workdir) for mode in args.modes.split(',')]
+    print(json.dumps({'results': results}, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,362 @@
+"""
+服务端基准：用不同规模的合成目录 (默认 100 / 1 万 / 10 万条软件，带 Logo) 测量主要接口的
+吞吐、延迟分位数和峰值内存，结果可按提交保存下来做对比。
+
+每个 (目录规模, 方式) 组合在单独的子进程中运行，峰值 RSS 互不影响：
+  test-client  在当前进程中通过 Flask 测试客户端调用 (不含网络开销；峰值 RSS 包含生成数据的开销)
+  http         用 serve.py (pre-fork + 线程池) 启动真实服务，多个线程并发请求 (serve.py 每个响应后关闭连接，含建立连接的开销)
+               (峰值 RSS 取服务端进程树中最大的一个进程)
+每个接口先单独请求一次记为 first_ms (缓存为空时的耗时)，之后按 --concurrency 个并发发送 --requests 个请求。
+写接口 (添加、修改) 在读接口之后运行。
+
+用法：python bench/server_bench.py [--target app] [--sizes 100,10000,100000] [--modes test-client,http]
+                                   [--requests 300] [--concurrency 8] [--logos 200] [--workers 2] [--threads 8]
+结果以 JSON 输出到标准输出，例如：python bench/server_bench.py > bench-$(git rev-parse --short HEAD).json
+"""
+import argparse
+import http.client
+import io
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+READ_ENDPOINTS = ('catalog', 'catalog_page', 'admin_list', 'edit_form', 'logo_thumbnail', 'logo_original')
+WRITE_ENDPOINTS = ('add', 'update')
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def peak_rss_mb(who):
+    """ru_maxrss 在 Linux 上以 KB 为单位，macOS 上以字节为单位"""
+    rss = resource.getrusage(who).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+# --- 生成合成目录 ---
+
+def load_target(target, workdir):
+    """在 workdir 中导入应用模块 (数据库路径相对于当前目录) 并指向 workdir 中的 logos / packages"""
+    os.chdir(workdir)
+    module = __import__(target)
+    module.app.config['UPLOAD_FOLDER'] = os.path.join(workdir, 'logos')
+    module.app.config['PACKAGE_FOLDER'] = os.path.join(workdir, 'packages')
+    os.makedirs(module.app.config['UPLOAD_FOLDER'], exist_ok=True)
+    os.makedirs(module.app.config['PACKAGE_FOLDER'], exist_ok=True)
+    return module
+
+
+def make_logos(upload_folder, count):
+    """生成 count 个不同颜色的 PNG Logo 及其缩略图；没有 Pillow 时只使用默认 Logo"""
+    from logo_store import store_logo_chunks, generate_thumbnails
+    if Image is None:
+        with open(os.path.join(ROOT, 'default_logo.png'), 'rb') as f:
+            return [store_logo_chunks(upload_folder, [f.read()], 'png')[0]]
+    names = []
+    rng = random.Random(0)
+    for _ in range(count):
+        buffer = io.BytesIO()
+        Image.new('RGB', (128, 128), tuple(rng.randrange(256) for _ in range(3))).save(buffer, 'PNG')
+        name, created = store_logo_chunks(upload_folder, [buffer.getvalue()], 'png')
+        if created:
+            generate_thumbnails(upload_folder, name)
+        names.append(name)
+    return names
+
+
+def seed_catalog(module, rows, logo_count):
+    """初始化数据库并在一个事务中写入 rows 条软件，返回 (Logo 文件名列表, 耗时秒数)"""
+    from catalog_db import get_connection_pool
+    started = time.perf_counter()
+    module.bootstrap()
+    logos = make_logos(module.app.config['UPLOAD_FOLDER'], logo_count)
+    pool = get_connection_pool(module.app.config['DATABASE'])
+    conn = pool.acquire()
+    try:
+        conn.executemany(
+            'INSERT INTO software (name, version, install_type, description, download_url, logo_url, silent_args) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            ((f'Package {i}', f'{i % 20}.{i % 7}', 'silent' if i % 3 else 'manual', '基准测试用的软件描述。' * 4,
+              f'https://downloads.example.com/pkg{i}.exe', f'/logos/{logos[i % len(logos)]}', '/S')
+             for i in range(rows))
+        )
+        conn.commit()
+    finally:
+        pool.release(conn)
+    return logos, time.perf_counter() - started
+
+
+def request_for(endpoint, rows, logos, rng):
+    """返回 (方法, 路径, JSON 请求体)"""
+    software_id = rng.randint(1, rows)
+    logo = logos[rng.randrange(len(logos))]
+    if endpoint == 'catalog':
+        return 'GET', '/api/software', None
+    if endpoint == 'catalog_page':
+        return 'GET', '/api/software?limit=100', None
+    if endpoint == 'admin_list':
+        return 'GET', '/', None
+    if endpoint == 'edit_form':
+        return 'GET', f'/edit/{software_id}', None
+    if endpoint == 'logo_thumbnail':
+        return 'GET', f'/logos/{logo}?size=40', None
+    if endpoint == 'logo_original':
+        return 'GET', f'/logos/{logo}', None
+    # 写接口：请求体同时满足 app.py 和 app_server.py 的字段要求 (app_server.py 的名称唯一)
+    name = f'Bench {rng.getrandbits(64):x}' if endpoint == 'add' else f'Bench Update {software_id}'
+    body = {'name': name, 'version': f'{rng.randint(1, 99)}.0', 'install_type': 'silent', 'description': 'benchmark',
+            'download_url': f'https://downloads.example.com/{name}.exe', 'logo_url': f'/logos/{logo}',
+            'logo_base64': f'/logos/{logo}', 'silent_args': '/S'}
+    if endpoint == 'add':
+        return 'POST', '/api/software', body
+    return 'PUT', f'/api/software/{software_id}', body
+
+
+# --- 发送请求 ---
+
+class TestClientSession:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def send(self, method, path, body):
+        response = self.client.open(path, method=method, json=body, headers={'Accept-Encoding': 'gzip'})
+        response.get_data()
+        return response.status_code
+
+    def close(self):
+        pass
+
+
+class HTTPSession:
+    """一个 HTTP 连接；服务端关闭连接后 (serve.py 每个响应后都会关闭) 重新建立"""
+
+    def __init__(self, port):
+        self.port = port
+        self.conn = None
+
+    def send(self, method, path, body):
+        headers = {'Accept-Encoding': 'gzip'}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        for attempt in (0, 1):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+            try:
+                self.conn.request(method, path, payload, headers)
+                response = self.conn.getresponse()
+                response.read()
+                if response.will_close:
+                    self.close()
+                return response.status
+            except (OSError, http.client.HTTPException):
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def run_endpoint(endpoint, new_session, rows, logos, requests, concurrency):
+    rng = random.Random(endpoint)
+    session = new_session()
+    started = time.perf_counter()
+    first_status = session.send(*request_for(endpoint, rows, logos, rng))
+    first_ms = (time.perf_counter() - started) * 1000
+    session.close()
+
+    latencies, errors = [], []
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def worker(seed):
+        local_rng = random.Random(f'{endpoint}-{seed}')
+        session = new_session()
+        try:
+            while True:
+                with lock:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+                method, path, body = request_for(endpoint, rows, logos, local_rng)
+                started = time.perf_counter()
+                try:
+                    status = session.send(method, path, body)
+                except Exception as e:
+                    with lock:
+                        errors.append(repr(e))
+                    continue
+                elapsed = time.perf_counter() - started
+                with lock:
+                    if status >= 400:
+                        errors.append(f'HTTP {status}')
+                    else:
+                        latencies.append(elapsed)
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    return {
+        'requests': requests,
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+        'first_status': first_status,
+        'first_ms': round(first_ms, 2),
+        'requests_per_sec': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+    }
+
+
+def run_endpoints(new_session, rows, logos, args):
+    return {endpoint: run_endpoint(endpoint, new_session, rows, logos, args.requests, args.concurrency)
+            for endpoint in READ_ENDPOINTS + WRITE_ENDPOINTS}
+
+
+# --- 子进程入口 ---
+
+def serve(args):
+    """http 方式的服务端子进程：目录已由父进程生成，这里只启动 serve.py 的多进程服务器"""
+    from serve import Arbiter, create_listen_socket, make_handler
+    module = load_target(args.target, args.workdir)
+    module.bootstrap()
+    options = {
+        'workers': args.workers, 'threads': args.threads, 'handler': make_handler(False),
+        'max_requests': 0, 'max_requests_jitter': 0, 'graceful_timeout': 10,
+        'worker_exit': getattr(module, 'worker_exit', None),
+    }
+    Arbiter(module.app, create_listen_socket('127.0.0.1', args.port, 2048), options).run()
+
+
+def wait_for_port(port, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'server on port {port} did not start')
+
+
+def run_once(args):
+    """在新的临时目录中生成目录并测量一种方式，返回结果字典"""
+    with tempfile.TemporaryDirectory() as workdir:
+        module = load_target(args.target, workdir)
+        logos, seed_seconds = seed_catalog(module, args.size, args.logos)
+        result = {'size': args.size, 'mode': args.run, 'logos': len(logos), 'seed_seconds': round(seed_seconds, 2)}
+
+        if args.run == 'test-client':
+            result['endpoints'] = run_endpoints(lambda: TestClientSession(module.app), args.size, logos, args)
+            result['peak_rss_mb'] = peak_rss_mb(resource.RUSAGE_SELF)
+            return result
+
+        port = free_port()
+        command = [sys.executable, os.path.abspath(__file__), '--serve', '--target', args.target, '--workdir', workdir,
+                   '--port', str(port), '--workers', str(args.workers), '--threads', str(args.threads)]
+        server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+        try:
+            wait_for_port(port)
+            result['endpoints'] = run_endpoints(lambda: HTTPSession(port), args.size, logos, args)
+        finally:
+            server.terminate()
+            server.wait(timeout=60)
+        result['workers'], result['threads'] = args.workers, args.threads
+        # 服务端主进程回收了各个 worker，这里得到的是整个进程树中最大的那个进程的峰值
+        result['peak_rss_mb'] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+        return result
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--target', default='app', choices=('app', 'app_server'))
+    parser.add_argument('--sizes', default='100,10000,100000', help='逗号分隔的目录规模 (软件条数)')
+    parser.add_argument('--modes', default='test-client,http')
+    parser.add_argument('--requests', type=int, default=300, help='每个接口的请求数')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--logos', type=int, default=200, help='生成的不同 Logo 数 (需要 Pillow)')
+    parser.add_argument('--workers', type=int, default=2, help='http 方式的 worker 进程数')
+    parser.add_argument('--threads', type=int, default=8, help='http 方式每个 worker 的线程数')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args)
+    if args.run:
+        print(json.dumps(run_once(args)))
+        return
+
+    results = []
+    for size in (int(size) for size in args.sizes.split(',')):
+        for mode in args.modes.split(','):
+            command = [sys.executable, os.path.abspath(__file__), '--run', mode, '--size', str(size),
+                       '--target', args.target, '--requests', str(args.requests),
+                       '--concurrency', str(args.concurrency), '--logos', str(args.logos),
+                       '--workers', str(args.workers), '--threads', str(args.threads)]
+            output = subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+            print(f"[server_bench] {args.target} size={size} mode={mode} 完成", file=sys.stderr)
+
+    print(json.dumps({
+        'commit': current_commit(),
+        'target': args.target,
+        'python': platform.python_version(),
+        'pillow': Image is not None,
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'results': results,
+    }, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
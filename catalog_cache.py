@@ -0,0 +1,67 @@
+"""
+目录快照缓存：缓存已经编码 (并已压缩) 的 /api/software JSON 字节。
+
+读请求只需比较版本号后返回内存中的字节，不再查询软件表和序列化；
+写接口提交后调用 invalidate()，下一次读取时重建一次。
+重建过程有锁保护 (single-flight)，并发的冷请求只会触发一次重建。
+"""
+import threading
+from flask import Response
+from compression import CompressedBody, supported_encodings, apply_encoding
+from http_cache import catalog_etag, set_cache_validators
+
+
+class CatalogSnapshot:
+    """某个目录版本对应的已编码响应体 (及 gzip / brotli 压缩版本)"""
+
+    __slots__ = ('revision', 'updated_at', 'content')
+
+    def __init__(self, revision, updated_at, body):
+        self.revision = revision
+        self.updated_at = updated_at
+        # 构建快照时一次性压缩好所有支持的编码
+        self.content = CompressedBody(body, eager_encodings=supported_encodings())
+
+
+class CatalogSnapshotCache:
+    """进程内的目录快照缓存"""
+
+    def __init__(self):
+        self._snapshot = None
+        self._lock = threading.Lock()
+        # 命中 / 未命中次数，供 metrics.py 采集 (不加锁递增，是近似值)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, revision, build):
+        """
+        返回不早于 revision 的快照。
+        build() 需返回 (revision, updated_at, body_bytes)，且三者来自同一个读事务。
+        """
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.revision >= revision:
+            self.hits += 1
+            return snapshot
+
+        with self._lock:
+            # 等锁期间其他线程可能已经完成重建
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot.revision >= revision:
+                self.hits += 1
+                return snapshot
+            self.misses += 1
+            snapshot = CatalogSnapshot(*build())
+            self._snapshot = snapshot
+            return snapshot
+
+    def invalidate(self):
+        """写操作提交后调用，丢弃当前快照"""
+        self._snapshot = None
+
+
+def snapshot_response(snapshot, encoding=''):
+    """用快照构造响应；encoding 为 'gzip' / 'br' 时直接返回预压缩的字节"""
+    response = apply_encoding(Response(mimetype='application/json'), snapshot.content.variant(encoding), encoding)
+    # 客户端据此记录版本号，之后可改用 /api/software/changes 增量同步
+    response.headers['X-Catalog-Revision'] = str(snapshot.revision)
+    return set_cache_validators(response, catalog_etag(snapshot.revision, encoding))
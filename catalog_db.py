@@ -0,0 +1,532 @@
+"""
+app.py 与 app_server.py 共用的 SQLite 目录辅助函数。
+
+两个服务读写同一个 appstore.db，这里集中维护两边都需要的附加表和触发器，
+保证无论哪个服务写入，目录版本号都能同步递增。
+"""
+import base64
+import binascii
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# --- 连接池 ---
+
+# 每个新连接都会执行的 PRAGMA：
+# busy_timeout 让写锁冲突时等待而不是立即报 "database is locked"；
+# WAL 模式下 synchronous=NORMAL 仍然保证数据库一致性，只是断电时可能丢失最后几个事务。
+CONNECTION_PRAGMAS = (
+    'PRAGMA busy_timeout = 5000',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -16000',      # 每个连接 16 MB 页缓存
+    'PRAGMA mmap_size = 268435456',    # 256 MB 内存映射读取
+    'PRAGMA temp_store = MEMORY',
+)
+# 新建连接使用的连接类，metrics.py 会换成记录语句耗时的子类
+_connection_factory = sqlite3.Connection
+
+
+def use_connection_factory(factory):
+    """设置之后新建连接使用的 sqlite3.Connection 子类 (已在池中的连接不受影响)"""
+    global _connection_factory
+    _connection_factory = factory
+
+
+class ConnectionPool:
+    """
+    进程内的 SQLite 连接池。
+    请求结束时连接归还池中复用，而不是每个请求重新打开数据库；
+    fork 出的子进程不会复用父进程的连接，而是各自新建。
+    """
+
+    def __init__(self, database, max_idle=16):
+        self.database = database
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._wal_enabled = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, check_same_thread=False, factory=_connection_factory)
+        conn.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        if not self._wal_enabled:
+            # journal_mode 会持久化到数据库文件，每个进程设置一次即可
+            conn.execute('PRAGMA journal_mode = WAL')
+            self._wal_enabled = True
+        return conn
+
+    def acquire(self):
+        """取出一个空闲连接，没有时新建"""
+        with self._lock:
+            if self._pid != os.getpid():
+                # 在 fork 出的子进程中：丢弃继承来的连接 (不能关闭，父进程仍在使用)
+                self._idle = []
+                self._pid = os.getpid()
+            if self._idle:
+                return self._idle.pop()
+        return self._connect()
+
+    def release(self, conn):
+        """归还连接；未提交的事务会被回滚，超出空闲上限的连接直接关闭"""
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if self._pid == os.getpid() and len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_connection_pool(database):
+    """按数据库路径获取 (或创建) 连接池"""
+    pool = _pools.get(database)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(database, ConnectionPool(database))
+    return pool
+
+
+def ensure_index(conn, index_name, table, columns):
+    """创建索引，若该表已有覆盖相同列的索引 (如 UNIQUE 约束自带的索引) 则跳过"""
+    for index in conn.execute(f'PRAGMA index_list({table})').fetchall():
+        indexed = [row[2] for row in conn.execute(f'PRAGMA index_info("{index[1]}")')]
+        if indexed == list(columns):
+            return
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON {table} ({", ".join(columns)})')
+
+
+# --- 目录版本号 (catalog revision) 与变更日志 ---
+
+# 版本号由触发器在 software 表的每次增/改/删后自动递增，
+# 因此 app.py、app_server.py 以及直接操作数据库的脚本都会被覆盖。
+# software_changes 每个软件只保留一行，记录它最后一次变更时的版本号，
+# 删除的软件保留为墓碑 (deleted = 1)，供增量同步接口返回。
+CATALOG_META_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS catalog_meta (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        revision INTEGER NOT NULL DEFAULT 0,
+        updated_at INTEGER NOT NULL,
+        compacted_revision INTEGER NOT NULL DEFAULT 0
+    );
+
+    INSERT OR IGNORE INTO catalog_meta (id, revision, updated_at)
+    VALUES (1, 0, CAST(strftime('%s', 'now') AS INTEGER));
+
+    CREATE TABLE IF NOT EXISTS software_changes (
+        software_id INTEGER PRIMARY KEY,
+        revision INTEGER NOT NULL,
+        deleted INTEGER NOT NULL DEFAULT 0
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_software_changes_revision ON software_changes (revision);
+
+    DROP TRIGGER IF EXISTS software_revision_insert;
+    CREATE TRIGGER software_revision_insert AFTER INSERT ON software
+    BEGIN
+        UPDATE catalog_meta
+        SET revision = revision + 1, updated_at = CAST(strftime('%s', 'now') AS INTEGER)
+        WHERE id = 1;
+        INSERT OR REPLACE INTO software_changes (software_id, revision, deleted)
+        VALUES (NEW.id, (SELECT revision FROM catalog_meta WHERE id = 1), 0);
+    END;
+
+    DROP TRIGGER IF EXISTS software_revision_update;
+    CREATE TRIGGER software_revision_update AFTER UPDATE ON software
+    BEGIN
+        UPDATE catalog_meta
+        SET revision = revision + 1, updated_at = CAST(strftime('%s', 'now') AS INTEGER)
+        WHERE id = 1;
+        INSERT OR REPLACE INTO software_changes (software_id, revision, deleted)
+        VALUES (NEW.id, (SELECT revision FROM catalog_meta WHERE id = 1), 0);
+    END;
+
+    DROP TRIGGER IF EXISTS software_revision_delete;
+    CREATE TRIGGER software_revision_delete AFTER DELETE ON software
+    BEGIN
+        UPDATE catalog_meta
+        SET revision = revision + 1, updated_at = CAST(strftime('%s', 'now') AS INTEGER)
+        WHERE id = 1;
+        INSERT OR REPLACE INTO software_changes (software_id, revision, deleted)
+        VALUES (OLD.id, (SELECT revision FROM catalog_meta WHERE id = 1), 1);
+    END;
+'''
+
+
+def ensure_column(conn, table, column, declaration):
+    """为旧数据库补充新增的列 (SQLite 不支持 ADD COLUMN IF NOT EXISTS)"""
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {declaration}')
+
+
+def init_catalog_schema(conn):
+    """创建目录版本号表、变更日志和触发器 (需在 software 表创建之后调用)"""
+    had_change_log = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'software_changes'"
+    ).fetchone() is not None
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'catalog_meta'").fetchone():
+        # 早于此版本号的墓碑已被清理，比它更旧的客户端需要全量同步
+        ensure_column(conn, 'catalog_meta', 'compacted_revision', 'INTEGER NOT NULL DEFAULT 0')
+    conn.executescript(CATALOG_META_SCHEMA)
+    if not had_change_log:
+        # 变更日志是新建的，此前的变更无从查起，旧版本号一律全量同步
+        conn.execute('UPDATE catalog_meta SET compacted_revision = revision WHERE id = 1')
+    conn.commit()
+
+
+@contextmanager
+def read_transaction(conn):
+    """在一个读事务中执行多条查询，保证它们看到同一份数据"""
+    conn.execute('BEGIN')
+    try:
+        yield conn
+    finally:
+        conn.commit()
+
+
+def get_catalog_revision(conn):
+    """返回 (revision, updated_at)，updated_at 为 Unix 时间戳 (秒)"""
+    row = conn.execute('SELECT revision, updated_at FROM catalog_meta WHERE id = 1').fetchone()
+    if row is None:
+        return 0, 0
+    return row[0], row[1]
+
+
+def read_catalog_rows(conn, sql, params=()):
+    """在同一个读事务中读取版本号和软件行，保证两者一致，返回 (revision, updated_at, rows)"""
+    with read_transaction(conn):
+        revision, updated_at = get_catalog_revision(conn)
+        rows = conn.execute(sql, params).fetchall()
+    return revision, updated_at, rows
+
+
+def select_software_columns(conn, fields, required=('id',)):
+    """
+    解析 ?fields=a,b,c 稀疏字段参数，返回要查询的列名列表。
+    只接受 software 表中真实存在的列 (未知字段忽略)，required 中的列总是包含在内。
+    """
+    available = [row[1] for row in conn.execute('PRAGMA table_info(software)')]
+    if not fields:
+        return available
+    wanted = [field.strip() for field in fields.split(',') if field.strip()]
+    columns = list(required)
+    columns += [field for field in wanted if field in available and field not in columns]
+    return columns
+
+
+def encode_cursor(value):
+    """把分页游标 (如软件名称) 编码为可放入 URL 和响应头的不透明字符串"""
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """解码 encode_cursor 生成的游标，格式无效时返回 None"""
+    try:
+        return base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+
+def read_catalog_changes(conn, since, full_sql):
+    """
+    读取 since 之后的增量变更。
+    返回 (revision, rows, deleted_ids, full)：
+    full 为 True 时 rows 是 full_sql 查询到的完整列表 (客户端版本过旧或无效)。
+    """
+    with read_transaction(conn):
+        revision, _ = get_catalog_revision(conn)
+        compacted = conn.execute('SELECT compacted_revision FROM catalog_meta WHERE id = 1').fetchone()[0]
+
+        if since < compacted or since > revision:
+            return revision, conn.execute(full_sql).fetchall(), [], True
+
+        rows = conn.execute('''
+            SELECT s.* FROM software_changes c JOIN software s ON s.id = c.software_id
+            WHERE c.revision > ? AND c.deleted = 0
+            ORDER BY c.revision
+        ''', (since,)).fetchall()
+        deleted_ids = [row[0] for row in conn.execute(
+            'SELECT software_id FROM software_changes WHERE revision > ? AND deleted = 1', (since,)
+        )]
+    return revision, rows, deleted_ids, False
+
+
+def compact_change_log(conn, keep_revisions=1000):
+    """清理较旧的删除墓碑，返回清理的条数；落后超过 keep_revisions 的客户端将改为全量同步"""
+    revision, _ = get_catalog_revision(conn)
+    horizon = revision - keep_revisions
+    if horizon <= 0:
+        return 0
+    cursor = conn.execute('DELETE FROM software_changes WHERE deleted = 1 AND revision <= ?', (horizon,))
+    conn.execute(
+        'UPDATE catalog_meta SET compacted_revision = MAX(compacted_revision, ?) WHERE id = 1', (horizon,)
+    )
+    conn.commit()
+    return cursor.rowcount
+
+
+# --- 版本历史 ---
+
+# software 表每个软件只有一行，始终是当前版本，目录列表只读这张表，不受历史记录数量影响。
+# 每次发布 (新增软件，或版本号、下载链接、安装参数变化) 由触发器追加一行 software_versions，
+# 安装包被同名替换 (校验和变化) 也记为一次发布。历史只增不改 (除补填校验和外)；id 自增且不复用，同一软件 id 最大的一行即最新版本，
+# 通过 (software_id, id DESC) 索引一次查找即可取得，"每个软件的最新版本" 为 O(软件数)。
+VERSION_HISTORY_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS software_versions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        software_id INTEGER NOT NULL,
+        version TEXT NOT NULL,
+        install_type TEXT,
+        download_url TEXT NOT NULL,
+        silent_args TEXT,
+        sha256 TEXT,
+        size_bytes INTEGER,
+        published_at INTEGER NOT NULL
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_software_versions_latest ON software_versions (software_id, id DESC);
+
+    DROP TRIGGER IF EXISTS software_version_insert;
+    CREATE TRIGGER software_version_insert AFTER INSERT ON software
+    BEGIN
+        INSERT INTO software_versions (software_id, version, install_type, download_url, silent_args,
+                                       sha256, size_bytes, published_at)
+        VALUES (NEW.id, NEW.version, NEW.install_type, NEW.download_url, NEW.silent_args,
+                NEW.sha256, NEW.size_bytes, CAST(strftime('%s', 'now') AS INTEGER));
+    END;
+
+    DROP TRIGGER IF EXISTS software_version_update;
+    CREATE TRIGGER software_version_update AFTER UPDATE OF version, install_type, download_url, silent_args ON software
+    WHEN OLD.version IS NOT NEW.version OR OLD.install_type IS NOT NEW.install_type
+      OR OLD.download_url IS NOT NEW.download_url OR OLD.silent_args IS NOT NEW.silent_args
+    BEGIN
+        -- 下载链接变化时旧校验和作废，等后台重新计算后由 software_version_checksum 补填；
+        -- 同一条 UPDATE 同时写入了新摘要 (恢复历史版本) 时直接记录
+        INSERT INTO software_versions (software_id, version, install_type, download_url, silent_args,
+                                       sha256, size_bytes, published_at)
+        VALUES (NEW.id, NEW.version, NEW.install_type, NEW.download_url, NEW.silent_args,
+                CASE WHEN OLD.download_url IS NEW.download_url OR OLD.sha256 IS NOT NEW.sha256 THEN NEW.sha256 END,
+                CASE WHEN OLD.download_url IS NEW.download_url OR OLD.sha256 IS NOT NEW.sha256 THEN NEW.size_bytes END,
+                CAST(strftime('%s', 'now') AS INTEGER));
+    END;
+
+    -- 只处理单纯的校验和变化 (发布信息同时变化时由 software_version_update 记录)：
+    -- 最新一条历史还没有摘要时补填；
+    -- 最新一条是先改版本号、还没替换安装包时记下的 (摘要与前一条相同，取自旧文件)，
+    -- 现在同名替换了安装包，改写这一条，不留下 "新版本号 + 旧文件摘要" 的记录；
+    -- 其余情况说明安装包被同名替换，追加一条新的发布，不改写旧记录，恢复历史版本时才能按原来的摘要找回文件
+    DROP TRIGGER IF EXISTS software_version_checksum;
+    CREATE TRIGGER software_version_checksum AFTER UPDATE OF sha256, size_bytes ON software
+    WHEN NEW.sha256 IS NOT NULL AND OLD.version IS NEW.version AND OLD.install_type IS NEW.install_type
+      AND OLD.download_url IS NEW.download_url AND OLD.silent_args IS NEW.silent_args
+    BEGIN
+        UPDATE software_versions SET sha256 = NEW.sha256, size_bytes = NEW.size_bytes
+        WHERE id = (SELECT id FROM software_versions WHERE software_id = NEW.id ORDER BY id DESC LIMIT 1)
+          AND download_url = NEW.download_url AND sha256 IS NULL;
+        UPDATE software_versions SET sha256 = NEW.sha256, size_bytes = NEW.size_bytes
+        WHERE id = (SELECT id FROM software_versions WHERE software_id = NEW.id ORDER BY id DESC LIMIT 1)
+          AND download_url = NEW.download_url AND sha256 = OLD.sha256
+          AND EXISTS (SELECT 1 FROM software_versions latest, software_versions previous
+                      WHERE latest.id = (SELECT id FROM software_versions WHERE software_id = NEW.id ORDER BY id DESC LIMIT 1)
+                        AND previous.id = (SELECT id FROM software_versions
+                                           WHERE software_id = NEW.id AND id < latest.id ORDER BY id DESC LIMIT 1)
+                        AND previous.sha256 = latest.sha256 AND previous.version IS NOT latest.version);
+        INSERT INTO software_versions (software_id, version, install_type, download_url, silent_args,
+                                       sha256, size_bytes, published_at)
+        SELECT NEW.id, NEW.version, NEW.install_type, NEW.download_url, NEW.silent_args,
+               NEW.sha256, NEW.size_bytes, CAST(strftime('%s', 'now') AS INTEGER)
+        WHERE EXISTS (SELECT 1 FROM software_versions
+                      WHERE id = (SELECT id FROM software_versions WHERE software_id = NEW.id ORDER BY id DESC LIMIT 1)
+                        AND sha256 IS NOT NEW.sha256);
+    END;
+
+    DROP TRIGGER IF EXISTS software_version_delete;
+    CREATE TRIGGER software_version_delete AFTER DELETE ON software
+    BEGIN
+        DELETE FROM software_versions WHERE software_id = OLD.id;
+    END;
+'''
+
+# 恢复历史版本时写回 software 表的列
+VERSION_RESTORE_COLUMNS = ('version', 'install_type', 'download_url', 'silent_args')
+
+
+def init_version_history(conn):
+    """创建版本历史表及触发器 (需在 init_package_schema 之后调用)，并为还没有历史的软件补一条当前版本"""
+    conn.executescript(VERSION_HISTORY_SCHEMA)
+    conn.execute('''
+        INSERT INTO software_versions (software_id, version, install_type, download_url, silent_args,
+                                       sha256, size_bytes, published_at)
+        SELECT s.id, s.version, s.install_type, s.download_url, s.silent_args,
+               s.sha256, s.size_bytes, CAST(strftime('%s', 'now') AS INTEGER)
+        FROM software s
+        WHERE NOT EXISTS (SELECT 1 FROM software_versions v WHERE v.software_id = s.id)
+    ''')
+    conn.commit()
+
+
+def list_software_versions(conn, software_id, limit, before=None):
+    """按发布时间倒序返回某个软件的历史版本，before 为上一页最后一条的版本 id"""
+    if before is not None:
+        sql = 'SELECT * FROM software_versions WHERE software_id = ? AND id < ? ORDER BY id DESC LIMIT ?'
+        params = (software_id, before, limit)
+    else:
+        sql = 'SELECT * FROM software_versions WHERE software_id = ? ORDER BY id DESC LIMIT ?'
+        params = (software_id, limit)
+    return conn.execute(sql, params).fetchall()
+
+
+def latest_software_versions(conn):
+    """每个软件的最新版本记录，每个软件只做一次索引查找"""
+    return conn.execute('''
+        SELECT v.* FROM software s
+        JOIN software_versions v
+          ON v.id = (SELECT id FROM software_versions WHERE software_id = s.id ORDER BY id DESC LIMIT 1)
+        ORDER BY s.id
+    ''').fetchall()
+
+
+def restore_software_version(conn, software_id, version_id, restore_package=None):
+    """
+    把软件恢复为某个历史版本 (写回版本号、安装类型、下载链接和安装参数)，返回是否找到该版本。
+    恢复本身也会记为一次新的发布。restore_package(download_url, sha256) 负责先把该版本的安装包放回原位：
+    返回 (sha256, size_bytes) 时与其他列在同一条 UPDATE 中写入，新的历史记录即为恢复后文件的摘要；
+    返回 None 时校验和由后台按实际文件重新计算。它抛出的异常原样传给调用方，数据库不做修改。
+    """
+    row = conn.execute(
+        f"SELECT {', '.join(VERSION_RESTORE_COLUMNS)}, sha256 FROM software_versions WHERE id = ? AND software_id = ?",
+        (version_id, software_id)
+    ).fetchone()
+    if row is None:
+        return False
+    values = tuple(row)[:len(VERSION_RESTORE_COLUMNS)]
+    checksum = restore_package(row['download_url'], row['sha256']) if restore_package is not None else None
+    assignments = ', '.join(f'{column} = ?' for column in VERSION_RESTORE_COLUMNS)
+    if checksum is None:
+        conn.execute(f"UPDATE software SET {assignments} WHERE id = ?", (*values, software_id))
+    else:
+        # 与 update_package_checksums 一样记下被替换的摘要，供生成差分补丁
+        conn.execute(f"""
+            UPDATE software SET {assignments},
+                previous_sha256 = CASE WHEN sha256 IS NOT NULL AND sha256 != ? THEN sha256 ELSE previous_sha256 END,
+                sha256 = ?, size_bytes = ?
+            WHERE id = ?
+        """, (*values, checksum[0], checksum[0], checksum[1], software_id))
+    conn.commit()
+    return True
+
+
+# --- 全文搜索索引 (FTS5) ---
+
+# 参与搜索的列；app.py 建的表没有 category，创建索引时只取实际存在的列
+SEARCH_COLUMNS = ('name', 'version', 'description', 'category')
+# trigram 分词的最短可索引长度，更短的关键词只能用 LIKE 匹配
+TRIGRAM_MIN_LENGTH = 3
+
+
+def has_search_index(conn):
+    """数据库中是否已经建立 software_fts 全文索引"""
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'software_fts'"
+    ).fetchone() is not None
+
+
+def init_search_index(conn):
+    """
+    创建 software_fts 全文索引及同步触发器，返回是否成功。
+    使用 trigram 分词：按三字符切分，中文无需分词也能做子串 (含前缀) 匹配。
+    SQLite 未编译 FTS5 或版本过旧时返回 False，搜索会退回 LIKE 查询。
+    """
+    available = [row[1] for row in conn.execute('PRAGMA table_info(software)')]
+    columns = [column for column in SEARCH_COLUMNS if column in available]
+    existed = has_search_index(conn)
+    try:
+        conn.execute(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS software_fts USING fts5(
+                {', '.join(columns)}, content='software', content_rowid='id', tokenize='trigram'
+            )
+        """)
+    except sqlite3.OperationalError:
+        return False
+
+    # 若索引是旧表结构建的，以索引中实际存在的列为准
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(software_fts)')]
+    column_list = ', '.join(columns)
+    new_values = ', '.join(f'NEW.{column}' for column in columns)
+    old_values = ', '.join(f'OLD.{column}' for column in columns)
+    conn.executescript(f'''
+        CREATE TRIGGER IF NOT EXISTS software_fts_insert AFTER INSERT ON software
+        BEGIN
+            INSERT INTO software_fts (rowid, {column_list}) VALUES (NEW.id, {new_values});
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS software_fts_delete AFTER DELETE ON software
+        BEGIN
+            INSERT INTO software_fts (software_fts, rowid, {column_list})
+            VALUES ('delete', OLD.id, {old_values});
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS software_fts_update AFTER UPDATE OF {column_list} ON software
+        BEGIN
+            INSERT INTO software_fts (software_fts, rowid, {column_list})
+            VALUES ('delete', OLD.id, {old_values});
+            INSERT INTO software_fts (rowid, {column_list}) VALUES (NEW.id, {new_values});
+        END;
+    ''')
+    if not existed:
+        # 为已有数据的旧数据库补建索引
+        rebuild_search_index(conn)
+    conn.commit()
+    return True
+
+
+def rebuild_search_index(conn):
+    """根据 software 表全量重建全文索引"""
+    conn.execute("INSERT INTO software_fts (software_fts) VALUES ('rebuild')")
+    conn.commit()
+
+
+def search_software(conn, search_query):
+    """
+    搜索软件，多个关键词 (空格分隔) 之间为 AND 关系。
+    不短于三个字符的关键词走 FTS5 索引并按 BM25 相关度排序；
+    更短的关键词 (如两个汉字) 无法使用 trigram 索引，在索引结果上再用 LIKE 过滤。
+    没有可用索引或全部关键词都很短时，退回原来的 LIKE 全表查询。
+    """
+    terms = search_query.split()
+    use_index = has_search_index(conn)
+    if use_index:
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(software_fts)')]
+        index_terms = [term for term in terms if len(term) >= TRIGRAM_MIN_LENGTH]
+    else:
+        columns = [column for column in (row[1] for row in conn.execute('PRAGMA table_info(software)'))
+                   if column in SEARCH_COLUMNS]
+        index_terms = []
+    like_terms = [term for term in terms if term not in index_terms]
+
+    clauses, params = [], []
+    for term in like_terms:
+        clauses.append('(' + ' OR '.join(f's.{column} LIKE ?' for column in columns) + ')')
+        params += [f'%{term}%'] * len(columns)
+
+    if index_terms:
+        # 每个关键词作为 FTS5 字符串 (双引号转义)，空格分隔即 AND
+        match = ' '.join('"' + term.replace('"', '""') + '"' for term in index_terms)
+        where = ' AND '.join(['software_fts MATCH ?'] + clauses)
+        sql = f'''
+            SELECT s.* FROM software_fts JOIN software s ON s.id = software_fts.rowid
+            WHERE {where}
+            ORDER BY bm25(software_fts)
+        '''
+        params = [match] + params
+    else:
+        sql = f"SELECT s.* FROM software s WHERE {' AND '.join(clauses) or '1'} ORDER BY s.id DESC"
+    return conn.execute(sql, params).fetchall()
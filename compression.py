@@ -0,0 +1,141 @@
+"""
+响应压缩：按 Accept-Encoding 协商 gzip / brotli。
+
+可缓存的响应 (目录 JSON、后台列表页) 的压缩结果按目录版本号缓存，
+同一版本内只压缩一次；其余较大的文本响应在 after_request 中按请求压缩。
+brotli 为可选依赖 (pip install brotli)，未安装时只提供 gzip。
+"""
+import gzip
+import threading
+from collections import OrderedDict
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 小于该字节数的响应不值得压缩
+MIN_COMPRESS_SIZE = 1024
+COMPRESSIBLE_MIMETYPES = ('text/html', 'text/css', 'text/plain', 'application/json',
+                          'application/javascript', 'application/x-ndjson')
+
+
+def supported_encodings():
+    """服务端支持的编码，按优先级排列"""
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate_encoding():
+    """根据请求的 Accept-Encoding 选择编码，返回 'br'、'gzip' 或 '' (不压缩)"""
+    best, best_quality = '', 0
+    for encoding in supported_encodings():
+        quality = request.accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(body, encoding):
+    """按指定编码压缩字节串"""
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6)
+    return body
+
+
+class CompressedBody:
+    """一个响应体及其各编码的压缩结果，每种编码只在第一次需要时压缩一次"""
+
+    __slots__ = ('body', '_variants', '_lock')
+
+    def __init__(self, body, eager_encodings=()):
+        self.body = body
+        self._variants = {'': body}
+        self._lock = threading.Lock()
+        for encoding in eager_encodings:
+            self.variant(encoding)
+
+    def variant(self, encoding):
+        data = self._variants.get(encoding)
+        if data is None:
+            with self._lock:
+                data = self._variants.get(encoding)
+                if data is None:
+                    data = self._variants[encoding] = compress(self.body, encoding)
+        return data
+
+
+class PrecompressedCache:
+    """
+    按 key 缓存 CompressedBody，并记录生成它时的 version (目录版本号)。
+    version 变大后下次读取时重建；重建有锁保护，并发请求只会构建一次。
+    """
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # 命中 / 未命中次数，供 metrics.py 采集 (不加锁递增，是近似值)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version, build):
+        """返回 key 对应且不早于 version 的 CompressedBody；build() 返回未压缩的 bytes"""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] >= version:
+            self.hits += 1
+            return entry[1]
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] >= version:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            body = CompressedBody(build())
+            self._entries[key] = (version, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return body
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def apply_encoding(response, data, encoding):
+    """把 (已压缩的) 数据写入响应，并设置 Content-Encoding 和 Vary"""
+    response.set_data(data)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def init_compression(app):
+    """注册 after_request 钩子：对尚未压缩、足够大的文本响应按请求压缩"""
+
+    @app.after_request
+    def compress_response(response):
+        if (response.direct_passthrough or response.is_streamed
+                or 'Content-Encoding' in response.headers
+                or response.status_code != 200
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+            return response
+        body = response.get_data()
+        response.vary.add('Accept-Encoding')
+        if len(body) < MIN_COMPRESS_SIZE:
+            return response
+        encoding = negotiate_encoding()
+        if encoding:
+            apply_encoding(response, compress(body, encoding), encoding)
+            etag, _ = response.get_etag()
+            if etag:
+                # 压缩后的字节与原 ETag 不再逐字节一致，按惯例降为弱 ETag (条件请求用弱比较，仍可 304)
+                response.set_etag(etag, weak=True)
+        return response
+
+    return app
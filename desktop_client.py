@@ -7,16 +7,40 @@ import ttkbootstrap as tkb
 from tkinter import messagebox
 from threading import Thread
 import io 
+import time
+import random
+import hashlib
+import shutil
 from PIL import Image, ImageTk 
 
+try:
+    import bsdiff4
+except ImportError:
+    bsdiff4 = None
+
 # --- 配置 ---
 API_URL = 'http://localhost:5000/api/software' 
+CHANGES_URL = f'{API_URL}/changes' 
+# 全部 Logo 拼成的雪碧图坐标表，一次请求即可取得列表中的所有图标
+SPRITE_URL = f'{API_URL}/logo-sprite' 
+# 列表界面和安装流程需要的字段，首次加载时分页获取
+CATALOG_FIELDS = 'name,version,description,category,logo_url,install_type,download_url,silent_args,sha256,size_bytes,previous_sha256,delta_url,delta_size_bytes'
+FIRST_PAGE_SIZE = 50
+PAGE_SIZE = 200
 BASE_URL = 'http://localhost:5000' 
+# 列表中的 Logo 边长，请求服务端同尺寸的缩略图
+LOGO_SIZE = 40
 
 # 临时下载目录
 TEMP_DIR = os.path.join(os.environ.get('TEMP', 'C:\\Temp'), 'AppStoreDownloads')
 if not os.path.exists(TEMP_DIR):
     os.makedirs(TEMP_DIR)
+# 按 sha256 缓存安装过的安装包，升级时只需下载差分补丁
+INSTALLER_CACHE_DIR = os.path.join(TEMP_DIR, 'cache')
+INSTALLER_CACHE_LIMIT = 2 * 1024 * 1024 * 1024
+# 服务端下载繁忙 (429 / 503) 时按 Retry-After 等待后重试的次数和单次最长等待秒数
+DOWNLOAD_MAX_RETRIES = 5
+DOWNLOAD_MAX_RETRY_WAIT = 120
 
 # --- 权限和系统操作 ---
 def is_admin():
@@ -35,19 +59,126 @@ def elevate_privileges():
         sys.exit(0)
     return True
 
-def download_file(url, local_path):
-    """下载文件到本地路径"""
+def download_file(url, local_path, soft=None, attempt=0):
+    """
+    下载文件到本地路径；上次下载中断时，用 Range 从 .part 文件末尾继续下载。
+    传入 soft 且本地缓存了它的上一版本时，先尝试只下载差分补丁 (见 download_delta)。
+    服务端下载繁忙时按 Retry-After (加随机抖动) 等待后重试，最多 DOWNLOAD_MAX_RETRIES 次。
+    """
+    if soft is not None and download_delta(soft, local_path):
+        return True
+    part_path = local_path + '.part'
+    etag_path = part_path + '.etag'
+    headers = {}
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset and os.path.exists(etag_path):
+        with open(etag_path, encoding='utf-8') as f:
+            # If-Range：服务端文件已被替换时返回完整的 200 响应，避免拼接出损坏的安装包
+            headers = {'Range': f'bytes={offset}-', 'If-Range': f.read().strip()}
     try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-        with open(local_path, 'wb') as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                file.write(chunk)
+        with requests.get(url, stream=True, headers=headers, timeout=30) as response:
+            if response.status_code == 416:
+                # 续传位置无效 (文件已变短等)，丢弃本地部分文件后重新下载
+                os.remove(part_path)
+                return download_file(url, local_path)
+            if response.status_code in (429, 503) and attempt < DOWNLOAD_MAX_RETRIES:
+                retry_after = response.headers.get('Retry-After', '')
+                wait = int(retry_after) if retry_after.isdigit() else 30
+                time.sleep(min(wait, DOWNLOAD_MAX_RETRY_WAIT) * random.uniform(1.0, 1.2))
+                return download_file(url, local_path, attempt=attempt + 1)
+            response.raise_for_status()
+
+            etag = response.headers.get('ETag')
+            if etag and not etag.startswith('W/'):
+                with open(etag_path, 'w', encoding='utf-8') as f:
+                    f.write(etag)
+            elif os.path.exists(etag_path):
+                os.remove(etag_path)
+
+            # 206 表示服务端接受了续传，追加写入；200 表示从头下载
+            with open(part_path, 'ab' if response.status_code == 206 else 'wb') as file:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    file.write(chunk)
+
+        os.replace(part_path, local_path)
+        if os.path.exists(etag_path):
+            os.remove(etag_path)
         return True
     except requests.exceptions.RequestException as e:
         print(f"下载失败: {e}")
         return False
 
+def file_sha256(path):
+    """计算本地文件的 SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def is_verified_installer(path, soft):
+    """本地文件与目录中的 sha256 / size_bytes 一致时返回 True (目录中没有校验和时返回 False)"""
+    if not soft.get('sha256') or not os.path.exists(path):
+        return False
+    if soft.get('size_bytes') is not None and os.path.getsize(path) != soft['size_bytes']:
+        return False
+    return file_sha256(path) == soft['sha256']
+
+def download_delta(soft, local_path):
+    """下载 previous_sha256 -> sha256 的补丁，应用到缓存的旧版本上并校验摘要；成功返回 True"""
+    if bsdiff4 is None or not soft.get('delta_url') or not soft.get('sha256') or not soft.get('previous_sha256'):
+        return False
+    base_path = os.path.join(INSTALLER_CACHE_DIR, soft['previous_sha256'])
+    if not os.path.exists(base_path):
+        return False
+
+    delta_url = soft['delta_url'] if soft['delta_url'].startswith('http') else f"{BASE_URL}{soft['delta_url']}"
+    patch_path = os.path.join(INSTALLER_CACHE_DIR, f"{soft['previous_sha256']}_{soft['sha256']}.bsdiff")
+    patched_path = local_path + '.patched'
+    try:
+        if not download_file(delta_url, patch_path):
+            return False
+        bsdiff4.file_patch(base_path, patched_path, patch_path)
+        if file_sha256(patched_path) != soft['sha256']:
+            print(f"补丁应用后校验失败，改为下载完整安装包: {soft['name']}")
+            return False
+        os.replace(patched_path, local_path)
+        # 旧版本刚被使用过，清理缓存时最后考虑
+        os.utime(base_path)
+        return True
+    except Exception as e:
+        print(f"应用补丁失败，改为下载完整安装包: {e}")
+        return False
+    finally:
+        for path in (patch_path, patched_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+def cache_installer(path, soft, move=False):
+    """把校验通过的安装包按 sha256 放入缓存，超过 INSTALLER_CACHE_LIMIT 时删除最久未用的"""
+    if not soft.get('sha256'):
+        if move:
+            os.remove(path)
+        return
+    os.makedirs(INSTALLER_CACHE_DIR, exist_ok=True)
+    target = os.path.join(INSTALLER_CACHE_DIR, soft['sha256'])
+    if move:
+        os.replace(path, target)
+    elif not os.path.exists(target):
+        shutil.copyfile(path, target)
+
+    entries = []
+    for name in os.listdir(INSTALLER_CACHE_DIR):
+        stat = os.stat(os.path.join(INSTALLER_CACHE_DIR, name))
+        entries.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= INSTALLER_CACHE_LIMIT:
+            break
+        if name != soft['sha256']:
+            os.remove(os.path.join(INSTALLER_CACHE_DIR, name))
+            total -= size
+
 def execute_silent_install(installer_path, silent_args):
     """执行静默安装命令"""
     command = [installer_path] + silent_args.split()
@@ -102,8 +233,12 @@ class AppStoreClient(tkb.Window):
             return
             
         self.all_software_data = {} 
+        self.catalog_revision = None 
         self.install_buttons = {} 
         self.logo_cache = {} 
+        # 从雪碧图中裁剪出的图标 (软件 ID -> PIL 图像) 及其对应的目录版本
+        self.logo_tiles = {} 
+        self.logo_sprite_revision = None 
         
         # 定义固定宽度
         self.COL_LOGO_WIDTH_PX = 60      
@@ -123,10 +258,16 @@ class AppStoreClient(tkb.Window):
     def _initial_data_load(self):
         self.after(0, lambda: self.status_bar.config(text="正在连接服务器并加载数据...", bootstyle="info"))
         try:
-            response = requests.get(API_URL)
-            response.raise_for_status()
-            software_list = response.json()
-            self.all_software_data = {soft['name']: soft for soft in software_list}
+            # 先取回 Logo 雪碧图，渲染列表时不再为每个软件单独请求 Logo
+            self._load_logo_sprite()
+            # 已有版本号时只拉取增量变更，否则下载完整列表
+            if self.catalog_revision is not None:
+                changed = self._sync_changes()
+            else:
+                changed = self._load_full_catalog()
+            if not changed:
+                self.after(0, lambda: self.status_bar.config(text="软件列表已是最新。", bootstyle="success"))
+                return
             self.after(0, lambda: self.search_var.set(""))
             self.after(0, self.load_software_list) 
         except requests.exceptions.RequestException as e:
@@ -136,6 +277,80 @@ class AppStoreClient(tkb.Window):
             ))
             print(f"API Connection Error: {e}")
 
+    def _load_full_catalog(self):
+        """分页下载完整软件列表：首屏数据到达后立即显示，其余页在后台继续加载"""
+        params = {'limit': FIRST_PAGE_SIZE, 'fields': CATALOG_FIELDS}
+        software_data = {}
+        revision = None
+        while True:
+            response = requests.get(API_URL, params=params)
+            response.raise_for_status()
+            for soft in response.json():
+                software_data[soft['id']] = soft
+            if revision is None:
+                # 以第一页的版本号为准，分页期间发生的变更会在下次增量同步时补上
+                header = response.headers.get('X-Catalog-Revision')
+                revision = int(header) if header else None
+
+            next_cursor = response.headers.get('X-Next-Cursor')
+            if not next_cursor:
+                break
+            if 'after' not in params:
+                self.all_software_data = dict(software_data)
+                self.after(0, self.load_software_list)
+            params = {'limit': PAGE_SIZE, 'fields': CATALOG_FIELDS, 'after': next_cursor}
+
+        self.all_software_data = software_data
+        self.catalog_revision = revision
+        return True
+
+    def _load_logo_sprite(self):
+        """下载雪碧图并裁剪出每个软件的图标；失败时保留旧图标，列表会退回逐个加载 Logo"""
+        try:
+            response = requests.get(SPRITE_URL, params={'size': LOGO_SIZE}, timeout=5)
+            response.raise_for_status()
+            sprite = response.json()
+            if sprite['revision'] == self.logo_sprite_revision:
+                return
+            image_response = requests.get(f"{BASE_URL}{sprite['image']}", timeout=10)
+            image_response.raise_for_status()
+            sheet = Image.open(io.BytesIO(image_response.content)).convert('RGBA')
+            size = sprite['size']
+            # 只是裁剪，不需要重新采样
+            self.logo_tiles = {
+                int(soft_id): sheet.crop((x, y, x + size, y + size))
+                for soft_id, (x, y) in sprite['tiles'].items()
+            }
+            self.logo_sprite_revision = sprite['revision']
+        except (requests.exceptions.RequestException, ValueError, OSError) as e:
+            print(f"Failed to load logo sprite: {e}")
+
+    def _sync_changes(self):
+        """按版本号增量同步，只下载变化的软件，返回 False 表示没有变化"""
+        response = requests.get(CHANGES_URL, params={'since': self.catalog_revision})
+        response.raise_for_status()
+        changes = response.json()
+
+        if changes['full']:
+            # 服务器已清理旧的变更记录，返回的是完整列表
+            self.all_software_data = {soft['id']: soft for soft in changes['software']}
+        elif not changes['upserted'] and not changes['deleted']:
+            return False
+        else:
+            for soft_id in changes['deleted']:
+                self.all_software_data.pop(soft_id, None)
+            added = {}
+            for soft in changes['upserted']:
+                if soft['id'] in self.all_software_data:
+                    self.all_software_data[soft['id']] = soft
+                else:
+                    added[soft['id']] = soft
+            # 新增的软件显示在列表最前面
+            self.all_software_data = {**added, **self.all_software_data}
+
+        self.catalog_revision = changes['revision']
+        return True
+
     def center_window(self):
         self.update_idletasks()
         width = self.winfo_width()
@@ -228,13 +443,13 @@ class AppStoreClient(tkb.Window):
             
         filtered_software = {}
         if search_term:
-            for name, soft in self.all_software_data.items():
-                if (search_term in name.lower() or
+            for soft_id, soft in self.all_software_data.items():
+                if (search_term in soft['name'].lower() or
                     search_term in soft['version'].lower() or
-                    search_term in soft['description'].lower() or
-                    search_term in soft['category'].lower()):
+                    search_term in (soft.get('description') or '').lower() or
+                    search_term in (soft.get('category') or '').lower()):
                     
-                    filtered_software[name] = soft
+                    filtered_software[soft_id] = soft
         else:
             filtered_software = self.all_software_data
 
@@ -250,7 +465,10 @@ class AppStoreClient(tkb.Window):
     def _get_logo_url(self, software):
         logo_url_path = software.get('logo_url')
         if logo_url_path and logo_url_path.startswith('/logos/'):
-            return f"{BASE_URL}{logo_url_path}"
+            # 直接请求服务端预生成的 40px 缩略图
+            return f"{BASE_URL}{logo_url_path}?size={LOGO_SIZE}"
+        if logo_url_path and logo_url_path.startswith(f"{BASE_URL}/logos/"):
+            return f"{logo_url_path}?size={LOGO_SIZE}"
         if logo_url_path and logo_url_path.startswith('http'):
              return logo_url_path
         return None 
@@ -266,8 +484,10 @@ class AppStoreClient(tkb.Window):
             if pil_image.mode != 'RGBA':
                 pil_image = pil_image.convert("RGBA")
 
-            size = (40, 40)
-            pil_image = pil_image.resize(size, Image.Resampling.LANCZOS)
+            size = (LOGO_SIZE, LOGO_SIZE)
+            if pil_image.size != size:
+                # 服务端缩略图已是目标尺寸；只有外部链接或旧服务端返回原图时才在本地缩放
+                pil_image = pil_image.resize(size, Image.Resampling.LANCZOS)
             
             photo_image = ImageTk.PhotoImage(pil_image)
             
@@ -324,7 +544,11 @@ class AppStoreClient(tkb.Window):
             current_col += 1
             
             logo_url = self._get_logo_url(soft)
-            if logo_url:
+            logo_tile = self.logo_tiles.get(soft.get('id'))
+            if logo_tile is not None:
+                # 雪碧图中已有该图标，直接显示
+                self._update_logo_label(soft['name'], ImageTk.PhotoImage(logo_tile), logo_label)
+            elif logo_url:
                 logo_label.config(text="加载中...")
                 Thread(target=self._load_logo_async, args=(logo_url, soft['name'], logo_label)).start()
             else:
@@ -387,10 +611,23 @@ class AppStoreClient(tkb.Window):
         local_installer_path = os.path.join(TEMP_DIR, file_name)
         install_type = soft.get('install_type', 'silent').lower()
 
-        self.after(0, lambda: self.status_bar.config(text=f"下载 {soft['name']}..."))
-        if not download_file(soft['download_url'], local_installer_path):
-            self.after(0, lambda: self.installation_finished(soft, False, f"下载失败: {soft['download_url']}", button_widget))
-            return
+        if is_verified_installer(local_installer_path, soft):
+            # 本地已有校验通过的安装包，跳过下载
+            self.after(0, lambda: self.status_bar.config(text=f"使用已下载的 {soft['name']} 安装包..."))
+        else:
+            size_text = f" ({soft['size_bytes'] / (1024 * 1024):.1f} MB)" if soft.get('size_bytes') else ""
+            if bsdiff4 is not None and soft.get('delta_size_bytes') and soft.get('previous_sha256') \
+                    and os.path.exists(os.path.join(INSTALLER_CACHE_DIR, soft['previous_sha256'])):
+                size_text = f" (增量更新 {soft['delta_size_bytes'] / (1024 * 1024):.1f} MB)"
+            self.after(0, lambda: self.status_bar.config(text=f"下载 {soft['name']}{size_text}..."))
+            if not download_file(soft['download_url'], local_installer_path, soft):
+                self.after(0, lambda: self.installation_finished(soft, False, f"下载失败: {soft['download_url']}", button_widget))
+                return
+            if soft.get('sha256') and not is_verified_installer(local_installer_path, soft):
+                # 校验失败的文件不能执行，删除后让用户重试
+                os.remove(local_installer_path)
+                self.after(0, lambda: self.installation_finished(soft, False, f"安装包校验失败 (SHA-256 不匹配): {soft['download_url']}", button_widget))
+                return
         
         if install_type == 'silent':
             self.after(0, lambda: self.status_bar.config(text=f"执行静默安装..."))
@@ -398,7 +635,8 @@ class AppStoreClient(tkb.Window):
             
             if success and os.path.exists(local_installer_path):
                  try:
-                     os.remove(local_installer_path)
+                     # 移入缓存 (没有校验和时删除)，下次升级可以只下载补丁
+                     cache_installer(local_installer_path, soft, move=True)
                  except Exception as e:
                      print(f"无法删除安装包: {e}")
             
@@ -407,6 +645,10 @@ class AppStoreClient(tkb.Window):
         elif install_type == 'manual':
             self.after(0, lambda: self.status_bar.config(text=f"下载完成，正在打开安装目录..."))
             
+            try:
+                cache_installer(local_installer_path, soft)
+            except OSError as e:
+                print(f"无法缓存安装包: {e}")
             if open_download_folder(local_installer_path):
                  message = f"'{soft['name']}' 下载完成。请在打开的文件夹中双击文件手动安装。"
                  self.after(0, lambda: self.installation_finished(soft, True, message, button_widget, is_manual=True))
@@ -0,0 +1,344 @@
+"""
+asyncio 下载服务：在一个进程内用协程处理成千上万个并发下载连接。
+
+大批量部署时几百个客户端同时通过慢速广域网下载同一个安装包，
+线程池 WSGI 服务器的每个线程都会被一个慢连接占住；这里每个连接只是一个协程，
+文件用 loop.sendfile() 发送 (支持时为 os.sendfile 零拷贝)。
+
+    python download_server.py --port 5001
+
+只提供两类只读地址，与 app.py 的同名路由行为一致：
+  /download/<路径>  packages 目录中的安装包，不存在时返回占位文件
+  /logos/<路径>     logos 目录中的图片，?size= 返回缩略图
+支持 GET / HEAD、Range (单个区间)、If-Range、If-None-Match、HTTP/1.1 长连接。
+客户端停止读取超过 SEND_STALL_TIMEOUT 秒时连接被中止，不会一直占用协程和文件描述符。
+ETag 与 Werkzeug 的 send_file 生成方式相同，客户端在两个服务之间切换时仍可断点续传。
+安装包的 SHA-256 从 app.py 使用的同一个 SQLite 目录中查询，放在 X-Checksum-SHA256 响应头中。
+前端 nginx 可以只把 /download/ 和 /logos/ 转发到这个端口，其余地址仍由 app.py 处理。
+"""
+import os
+import time
+import zlib
+import sqlite3
+import asyncio
+import mimetypes
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import urlsplit, unquote, parse_qs, quote
+import click
+from werkzeug.security import safe_join
+from catalog_db import get_connection_pool
+from logo_store import resolve_thumbnail, THUMBNAIL_MAX_AGE
+from package_store import PACKAGE_MIMETYPE
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+# 请求头的最大长度，超出时返回 431
+MAX_HEADER_BYTES = 16 * 1024
+# 两个请求之间的长连接空闲时间 (秒)
+KEEPALIVE_TIMEOUT = 15
+# 读取请求头的超时时间 (秒)，防止慢速攻击占住连接
+HEADER_TIMEOUT = 10
+# 响应体按块发送，一块 (或响应头) 在这么多秒内仍未发出时认为客户端已停止读取，直接断开连接
+SEND_STALL_TIMEOUT = 60
+SENDFILE_CHUNK = 256 * 1024
+
+STATUS_TEXT = {
+    200: 'OK', 206: 'Partial Content', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found',
+    405: 'Method Not Allowed', 416: 'Range Not Satisfiable', 431: 'Request Header Fields Too Large',
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+class ClientStalled(ConnectionError):
+    """客户端在 SEND_STALL_TIMEOUT 秒内没有读取任何数据"""
+
+
+async def stall_guard(awaitable):
+    """等待一次发送完成，超过 SEND_STALL_TIMEOUT 秒时抛出 ClientStalled"""
+    try:
+        return await asyncio.wait_for(awaitable, SEND_STALL_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise ClientStalled() from None
+
+
+def file_etag(path, stat):
+    """与 Werkzeug send_file(etag=True) 相同的 ETag"""
+    check = zlib.adler32(path.encode()) & 0xFFFFFFFF
+    return f"{stat.st_mtime}-{stat.st_size}-{check}"
+
+
+def parse_range(header, size):
+    """
+    解析单个字节区间，返回 (start, end) (含 end)。
+    没有 Range 头或是多区间请求时返回 None (按完整内容返回 200)；区间无法满足时抛出 416。
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    start, _, end = header[6:].strip().partition('-')
+    try:
+        if start:
+            start = int(start)
+            end = int(end) if end else size - 1
+        else:
+            # bytes=-N：最后 N 个字节
+            start, end = max(size - int(end), 0), size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise HTTPError(416)
+    return start, min(end, size - 1)
+
+
+class ChecksumLookup:
+    """按安装包路径查询目录中的 sha256，只接受大小与目录记录一致的结果；结果按文件修改时间缓存"""
+
+    max_entries = 4096
+
+    def __init__(self, database):
+        self.database = database
+        self._cache = {}
+
+    def lookup(self, relpath, stat):
+        key = (relpath, stat.st_mtime_ns, stat.st_size)
+        if key in self._cache:
+            return self._cache[key]
+        suffix = f"/download/{relpath}"
+        pool = get_connection_pool(self.database)
+        conn = pool.acquire()
+        try:
+            row = conn.execute(
+                'SELECT sha256 FROM software WHERE substr(download_url, -?) = ? AND size_bytes = ? AND sha256 IS NOT NULL LIMIT 1',
+                (len(suffix), suffix, stat.st_size)
+            ).fetchone()
+        except sqlite3.OperationalError:
+            # 目录尚未由 app.py 初始化 (没有 sha256 列)，此时不带校验和，也不缓存结果
+            return None
+        finally:
+            pool.release(conn)
+        if len(self._cache) >= self.max_entries:
+            self._cache.clear()
+        sha256 = row[0] if row else None
+        self._cache[key] = sha256
+        return sha256
+
+
+class DownloadServer:
+    def __init__(self, package_folder, upload_folder, database):
+        self.package_folder = package_folder
+        self.upload_folder = upload_folder
+        self.checksums = ChecksumLookup(database)
+        self.active = 0
+
+    async def handle_client(self, reader, writer):
+        self.active += 1
+        try:
+            keep_alive = True
+            timeout = HEADER_TIMEOUT
+            while keep_alive:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self.send_error(writer, 431, False)
+                    break
+                keep_alive = await self.handle_request(head, writer)
+                timeout = KEEPALIVE_TIMEOUT
+        except ClientStalled:
+            # 缓冲区中还有发不出去的数据，close() 会一直等待，直接中止连接释放文件描述符
+            writer.transport.abort()
+        except ConnectionError:
+            pass
+        finally:
+            self.active -= 1
+            writer.close()
+
+    async def handle_request(self, head, writer):
+        """处理一个请求，返回是否保持连接"""
+        try:
+            method, target, version, headers = parse_request(head)
+        except HTTPError as e:
+            await self.send_error(writer, e.status, False)
+            return False
+        keep_alive = (version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close') or \
+            headers.get('connection', '').lower() == 'keep-alive'
+
+        try:
+            if method not in ('GET', 'HEAD'):
+                # 请求体没有被读取，不能继续复用这个连接
+                keep_alive = False
+                raise HTTPError(405)
+            url = urlsplit(target)
+            path = unquote(url.path)
+            if path.startswith('/download/'):
+                await self.send_package(writer, method, path[len('/download/'):], headers, keep_alive)
+            elif path.startswith('/logos/'):
+                await self.send_logo(writer, method, path[len('/logos/'):], parse_qs(url.query), headers, keep_alive)
+            else:
+                raise HTTPError(404)
+        except HTTPError as e:
+            await self.send_error(writer, e.status, keep_alive, head_only=method == 'HEAD')
+        return keep_alive
+
+    async def send_package(self, writer, method, relpath, headers, keep_alive):
+        path = safe_join(self.package_folder, relpath)
+        extra = {}
+        if path is None or not os.path.isfile(path):
+            # 与 app.py 一致：安装包不存在时返回占位文件
+            path = os.path.join(APP_ROOT, 'placeholder.txt')
+            stat = os.stat(path)
+        else:
+            stat = os.stat(path)
+            sha256 = await asyncio.get_running_loop().run_in_executor(None, self.checksums.lookup, relpath, stat)
+            if sha256:
+                extra['X-Checksum-SHA256'] = sha256
+        extra['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(os.path.basename(relpath))}"
+        extra['Cache-Control'] = 'no-cache'
+        await self.send_file(writer, method, path, stat, PACKAGE_MIMETYPE, headers, keep_alive, extra)
+
+    async def send_logo(self, writer, method, relpath, query, headers, keep_alive):
+        extra = {}
+        try:
+            size = int(query.get('size', ['0'])[0])
+        except ValueError:
+            size = 0
+        if size > 0:
+            accepts_webp = 'image/webp' in headers.get('accept', '')
+            # 缺少缩略图时需要用 Pillow 生成，放到线程池中执行，不阻塞事件循环
+            name = await asyncio.get_running_loop().run_in_executor(
+                None, resolve_thumbnail, self.upload_folder, relpath, size, 'webp' if accepts_webp else 'png')
+            extra['Vary'] = 'Accept'
+            if name:
+                relpath = name
+                extra['Cache-Control'] = f'public, max-age={THUMBNAIL_MAX_AGE}'
+        path = safe_join(self.upload_folder, relpath)
+        if path is None or not os.path.isfile(path):
+            raise HTTPError(404)
+        extra.setdefault('Cache-Control', 'no-cache')
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        await self.send_file(writer, method, path, os.stat(path), mimetype, headers, keep_alive, extra)
+
+    async def send_file(self, writer, method, path, stat, mimetype, headers, keep_alive, extra):
+        etag = file_etag(os.path.abspath(path), stat)
+        last_modified = formatdate(stat.st_mtime, usegmt=True)
+        base = {'ETag': f'"{etag}"', 'Last-Modified': last_modified, 'Accept-Ranges': 'bytes', **extra}
+
+        if etag_matches(headers.get('if-none-match'), etag):
+            await self.write_head(writer, 304, base, keep_alive)
+            return
+
+        size = stat.st_size
+        byte_range = None
+        if if_range_matches(headers.get('if-range'), etag, stat.st_mtime):
+            try:
+                byte_range = parse_range(headers.get('range'), size)
+            except HTTPError:
+                await self.write_head(writer, 416, {**base, 'Content-Range': f'bytes */{size}', 'Content-Length': '0'},
+                                      keep_alive)
+                return
+        if byte_range is not None:
+            start, end = byte_range
+            status = 206
+            base['Content-Range'] = f'bytes {start}-{end}/{size}'
+        else:
+            start, end, status = 0, size - 1, 200
+        count = end - start + 1 if size else 0
+        base['Content-Type'] = mimetype
+        base['Content-Length'] = str(count)
+        await self.write_head(writer, status, base, keep_alive)
+        if method == 'HEAD' or count == 0:
+            return
+
+        # 分块发送，每一块都有停滞超时：不再读取的客户端不会永远占住协程和文件描述符
+        loop = asyncio.get_running_loop()
+        with open(path, 'rb') as f:
+            offset, remaining = start, count
+            while remaining:
+                chunk = min(remaining, SENDFILE_CHUNK)
+                await stall_guard(loop.sendfile(writer.transport, f, offset, chunk))
+                offset += chunk
+                remaining -= chunk
+
+    async def write_head(self, writer, status, headers, keep_alive):
+        lines = [f'HTTP/1.1 {status} {STATUS_TEXT[status]}', f'Date: {formatdate(time.time(), usegmt=True)}',
+                 f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        lines += [f'{name}: {value}' for name, value in headers.items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1', 'replace'))
+        await stall_guard(writer.drain())
+
+    async def send_error(self, writer, status, keep_alive, head_only=False):
+        body = f'{status} {STATUS_TEXT[status]}\n'.encode()
+        headers = {'Content-Type': 'text/plain; charset=utf-8', 'Content-Length': str(len(body))}
+        await self.write_head(writer, status, headers, keep_alive)
+        if not head_only:
+            writer.write(body)
+            await stall_guard(writer.drain())
+
+
+def parse_request(head):
+    """解析请求行和请求头，返回 (方法, 目标, HTTP 版本, {小写头名: 值})"""
+    try:
+        lines = head.decode('latin-1').split('\r\n')
+        method, target, version = lines[0].split(' ')
+    except ValueError:
+        raise HTTPError(400)
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+    return method, target, version, headers
+
+
+def etag_matches(header, etag):
+    """If-None-Match 是否命中 (弱比较)"""
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    return any(tag.strip().removeprefix('W/').strip('"') == etag for tag in header.split(','))
+
+
+def if_range_matches(header, etag, mtime):
+    """没有 If-Range 或其与当前文件一致时返回 True，此时才按 Range 返回部分内容"""
+    if not header:
+        return True
+    if header.startswith('"') or header.startswith('W/'):
+        # If-Range 只能使用强 ETag
+        return header.strip('"') == etag
+    try:
+        return int(parsedate_to_datetime(header).timestamp()) >= int(mtime)
+    except (TypeError, ValueError):
+        return False
+
+
+async def serve(host, port, package_folder, upload_folder, database, backlog):
+    server = DownloadServer(package_folder, upload_folder, database)
+    listener = await asyncio.start_server(server.handle_client, host, port, backlog=backlog, limit=MAX_HEADER_BYTES)
+    print(f"[download_server] 监听 http://{host}:{listener.sockets[0].getsockname()[1]}  "
+          f"packages={package_folder}  logos={upload_folder}")
+    async with listener:
+        await listener.serve_forever()
+
+
+@click.command()
+@click.option('--host', default='127.0.0.1', show_default=True, envvar='APPSTORE_DOWNLOAD_HOST')
+@click.option('--port', default=5001, show_default=True, envvar='APPSTORE_DOWNLOAD_PORT')
+@click.option('--packages', 'package_folder', default=os.path.join(APP_ROOT, 'packages'), show_default=True)
+@click.option('--logos', 'upload_folder', default=os.path.join(APP_ROOT, 'logos'), show_default=True)
+@click.option('--database', default='appstore.db', show_default=True, help='与 app.py 相同的 SQLite 目录')
+@click.option('--backlog', default=4096, show_default=True)
+def main(host, port, package_folder, upload_folder, database, backlog):
+    """以 asyncio 方式提供 /download/ 和 /logos/ (只读，支持断点续传)"""
+    try:
+        asyncio.run(serve(host, port, package_folder, upload_folder, database, backlog))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+文件发送卸载：由前端 Web 服务器代替 Flask 进程发送安装包和 Logo 的字节。
+
+app.config['FILE_OFFLOAD'] (或环境变量 APPSTORE_FILE_OFFLOAD) 取值：
+  ''                 在进程内流式发送 (默认，也是回退模式)
+  'x-accel-redirect' 返回 X-Accel-Redirect 头，指向 nginx 的 internal location
+  'x-sendfile'       返回 X-Sendfile 头，指向文件的绝对路径 (Apache mod_xsendfile / lighttpd)
+卸载模式下 Python 只负责查找和校验文件，Range、ETag 等由前端服务器处理。
+"""
+import os
+import mimetypes
+from urllib.parse import quote
+from flask import current_app, send_from_directory, abort, Response
+from werkzeug.security import safe_join
+
+OFFLOAD_MODES = ('', 'x-accel-redirect', 'x-sendfile')
+# nginx 中对应各目录的 internal location 前缀
+DEFAULT_X_ACCEL_PREFIXES = {
+    'packages': '/_protected/packages/',
+    'logos': '/_protected/logos/',
+}
+
+
+def init_file_offload(app):
+    """读取环境变量设置默认配置，未知的模式在启动时报错"""
+    mode = os.environ.get('APPSTORE_FILE_OFFLOAD', '').strip().lower()
+    app.config.setdefault('FILE_OFFLOAD', '' if mode in ('', 'off', 'none') else mode)
+    app.config.setdefault('X_ACCEL_PREFIXES', dict(DEFAULT_X_ACCEL_PREFIXES))
+    if app.config['FILE_OFFLOAD'] not in OFFLOAD_MODES:
+        raise ValueError(f"Unknown FILE_OFFLOAD mode: {app.config['FILE_OFFLOAD']!r}")
+    return app
+
+
+def send_stored_file(directory, filename, area, max_age=None, **send_kwargs):
+    """
+    发送 directory 中的 filename。area 为 'packages' / 'logos'，用于选择 X-Accel-Redirect 前缀。
+    未开启卸载时等同于 send_from_directory(conditional=True)。
+    """
+    mode = current_app.config.get('FILE_OFFLOAD', '')
+    if not mode:
+        return send_from_directory(directory, filename, max_age=max_age, **send_kwargs)
+
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    mimetype = send_kwargs.get('mimetype') or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    response = Response(mimetype=mimetype)
+    if mode == 'x-accel-redirect':
+        prefix = current_app.config['X_ACCEL_PREFIXES'][area]
+        response.headers['X-Accel-Redirect'] = quote(prefix + filename.replace(os.sep, '/'))
+    else:
+        response.headers['X-Sendfile'] = os.path.abspath(path)
+
+    if send_kwargs.get('as_attachment'):
+        response.headers.set('Content-Disposition', 'attachment',
+                             filename=send_kwargs.get('download_name') or os.path.basename(filename))
+    # 前端服务器会保留这些响应头
+    if max_age:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    return response
+
+
+def check_file_offload(app, package_name, logo_name):
+    """
+    在测试客户端中分别以两种卸载模式和进程内模式请求一个安装包和一个 Logo，
+    检查响应头是否符合预期。返回 [(检查项, 是否通过, 说明)]。
+    """
+    results = []
+    saved = app.config['FILE_OFFLOAD']
+    client = app.test_client()
+    urls = {'packages': f'/download/{package_name}', 'logos': f'/logos/{logo_name}'}
+    try:
+        for mode in OFFLOAD_MODES:
+            app.config['FILE_OFFLOAD'] = mode
+            for area, url in urls.items():
+                response = client.get(url)
+                if mode == 'x-accel-redirect':
+                    expected = quote(app.config['X_ACCEL_PREFIXES'][area] + url.split('/', 2)[2])
+                    actual = response.headers.get('X-Accel-Redirect')
+                    ok = actual == expected and not response.get_data()
+                elif mode == 'x-sendfile':
+                    actual = response.headers.get('X-Sendfile')
+                    ok = bool(actual) and os.path.isabs(actual) and not response.get_data()
+                else:
+                    actual = response.headers.get('Content-Length')
+                    ok = ('X-Accel-Redirect' not in response.headers and 'X-Sendfile' not in response.headers
+                          and int(actual or 0) > 0)
+                results.append((f"{mode or 'in-process'} {url}", ok and response.status_code == 200,
+                                f"status={response.status_code} header={actual}"))
+                response.close()
+    finally:
+        app.config['FILE_OFFLOAD'] = saved
+    return results
@@ -0,0 +1,38 @@
+"""
+HTTP 条件请求辅助函数 (ETag / 304)。
+
+目录接口以 catalog_meta 中的版本号作为强 ETag，
+客户端携带 If-None-Match 再次请求时，只需一次单行查询即可回答 304。
+不提供 Last-Modified：它只精确到秒，同一秒内的两次修改之后，只带 If-Modified-Since 的客户端会拿到过期的 304。
+"""
+import zlib
+from flask import request, Response
+
+
+def catalog_etag(revision, variant=''):
+    """根据目录版本号生成 ETag 值 (不含引号)，variant 用于区分同一版本的不同表示"""
+    return f"catalog-{revision}-{variant}" if variant else f"catalog-{revision}"
+
+
+def query_variant():
+    """根据查询字符串生成简短的变体标识，使分页/字段选择的不同请求拥有不同的 ETag"""
+    return format(zlib.crc32(request.query_string), '08x')
+
+
+def is_not_modified(etag):
+    """判断当前请求的 If-None-Match 是否表明客户端缓存仍然有效 (忽略 If-Modified-Since)"""
+    return bool(request.if_none_match) and request.if_none_match.contains_weak(etag)
+
+
+def set_cache_validators(response, etag):
+    """为响应设置 ETag，并要求客户端每次重新验证"""
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+def not_modified_response(etag):
+    """构造不带响应体的 304 响应"""
+    response = Response(status=304)
+    response.vary.add('Accept-Encoding')
+    return set_cache_validators(response, etag)
@@ -5,6 +5,7 @@ import json
 import requests
 import time
 from flask import Flask, request, jsonify
+from serve import serve_threaded
 
 # --- 配置 ---
 CLIENT_HOST = '127.0.0.1'
@@ -132,6 +133,5 @@ if __name__ == '__main__':
     print(f"桌面客户端启动，正在监听 {CLIENT_HOST}:{CLIENT_PORT}")
     print(f"临时下载目录: {TEMP_DIR}")
     
-    # 启动 Flask 客户端服务器
-    # 注意：关闭 debug=True 在生产环境是必须的
-    app.run(host=CLIENT_HOST, port=CLIENT_PORT, debug=False)
\ No newline at end of file
+    # 启动客户端服务器：单进程线程池 (安装任务只能在本进程的管理员权限下执行，不需要多进程)
+    serve_threaded(app, CLIENT_HOST, CLIENT_PORT, threads=4)
\ No newline at end of file
@@ -0,0 +1,431 @@
+"""
+Logo 存储：按内容哈希保存上传的图片，并在上传时一次性生成缩略图。
+目录中全部 Logo 的缩略图还可以按目录版本拼成一张雪碧图，客户端一次请求取回所有图标。
+
+原图保存在 logos/<哈希前两位>/<sha256>.<扩展名>，内容相同的上传只保存一份；
+不再被任何 software.logo_url 引用的文件由 collect_orphan_logos 清理。
+缩略图保存在 logos/_thumbs/<原图路径>_<尺寸>.<png|webp> (保留原图扩展名，foo.png 和 foo.jpg 的缩略图互不覆盖)，
+通过 /logos/<路径>?size=40 访问；客户端直接显示，不再自行缩放。
+Pillow 为可选依赖 (pip install pillow)，未安装时 ?size= 请求返回原图。
+"""
+import io
+import os
+import re
+import math
+import time
+import base64
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from flask import request
+from werkzeug.security import safe_join
+from catalog_db import read_catalog_rows
+from file_offload import send_stored_file
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# 生成缩略图时可能出现的错误：文件损坏、不是图片，或像素数超过 Pillow 上限 (解压炸弹)
+THUMBNAIL_ERRORS = (OSError, ValueError, Image.DecompressionBombError) if Image is not None else (OSError, ValueError)
+
+THUMBS_DIR = '_thumbs'
+# 预生成的缩略图边长 (像素)，请求其他尺寸时取不小于它的最近一档
+THUMBNAIL_SIZES = (40, 64, 128)
+THUMBNAIL_FORMATS = {'png': 'PNG', 'webp': 'WEBP'}
+# 缩略图文件名随原图唯一，可以让客户端长期缓存
+THUMBNAIL_MAX_AGE = 7 * 24 * 3600
+# 可以生成缩略图的原图扩展名
+SOURCE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp', '.ico')
+# 单个 Logo 的默认大小上限 (字节)，服务端可通过 app.config['MAX_LOGO_BYTES'] 调整
+MAX_LOGO_BYTES = 16 * 1024 * 1024
+# 上传和 Base64 解码时每次处理的字节数
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# 新上传且尚未被引用的文件在这段时间内不会被清理 (表单可能还没提交)
+LOGO_GC_GRACE_SECONDS = 3600
+# 带版本号的雪碧图地址内容不会再变，可以长期缓存
+SPRITE_MAX_AGE = 365 * 24 * 3600
+# 表单等处直接引用、不会出现在 software 表中的文件
+PROTECTED_LOGOS = ('default.png',)
+
+
+# --- 按内容哈希存储 ---
+
+def normalize_extension(ext):
+    """清理扩展名，只保留小写字母和数字"""
+    ext = re.sub(r'[^a-z0-9]', '', (ext or '').lower())[:8]
+    return 'jpg' if ext == 'jpeg' else ext or 'png'
+
+
+class LogoTooLargeError(ValueError):
+    """上传的 Logo 超过大小上限"""
+
+
+def iter_stream(stream, chunk_size=UPLOAD_CHUNK_SIZE):
+    """按块读取文件对象 (如 request.stream)，不会把整个请求体读入内存"""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def parse_image_data_uri(data_uri):
+    """
+    解析 data:image/...;base64, 前缀，返回 (MIME 类型, Base64 数据起始位置)。
+    只检查开头的一小段，不对整个字符串做正则匹配或复制。
+    """
+    header_end = data_uri.find(',', 0, 256)
+    match = re.fullmatch(r'data:(?P<mime>image/[^;,]+);base64', data_uri[:header_end]) if header_end > 0 else None
+    if not match:
+        raise ValueError("Invalid Base64 image format. Data URI prefix (data:image/...) not found.")
+    return match.group('mime'), header_end + 1
+
+
+def iter_base64_chunks(text, start=0, chunk_size=UPLOAD_CHUNK_SIZE):
+    """从 text[start:] 逐段解码 Base64，每次只复制 chunk_size 个字符，忽略其中的空白和换行"""
+    pending = ''
+    for offset in range(start, len(text), chunk_size):
+        piece = pending + ''.join(text[offset:offset + chunk_size].split())
+        usable = len(piece) - len(piece) % 4
+        pending = piece[usable:]
+        if usable:
+            yield base64.b64decode(piece[:usable], validate=True)
+    if pending:
+        raise ValueError("Base64 decoding failed: incorrect padding")
+
+
+def store_logo_chunks(upload_folder, chunks, ext, max_bytes=MAX_LOGO_BYTES):
+    """
+    把依次产生的字节块写入临时文件并同时计算 SHA-256，完成后按哈希保存，返回 (相对路径, 是否新写入)。
+    内存中始终只有一个块；累计超过 max_bytes 时立即停止并抛出 LogoTooLargeError。
+    内容已存在时不重复保存，只刷新修改时间，避免刚被复用的旧文件在宽限期内被清理。
+    """
+    os.makedirs(upload_folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='.upload-', suffix='.tmp', dir=upload_folder)
+    try:
+        digest, size = hashlib.sha256(), 0
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise LogoTooLargeError(f"Logo exceeds the {max_bytes} byte limit")
+                digest.update(chunk)
+                f.write(chunk)
+        if size == 0:
+            raise ValueError("Empty image data")
+
+        digest = digest.hexdigest()
+        relpath = f"{digest[:2]}/{digest}.{normalize_extension(ext)}"
+        path = os.path.join(upload_folder, relpath)
+        if os.path.exists(path):
+            os.utime(path)
+            return relpath, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 改名是原子操作，并发的相同上传最终只留下一份完整文件
+        os.replace(tmp_path, path)
+        return relpath, True
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def discard_logos(upload_folder, relpaths):
+    """删除刚由 store_logo_chunks 新写入、最终没有被使用的原图及其缩略图 (例如所在事务已回滚)"""
+    for relpath in relpaths:
+        paths = [relpath] + [thumbnail_name(relpath, size, ext) for size in THUMBNAIL_SIZES for ext in THUMBNAIL_FORMATS]
+        for path in paths:
+            try:
+                os.remove(os.path.join(upload_folder, path))
+            except FileNotFoundError:
+                pass
+
+
+def logo_relative_path(logo_url):
+    """从 logo_url (相对或绝对链接) 中取出 logos 目录下的相对路径，非本地 Logo 返回 None"""
+    if not logo_url or '/logos/' not in logo_url:
+        return None
+    return logo_url.split('/logos/', 1)[1].split('?', 1)[0] or None
+
+
+def thumbnails_available():
+    """当前环境能否生成缩略图"""
+    return Image is not None
+
+
+def snap_thumbnail_size(size):
+    """把请求的尺寸对齐到预生成的档位"""
+    for candidate in THUMBNAIL_SIZES:
+        if size <= candidate:
+            return candidate
+    return THUMBNAIL_SIZES[-1]
+
+
+def thumbnail_name(filename, size, ext):
+    """缩略图相对于 logos 目录的路径 (使用 / 分隔，便于 send_from_directory)"""
+    return f"{THUMBS_DIR}/{filename}_{size}.{ext}"
+
+
+def _render_square(image, size):
+    """等比缩放到 size 以内，再居中放到透明的正方形画布上"""
+    thumb = ImageOps.contain(image, (size, size), Image.Resampling.LANCZOS)
+    canvas = Image.new('RGBA', (size, size), (0, 0, 0, 0))
+    canvas.paste(thumb, ((size - thumb.width) // 2, (size - thumb.height) // 2))
+    return canvas
+
+
+def generate_thumbnails(upload_folder, filename):
+    """为 logos 目录中的一个文件生成全部尺寸和格式的缩略图，返回是否成功"""
+    if Image is None or not filename.lower().endswith(SOURCE_EXTENSIONS):
+        return False
+
+    with Image.open(os.path.join(upload_folder, filename)) as source:
+        image = source.convert('RGBA')
+
+    thumbs_dir = os.path.dirname(os.path.join(upload_folder, THUMBS_DIR, filename))
+    os.makedirs(thumbs_dir, exist_ok=True)
+    for size in THUMBNAIL_SIZES:
+        thumb = _render_square(image, size)
+        for ext, image_format in THUMBNAIL_FORMATS.items():
+            path = os.path.join(upload_folder, thumbnail_name(filename, size, ext))
+            # 先写唯一的临时文件再替换：并发请求同一个 Logo 时各写各的，不会读到或发布写了一半的缩略图
+            fd, tmp_path = tempfile.mkstemp(prefix='.thumb-', suffix='.tmp', dir=thumbs_dir)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    if image_format == 'WEBP':
+                        thumb.save(f, image_format, quality=85, method=4)
+                    else:
+                        thumb.save(f, image_format, optimize=True)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+    return True
+
+
+def resolve_thumbnail(upload_folder, filename, size, ext):
+    """
+    返回缩略图的相对路径；旧文件还没有缩略图时当场生成一次。
+    无法生成 (未安装 Pillow、不是图片) 时返回 None，由调用方返回原图。
+    """
+    source = safe_join(upload_folder, filename)
+    if source is None or filename.startswith(THUMBS_DIR + '/'):
+        return None
+    name = thumbnail_name(filename, snap_thumbnail_size(size), ext)
+    if os.path.exists(os.path.join(upload_folder, name)):
+        return name
+    if not os.path.isfile(source):
+        return None
+    try:
+        if generate_thumbnails(upload_folder, filename):
+            return name
+    except THUMBNAIL_ERRORS:
+        pass
+    return None
+
+
+def backfill_thumbnails(upload_folder, force=False):
+    """为 logos 目录中已有的图片补齐缩略图，返回 (生成数, 失败的文件名列表)"""
+    generated, failed = 0, []
+    for filename in sorted(iter_logo_files(upload_folder)):
+        if not filename.lower().endswith(SOURCE_EXTENSIONS):
+            continue
+        last = thumbnail_name(filename, THUMBNAIL_SIZES[-1], 'webp')
+        if not force and os.path.exists(os.path.join(upload_folder, last)):
+            continue
+        try:
+            generate_thumbnails(upload_folder, filename)
+            generated += 1
+        except THUMBNAIL_ERRORS:
+            failed.append(filename)
+    return generated, failed
+
+
+def send_logo(upload_folder, filename):
+    """/logos/<文件名> 的响应：带 ?size= 时返回缩略图 (浏览器明确接受 WebP 时返回 WebP)，否则返回原图"""
+    size = request.args.get('size', type=int)
+    if size and size > 0:
+        accepts_webp = any(value == 'image/webp' for value in request.accept_mimetypes.values())
+        name = resolve_thumbnail(upload_folder, filename, size, 'webp' if accepts_webp else 'png')
+        if name:
+            response = send_stored_file(upload_folder, name, 'logos', max_age=THUMBNAIL_MAX_AGE)
+            response.vary.add('Accept')
+            return response
+    return send_stored_file(upload_folder, filename, 'logos')
+
+
+# --- 孤立文件清理 ---
+
+def iter_logo_files(upload_folder):
+    """遍历 logos 目录中的原图 (不含缩略图和临时文件)，返回使用 / 分隔的相对路径"""
+    for root, dirs, files in os.walk(upload_folder):
+        relroot = os.path.relpath(root, upload_folder)
+        if relroot == '.':
+            dirs[:] = [name for name in dirs if name != THUMBS_DIR]
+        for name in files:
+            if '.tmp' in name:
+                continue
+            yield name if relroot == '.' else f"{relroot.replace(os.sep, '/')}/{name}"
+
+
+def load_logo_references(conn):
+    """software 表中引用的全部本地 Logo 相对路径"""
+    rows = conn.execute('SELECT DISTINCT logo_url FROM software WHERE logo_url IS NOT NULL').fetchall()
+    return {path for path in (logo_relative_path(row[0]) for row in rows) if path}
+
+
+def collect_orphan_logos(upload_folder, referenced, grace_seconds=LOGO_GC_GRACE_SECONDS):
+    """删除未被引用且超过宽限期的原图及其缩略图，返回删除的原图相对路径列表"""
+    cutoff = time.time() - grace_seconds
+    removed, kept_stems = [], set()
+    for relpath in iter_logo_files(upload_folder):
+        path = os.path.join(upload_folder, relpath)
+        if relpath in referenced or relpath in PROTECTED_LOGOS or os.path.getmtime(path) > cutoff:
+            kept_stems.add(relpath)
+            continue
+        try:
+            os.remove(path)
+            removed.append(relpath)
+        except FileNotFoundError:
+            pass
+
+    # 原图已不存在的缩略图一并删除
+    thumbs_root = os.path.join(upload_folder, THUMBS_DIR)
+    for root, _, files in os.walk(thumbs_root):
+        relroot = os.path.relpath(root, thumbs_root)
+        for name in files:
+            if '.tmp' in name:
+                # 正在生成的缩略图
+                continue
+            stem = name.rsplit('_', 1)[0]
+            stem = stem if relroot == '.' else f"{relroot.replace(os.sep, '/')}/{stem}"
+            if stem not in kept_stems:
+                try:
+                    os.remove(os.path.join(root, name))
+                except FileNotFoundError:
+                    pass
+    return removed
+
+
+class OrphanLogoCollector:
+    """在后台线程中清理孤立 Logo；清理进行中再次触发会合并到下一轮"""
+
+    def __init__(self, load_references, grace_seconds=LOGO_GC_GRACE_SECONDS):
+        self.load_references = load_references
+        self.grace_seconds = grace_seconds
+        self._lock = threading.Lock()
+        self._pending = False
+        self._running = False
+
+    def schedule(self, upload_folder):
+        """修改或删除软件后调用，立即返回"""
+        with self._lock:
+            self._pending = True
+            if self._running:
+                return
+            self._running = True
+        threading.Thread(target=self._run, args=(upload_folder,), daemon=True).start()
+
+    def _run(self, upload_folder):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._running = False
+                    return
+                self._pending = False
+            try:
+                collect_orphan_logos(upload_folder, self.load_references(), self.grace_seconds)
+            except Exception as e:
+                print(f"Logo GC failed: {e}")
+
+
+# --- Logo 雪碧图 ---
+
+class LogoSprite:
+    """某个目录版本下全部 Logo 缩略图拼成的一张图，以及每个软件图标的左上角坐标"""
+
+    __slots__ = ('revision', 'updated_at', 'size', 'ext', 'image', 'tiles')
+
+    def __init__(self, revision, updated_at, size, ext, image, tiles):
+        self.revision = revision
+        self.updated_at = updated_at
+        self.size = size
+        self.ext = ext
+        self.image = image
+        self.tiles = tiles
+
+
+def build_logo_sprite(upload_folder, rows, size, ext):
+    """
+    把 rows 中 (软件 ID, logo_url) 对应的缩略图拼成近似正方形的网格，
+    返回 (图片字节, {软件 ID 字符串: [x, y]})。相同的 Logo 只占一格，外部链接的 Logo 不包含在内。
+    """
+    cells, positions, tiles = [], {}, {}
+    for software_id, logo_url in rows:
+        relpath = logo_relative_path(logo_url)
+        if relpath is None:
+            continue
+        if relpath not in positions:
+            name = resolve_thumbnail(upload_folder, relpath, size, 'png')
+            positions[relpath] = len(cells) if name else None
+            if name:
+                cells.append(name)
+        if positions[relpath] is not None:
+            tiles[str(software_id)] = positions[relpath]
+
+    columns = max(1, math.ceil(math.sqrt(len(cells))))
+    sheet = Image.new('RGBA', (columns * size, max(1, math.ceil(len(cells) / columns)) * size), (0, 0, 0, 0))
+    for index, name in enumerate(cells):
+        with Image.open(os.path.join(upload_folder, name)) as thumb:
+            sheet.paste(thumb.convert('RGBA'), ((index % columns) * size, (index // columns) * size))
+
+    buffer = io.BytesIO()
+    if ext == 'webp':
+        sheet.save(buffer, 'WEBP', quality=85, method=4)
+    else:
+        sheet.save(buffer, 'PNG', optimize=True)
+    coordinates = {key: [(index % columns) * size, (index // columns) * size] for key, index in tiles.items()}
+    return buffer.getvalue(), coordinates
+
+
+class LogoSpriteCache:
+    """按 (尺寸, 格式) 缓存最新目录版本的雪碧图；重建有锁保护，并发请求只会构建一次"""
+
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # 命中 / 未命中次数，供 metrics.py 采集 (不加锁递增，是近似值)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, conn, upload_folder, revision, size, ext):
+        """返回不早于 revision 的雪碧图，过期时在同一个读事务中查询软件表并重建"""
+        key = (size, ext)
+        sprite = self._entries.get(key)
+        if sprite is not None and sprite.revision >= revision:
+            self.hits += 1
+            return sprite
+
+        with self._lock:
+            sprite = self._entries.get(key)
+            if sprite is not None and sprite.revision >= revision:
+                self.hits += 1
+                return sprite
+            self.misses += 1
+            revision, updated_at, rows = read_catalog_rows(conn, 'SELECT id, logo_url FROM software ORDER BY id')
+            image, tiles = build_logo_sprite(upload_folder, rows, size, ext)
+            sprite = self._entries[key] = LogoSprite(revision, updated_at, size, ext, image, tiles)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return sprite
+
+
+def sprite_request_args():
+    """解析雪碧图请求的 ?size= 和 ?format= 参数，返回 (对齐后的尺寸, 'png' 或 'webp')"""
+    size = snap_thumbnail_size(request.args.get('size', default=THUMBNAIL_SIZES[0], type=int))
+    ext = request.args.get('format', 'png')
+    return size, ext if ext in THUMBNAIL_FORMATS else 'png'
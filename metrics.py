@@ -0,0 +1,522 @@
+"""
+运行指标 (Prometheus 文本格式，由 /metrics 提供)。
+
+记录每个路由的请求数和延迟直方图、响应字节数、进行中的请求数、
+SQLite 语句耗时 (按语句类型) 以及各进程内缓存的命中 / 未命中次数。
+
+热路径上不加锁：每个线程写自己的一份计数 (threading.local)，只有采集时才汇总，
+线程第一次写某个指标时登记一次；线程结束后它的计数并入“已退役”部分，不会丢失。
+
+serve.py 以多进程运行时，每个 worker 只能看到自己的计数。设置了环境变量 APPSTORE_METRICS_DIR
+(serve.py 会自动创建临时目录) 时，worker 每秒把自己的快照写入该目录中的 <pid>-<启动时间>.json
+(带上启动时间，pid 被复用时新进程不会覆盖旧进程尚未合并的文件)，
+/metrics 汇总所有 worker 的快照；已退出 worker 的计数器保留，进行中请求数等瞬时值丢弃。
+读取快照时持有目录锁的共享锁，合并已退出 worker 时持有排他锁，采集不会把同一个 worker 计算两次。
+"""
+import os
+import json
+import time
+import errno
+import bisect
+import sqlite3
+import threading
+from flask import Response, g, request
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+METRICS_DIR_ENV = 'APPSTORE_METRICS_DIR'
+# 多进程模式下快照写入间隔 (秒)
+FLUSH_INTERVAL = 1.0
+# 已退出 worker 的计数器合并后保存在这个文件中
+RETIRED_SNAPSHOT = '_retired.json'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+HTTP_METHODS = ('GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'OPTIONS', 'PATCH')
+SQL_STATEMENTS = ('select', 'insert', 'update', 'delete', 'replace', 'with', 'pragma', 'create', 'begin')
+
+
+# --- 指标类型 ---
+
+class Metric:
+    """按标签值 (元组) 记录数值；每个线程写自己的字典，采集时汇总"""
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._local = threading.local()
+        self._shards = []
+        self._retired = {}
+
+    def _values(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), values))
+            return values
+
+    @staticmethod
+    def _merge(total, value):
+        return total + value
+
+    def collect(self):
+        """返回 {标签值元组: 数值}；已结束线程的计数并入退役部分"""
+        with self._lock:
+            alive = []
+            for thread, values in self._shards:
+                if thread.is_alive():
+                    alive.append((thread, values))
+                else:
+                    _merge_into(self, self._retired, list(values.items()))
+            self._shards = alive
+            merged = {}
+            _merge_into(self, merged, self._retired.items())
+            for _, values in alive:
+                # list() 在 C 层一次性复制，其他线程此时插入新键也不会打断
+                _merge_into(self, merged, list(values.items()))
+        return merged
+
+
+def _merge_into(metric, target, items):
+    for labels, value in items:
+        if isinstance(value, list):
+            value = list(value)
+        previous = target.get(labels)
+        target[labels] = value if previous is None else metric._merge(previous, value)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        values = self._values()
+        values[labels] = values.get(labels, 0) + amount
+
+
+class Gauge(Counter):
+    """可增可减的数值 (例如进行中的请求数)；同一线程内 inc / dec 成对调用"""
+
+    kind = 'gauge'
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+
+class Histogram(Metric):
+    """每个标签值记录 [各区间计数..., +Inf 区间计数, 总和]，输出时转换为累计计数"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def observe(self, labels, value):
+        values = self._values()
+        cell = values.get(labels)
+        if cell is None:
+            cell = values[labels] = [0] * (len(self.buckets) + 2)
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    @staticmethod
+    def _merge(total, value):
+        return [a + b for a, b in zip(total, value)]
+
+
+# --- 注册表与输出 ---
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+        # 名称 -> 提供 hits / misses 属性的缓存对象
+        self.caches = {}
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def register_cache(self, name, cache):
+        """登记一个进程内缓存，采集时读取它的 hits / misses 计数"""
+        self.caches[name] = cache
+
+    def reset(self):
+        """fork 之后在子进程中调用：清空从父进程继承来的计数"""
+        for metric in self.metrics:
+            metric.reset()
+        for cache in self.caches.values():
+            cache.hits = cache.misses = 0
+
+    def snapshot(self):
+        """本进程的全部计数：{指标名: {标签值元组: 数值}}"""
+        snapshot = {metric.name: metric.collect() for metric in self.metrics}
+        snapshot[CACHE_REQUESTS.name] = {}
+        for name, cache in self.caches.items():
+            snapshot[CACHE_REQUESTS.name][(name, 'hit')] = cache.hits
+            snapshot[CACHE_REQUESTS.name][(name, 'miss')] = cache.misses
+        return snapshot
+
+    def render(self, snapshot, extra_gauges=()):
+        """输出 Prometheus 文本格式；extra_gauges 为采集时计算的 (名称, 说明, 数值)"""
+        lines = []
+        for metric in self.metrics + [CACHE_REQUESTS]:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for labels, value in sorted(snapshot.get(metric.name, {}).items()):
+                pairs = list(zip(metric.labelnames, labels))
+                if metric.kind == 'histogram':
+                    lines += _histogram_lines(metric, pairs, value)
+                else:
+                    lines.append(f'{metric.name}{_format_labels(pairs)} {_format_value(value)}')
+        for name, documentation, value in extra_gauges:
+            lines += [f'# HELP {name} {documentation}', f'# TYPE {name} gauge', f'{name} {_format_value(value)}']
+        return '\n'.join(lines) + '\n'
+
+
+def _histogram_lines(metric, pairs, cell):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(metric.buckets + (float('inf'),), cell):
+        cumulative += count
+        le = '+Inf' if bound == float('inf') else repr(bound)
+        lines.append(f'{metric.name}_bucket{_format_labels(pairs + [("le", le)])} {cumulative}')
+    lines.append(f'{metric.name}_sum{_format_labels(pairs)} {_format_value(cell[-1])}')
+    lines.append(f'{metric.name}_count{_format_labels(pairs)} {cumulative}')
+    return lines
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+registry = MetricsRegistry()
+
+HTTP_REQUESTS = registry.counter('appstore_http_requests_total', '按路由和状态码统计的请求数',
+                                 ('method', 'route', 'status'))
+HTTP_LATENCY = registry.histogram('appstore_http_request_duration_seconds', '生成响应的耗时 (不含流式响应体的发送)',
+                                  ('method', 'route'))
+HTTP_RESPONSE_BYTES = registry.counter('appstore_http_response_bytes_total', '响应体字节数 (压缩后；流式响应长度未知时不计)',
+                                       ('route',))
+HTTP_IN_FLIGHT = registry.gauge('appstore_http_requests_in_flight', '正在处理的请求数')
+DB_QUERY_LATENCY = registry.histogram('appstore_db_query_duration_seconds',
+                                      'SQLite 语句的执行耗时 (SELECT 只计到第一行；commit 单独统计)',
+                                      ('statement',), buckets=DB_BUCKETS)
+# 数值来自 registry.caches，不直接写入
+CACHE_REQUESTS = Counter('appstore_cache_requests_total', '进程内缓存的命中 / 未命中次数', ('cache', 'result'))
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=registry.reset)
+
+
+# --- SQLite 语句计时 ---
+
+def _statement_kind(sql):
+    word = sql.lstrip()[:8].split(None, 1)
+    word = word[0].lower() if word else ''
+    return word if word in SQL_STATEMENTS else 'other'
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """记录 execute / executemany / executescript / commit 耗时的连接类 (作为 sqlite3.connect 的 factory)"""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            DB_QUERY_LATENCY.observe((_statement_kind(sql),), time.perf_counter() - started)
+
+    def executemany(self, sql, parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            DB_QUERY_LATENCY.observe((_statement_kind(sql),), time.perf_counter() - started)
+
+    def executescript(self, script):
+        started = time.perf_counter()
+        try:
+            return super().executescript(script)
+        finally:
+            DB_QUERY_LATENCY.observe(('script',), time.perf_counter() - started)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            DB_QUERY_LATENCY.observe(('commit',), time.perf_counter() - started)
+
+
+# --- 多进程汇总 ---
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _process_start(pid):
+    """进程的启动时间 (/proc/<pid>/stat 第 22 列，单位 clock tick)，读不到时返回 None"""
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # 第 2 列进程名可能包含空格和括号，从最后一个 ')' 之后开始数
+    try:
+        return int(stat.rsplit(b')', 1)[1].split()[19])
+    except (IndexError, ValueError):
+        return None
+
+
+def _snapshot_name(pid):
+    """快照文件名 <pid>-<启动时间>.json；没有 /proc 的平台启动时间记为 0，只按 pid 区分"""
+    return f'{pid}-{_process_start(pid) or 0}.json'
+
+
+def _parse_snapshot_name(name):
+    """从快照文件名解析出 (pid, 启动时间)，不是快照文件时返回 None"""
+    if not name.endswith('.json'):
+        return None
+    pid, sep, start = name[:-5].partition('-')
+    if not sep or not pid.isdigit() or not start.isdigit():
+        return None
+    return int(pid), int(start)
+
+
+def _snapshot_alive(pid, start):
+    """快照所属的进程是否仍在运行：pid 存在且启动时间一致 (pid 已被新进程复用时视为已退出)"""
+    if not _pid_alive(pid):
+        return False
+    if start == 0:
+        return True
+    current = _process_start(pid)
+    return current is None or current == start
+
+
+def _open_lock(directory, operation):
+    """打开目录锁文件并加锁 (LOCK_SH / LOCK_EX，可带 LOCK_NB)，关闭文件即释放；平台不支持 flock 时不加锁"""
+    lock = open(os.path.join(directory, '.lock'), 'a')
+    if fcntl is not None:
+        try:
+            fcntl.flock(lock, operation)
+        except OSError:
+            lock.close()
+            raise
+    return lock
+
+
+def _dump(snapshot):
+    return {name: [[list(labels), value] for labels, value in values.items()] for name, values in snapshot.items()}
+
+
+def _load(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {name: {tuple(labels): value for labels, value in values} for name, values in data.items()}
+
+
+def _write_json(path, snapshot):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(_dump(snapshot), f)
+    os.replace(tmp_path, path)
+
+
+def _merge_snapshots(target, snapshot, counters_only=False):
+    kinds = {metric.name: metric for metric in registry.metrics + [CACHE_REQUESTS]}
+    for name, values in snapshot.items():
+        metric = kinds.get(name)
+        if metric is None or (counters_only and metric.kind == 'gauge'):
+            continue
+        _merge_into(metric, target.setdefault(name, {}), values.items())
+    return target
+
+
+class SnapshotWriter:
+    """worker 进程中的后台线程：每 FLUSH_INTERVAL 秒把本进程快照写入指标目录"""
+
+    def __init__(self):
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self, directory):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, args=(directory,), name='metrics-writer', daemon=True).start()
+
+    def _run(self, directory):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush(directory)
+
+    def flush(self, directory):
+        try:
+            _write_json(os.path.join(directory, _snapshot_name(os.getpid())), registry.snapshot())
+        except OSError:
+            pass
+
+
+snapshot_writer = SnapshotWriter()
+
+
+def flush_metrics():
+    """worker 退出前调用：立即写出本进程的最终快照，避免丢失最后一秒内的计数"""
+    directory = os.environ.get(METRICS_DIR_ENV)
+    if directory and os.path.isdir(directory):
+        snapshot_writer.flush(directory)
+
+
+def collect_all(directory):
+    """汇总指标目录中所有 worker 的快照 (本进程使用实时数据)，顺带把已退出 worker 的文件合并"""
+    merged = _merge_snapshots({}, registry.snapshot())
+    _compact_retired(directory)
+    own = _snapshot_name(os.getpid())
+    # 共享锁：合并 (排他锁) 要么完全在读取之前，要么完全在之后，已退出 worker 不会既在 _retired.json 中又有自己的文件
+    with _open_lock(directory, fcntl.LOCK_SH if fcntl is not None else 0):
+        for name in os.listdir(directory):
+            if name == RETIRED_SNAPSHOT:
+                _merge_snapshots(merged, _load(os.path.join(directory, name)), counters_only=True)
+                continue
+            parsed = _parse_snapshot_name(name)
+            if parsed is None or name == own:
+                continue
+            # 还没来得及合并的已退出 worker 同样只保留计数器
+            _merge_snapshots(merged, _load(os.path.join(directory, name)), counters_only=not _snapshot_alive(*parsed))
+    return merged
+
+
+def _compact_retired(directory):
+    """把已退出 worker 的快照中的计数器并入 _retired.json 并删除原文件 (持有排他锁，期间没有采集在读取目录)"""
+    if fcntl is None:
+        return
+    if not any(parsed is not None and not _snapshot_alive(*parsed)
+               for parsed in map(_parse_snapshot_name, os.listdir(directory))):
+        return
+    try:
+        lock = _open_lock(directory, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        # 其他进程正在合并或读取，下次采集时再合并
+        return
+    with lock:
+        # 拿到锁之后重新列目录：等锁期间其他进程可能已经合并过
+        dead = []
+        for name in os.listdir(directory):
+            parsed = _parse_snapshot_name(name)
+            if parsed is not None and not _snapshot_alive(*parsed):
+                dead.append(name)
+        if not dead:
+            return
+        retired_path = os.path.join(directory, RETIRED_SNAPSHOT)
+        retired = _load(retired_path)
+        for name in dead:
+            _merge_snapshots(retired, _load(os.path.join(directory, name)), counters_only=True)
+        _write_json(retired_path, retired)
+        for name in dead:
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+
+# --- Flask 集成 ---
+
+def _route_label():
+    rule = request.url_rule
+    return rule.rule if rule is not None else '[unmatched]'
+
+
+def init_metrics(app):
+    """
+    注册请求计时钩子。需在 init_compression 之前调用：
+    after_request 按注册的相反顺序执行，这样统计的是压缩后的响应字节数。
+    """
+    from catalog_db import use_connection_factory
+    use_connection_factory(InstrumentedConnection)
+
+    @app.before_request
+    def start_request_timer():
+        g._metrics_started = time.perf_counter()
+        g._metrics_in_flight = True
+        HTTP_IN_FLIGHT.inc()
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('_metrics_started', None)
+        if started is not None:
+            _record(started, response.status_code, response.content_length or 0)
+        return response
+
+    @app.teardown_request
+    def finish_request(exception):
+        # after_request 没有执行 (未处理的异常) 时按 500 记录
+        started = g.pop('_metrics_started', None)
+        if started is not None:
+            _record(started, 500, 0)
+        if g.pop('_metrics_in_flight', False):
+            HTTP_IN_FLIGHT.dec()
+
+    return app
+
+
+def _record(started, status, size):
+    method = request.method if request.method in HTTP_METHODS else 'other'
+    route = _route_label()
+    HTTP_REQUESTS.inc((method, route, str(status)))
+    HTTP_LATENCY.observe((method, route), time.perf_counter() - started)
+    if size:
+        HTTP_RESPONSE_BYTES.inc((route,), size)
+    directory = os.environ.get(METRICS_DIR_ENV)
+    if directory:
+        snapshot_writer.ensure_started(directory)
+
+
+def metrics_response(extra_gauges=()):
+    """/metrics 的响应；extra_gauges 为采集时计算的 (名称, 说明, 数值)，只取本进程的值"""
+    directory = os.environ.get(METRICS_DIR_ENV)
+    if directory and os.path.isdir(directory):
+        snapshot = collect_all(directory)
+    else:
+        snapshot = registry.snapshot()
+    response = Response(registry.render(snapshot, extra_gauges), content_type=CONTENT_TYPE)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
@@ -0,0 +1,179 @@
+"""
+安装包差分补丁：在相邻两个版本 (previous_sha256 -> sha256) 之间预先生成 bsdiff 补丁。
+
+补丁保存在 packages/_deltas/<旧摘要>_<新摘要>.bsdiff，经 /download/_deltas/... 下载 (同样支持断点续传)。
+生成后写入 software 表的 delta_url / delta_size_bytes 列，随目录一起下发；
+客户端本地缓存了旧版本安装包时只下载补丁，应用后按 sha256 校验得到新版本。
+
+bsdiff4 为可选依赖 (pip install bsdiff4)，未安装时不生成补丁，客户端照常下载完整安装包。
+bsdiff 的内存占用约为旧文件的十几倍 (后缀数组 + 新旧文件)，而补丁默认在每个服务进程的后台线程中生成，
+因此服务进程内只处理不超过 DELTA_MAX_BYTES 的安装包；更大的安装包跳过 (不记录)，
+由单独运行的 flask build-deltas 命令按 DELTA_CLI_MAX_BYTES 生成。
+补丁不小于新版本的 DELTA_MAX_RATIO 时也不下发 (记录在 package_deltas 表中，不会重复计算)。
+"""
+import os
+import time
+from catalog_db import ensure_column
+from package_store import VERSIONS_DIR, version_path, package_hashes
+
+try:
+    import bsdiff4
+except ImportError:
+    bsdiff4 = None
+
+DELTAS_DIR = '_deltas'
+# 服务进程内 (后台线程、启动时) 生成补丁的文件大小上限，峰值内存约为它的 17 倍
+DELTA_MAX_BYTES = 16 * 1024 * 1024
+# flask build-deltas 命令 (单独进程) 默认的文件大小上限
+DELTA_CLI_MAX_BYTES = 512 * 1024 * 1024
+DELTA_MAX_RATIO = 0.6
+
+DELTA_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS package_deltas (
+    from_sha256 TEXT NOT NULL,
+    to_sha256 TEXT NOT NULL,
+    size_bytes INTEGER,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (from_sha256, to_sha256)
+);
+DROP TRIGGER IF EXISTS software_delta_reset;
+CREATE TRIGGER software_delta_reset AFTER UPDATE OF sha256 ON software
+WHEN OLD.sha256 IS NOT NEW.sha256 AND NEW.delta_url IS NOT NULL
+BEGIN
+    UPDATE software SET delta_url = NULL, delta_size_bytes = NULL WHERE id = NEW.id;
+END;
+'''
+
+
+def deltas_available():
+    """是否安装了 bsdiff4"""
+    return bsdiff4 is not None
+
+
+def init_delta_schema(conn):
+    """为 software 表补充 delta_url / delta_size_bytes 列 (需在 init_package_schema 之后调用)"""
+    ensure_column(conn, 'software', 'delta_url', 'TEXT')
+    ensure_column(conn, 'software', 'delta_size_bytes', 'INTEGER')
+    conn.executescript(DELTA_SCHEMA)
+    conn.commit()
+
+
+def delta_name(from_sha256, to_sha256):
+    """补丁在 packages 目录中的相对路径"""
+    return f"{DELTAS_DIR}/{from_sha256}_{to_sha256}.bsdiff"
+
+
+def exceeds_delta_limit(package_folder, from_sha256, to_sha256, max_bytes):
+    """新旧版本中是否有文件超过 max_bytes (文件不存在时返回 False)"""
+    for sha256 in (from_sha256, to_sha256):
+        path = version_path(package_folder, sha256)
+        if os.path.isfile(path) and os.path.getsize(path) > max_bytes:
+            return True
+    return False
+
+
+def build_delta(package_folder, from_sha256, to_sha256, max_bytes=DELTA_MAX_BYTES):
+    """
+    生成一个补丁并返回其字节数；旧版本已不在 _versions 中、文件超过 max_bytes 或补丁不划算时返回 None。
+    保留的版本可能被原地覆盖写入，生成前先核对摘要。
+    """
+    old_path = version_path(package_folder, from_sha256)
+    new_path = version_path(package_folder, to_sha256)
+    for path, sha256 in ((old_path, from_sha256), (new_path, to_sha256)):
+        if not os.path.isfile(path) or os.path.getsize(path) > max_bytes:
+            return None
+        if package_hashes.get(path)[0] != sha256:
+            return None
+
+    target = os.path.join(package_folder, delta_name(from_sha256, to_sha256))
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    try:
+        bsdiff4.file_diff(old_path, new_path, tmp_path)
+        size = os.path.getsize(tmp_path)
+        if size >= os.path.getsize(new_path) * DELTA_MAX_RATIO:
+            return None
+        os.replace(tmp_path, target)
+        return size
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def update_package_deltas(conn, package_folder, max_bytes=DELTA_MAX_BYTES):
+    """
+    为 previous_sha256 与 sha256 都已知的软件生成 (或复用) 补丁，写入 delta_url / delta_size_bytes。
+    超过 max_bytes 的安装包跳过且不记录，留给上限更高的 build-deltas 命令。返回本次新生成的补丁数。
+    """
+    if bsdiff4 is None:
+        return 0
+    rows = conn.execute('''
+        SELECT s.id, s.sha256, s.previous_sha256, s.delta_url, d.size_bytes AS built_size, d.created_at
+        FROM software s
+        LEFT JOIN package_deltas d ON d.from_sha256 = s.previous_sha256 AND d.to_sha256 = s.sha256
+        WHERE s.sha256 IS NOT NULL AND s.previous_sha256 IS NOT NULL AND s.previous_sha256 != s.sha256
+    ''').fetchall()
+
+    built = 0
+    for row in rows:
+        size = row['built_size']
+        if row['created_at'] is None:
+            if not os.path.isfile(version_path(package_folder, row['previous_sha256'])):
+                # 旧版本没有保留下来 (例如在引入本功能之前替换)，无法生成补丁
+                continue
+            if exceeds_delta_limit(package_folder, row['previous_sha256'], row['sha256'], max_bytes):
+                continue
+            size = build_delta(package_folder, row['previous_sha256'], row['sha256'], max_bytes)
+            conn.execute('INSERT OR REPLACE INTO package_deltas VALUES (?, ?, ?, ?)',
+                         (row['previous_sha256'], row['sha256'], size, time.time()))
+            built += 1
+
+        delta_url = f"/download/{delta_name(row['previous_sha256'], row['sha256'])}" if size is not None else None
+        if delta_url != row['delta_url']:
+            # 生成期间安装包又被替换的行不写入
+            conn.execute('''
+                UPDATE software SET delta_url = ?, delta_size_bytes = ?
+                WHERE id = ? AND sha256 = ? AND previous_sha256 = ?
+            ''', (delta_url, size, row['id'], row['sha256'], row['previous_sha256']))
+        conn.commit()
+    return built
+
+
+def prune_package_versions(conn, package_folder):
+    """
+    删除不再被引用的历史版本和补丁，返回删除的文件数。
+    版本历史 (software_versions) 中记录的摘要同样保留，否则这些版本无法连同安装包一起恢复；
+    历史版本文件随软件一起删除 (触发器清除其历史记录后的下一次清理)。
+    """
+    referenced = set()
+    pairs = set()
+    for sha256, previous in conn.execute('SELECT sha256, previous_sha256 FROM software'):
+        referenced.update(x for x in (sha256, previous) if x)
+        if sha256 and previous:
+            pairs.add((previous, sha256))
+    referenced.update(row[0] for row in conn.execute(
+        'SELECT DISTINCT sha256 FROM software_versions WHERE sha256 IS NOT NULL'))
+
+    removed = 0
+    versions_dir = os.path.join(package_folder, VERSIONS_DIR)
+    if os.path.isdir(versions_dir):
+        for name in os.listdir(versions_dir):
+            if name not in referenced and not name.endswith('.tmp'):
+                os.remove(os.path.join(versions_dir, name))
+                removed += 1
+
+    stale = [tuple(pair) for pair in conn.execute('SELECT from_sha256, to_sha256 FROM package_deltas') if tuple(pair) not in pairs]
+    for from_sha256, to_sha256 in stale:
+        path = os.path.join(package_folder, delta_name(from_sha256, to_sha256))
+        if os.path.exists(path):
+            os.remove(path)
+            removed += 1
+    conn.executemany('DELETE FROM package_deltas WHERE from_sha256 = ? AND to_sha256 = ?', stale)
+    conn.commit()
+    return removed
+
+
+def refresh_package_deltas(conn, package_folder, max_bytes=DELTA_MAX_BYTES):
+    """计算校验和之后调用：生成新的补丁并清理不再需要的历史版本，返回 (新补丁数, 删除的文件数)"""
+    built = update_package_deltas(conn, package_folder, max_bytes)
+    return built, prune_package_versions(conn, package_folder)
@@ -0,0 +1,331 @@
+"""
+安装包存储：/download/<文件名> 从 packages 目录提供真实的安装包。
+
+使用 send_from_directory(conditional=True)，由 Werkzeug 处理 Range / 206、If-Range、
+ETag 和 If-None-Match；文件通过 WSGI 服务器的 wsgi.file_wrapper 发送 (支持时为 sendfile 零拷贝)，
+不会整体读入 Python 内存，几百 MB 的安装包也可以断点续传。
+开启 FILE_OFFLOAD 时改由前端服务器发送 (见 file_offload.py)。
+
+software 表的 sha256 / size_bytes 列由服务端根据 packages 目录中的文件计算：
+上传安装包时边写边算；下载链接指向 /download/<路径> 或外部链接在本地镜像 (packages 目录中同名文件)
+中存在时，由后台线程补算。下载链接变化时触发器会清空这两列，等待重新计算。
+
+计算过的安装包按摘要在 packages/_versions/<sha256> 保留一份 (同一文件系统上为硬链接，不占额外空间)，
+校验和变化时旧摘要记入 previous_sha256，供 package_delta.py 生成相邻版本间的差分补丁。
+替换安装包时请使用 PUT 上传或 mv (原子替换)，原地覆盖写入会连带改写已保留的旧版本。
+"""
+import os
+import hashlib
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, unquote
+from werkzeug.security import safe_join
+from catalog_db import ensure_column, get_connection_pool, restore_software_version
+from file_offload import send_stored_file
+
+# 安装包在 Content-Disposition 中使用的默认 MIME 类型
+PACKAGE_MIMETYPE = 'application/octet-stream'
+# 计算校验和和上传安装包时每次读写的字节数
+PACKAGE_CHUNK_SIZE = 1024 * 1024
+# 按摘要保留的历史版本目录 (位于 packages 目录下)
+VERSIONS_DIR = '_versions'
+
+PACKAGE_SCHEMA = '''
+DROP TRIGGER IF EXISTS software_package_reset;
+CREATE TRIGGER software_package_reset AFTER UPDATE OF download_url ON software
+WHEN OLD.download_url IS NOT NEW.download_url AND NEW.sha256 IS OLD.sha256
+BEGIN
+    UPDATE software SET previous_sha256 = COALESCE(OLD.sha256, OLD.previous_sha256),
+                        sha256 = NULL, size_bytes = NULL
+    WHERE id = NEW.id;
+END;
+'''
+
+
+def find_package(package_folder, filename):
+    """返回安装包的绝对路径，不存在 (或路径越出 packages 目录) 时返回 None"""
+    path = safe_join(package_folder, filename)
+    if path is None or not os.path.isfile(path):
+        return None
+    return path
+
+
+def send_package(package_folder, filename):
+    """以附件形式流式发送安装包，支持断点续传和条件请求"""
+    response = send_stored_file(
+        package_folder, filename, 'packages',
+        mimetype=PACKAGE_MIMETYPE,
+        as_attachment=True,
+        download_name=os.path.basename(filename),
+        conditional=True,
+        etag=True,
+        # 安装包可能被同名替换，每次都用 ETag 重新验证
+        max_age=None,
+    )
+    response.cache_control.no_cache = True
+    return response
+
+
+# --- 校验和与大小 ---
+
+def init_package_schema(conn):
+    """为 software 表补充 sha256 / size_bytes / previous_sha256 列，并在下载链接变化时清空旧的校验和"""
+    ensure_column(conn, 'software', 'sha256', 'TEXT')
+    ensure_column(conn, 'software', 'size_bytes', 'INTEGER')
+    ensure_column(conn, 'software', 'previous_sha256', 'TEXT')
+    conn.executescript(PACKAGE_SCHEMA)
+    conn.commit()
+
+
+def hash_file(path):
+    """流式计算文件的 SHA-256，返回 (十六进制摘要, 字节数)"""
+    digest, size = hashlib.sha256(), 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(PACKAGE_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+class PackageHashCache:
+    """按 (路径, 大小, 修改时间) 缓存文件摘要，未变化的大文件不会重复计算"""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        stat = os.stat(path)
+        key = (stat.st_size, stat.st_mtime_ns)
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        result = hash_file(path)
+        with self._lock:
+            self._entries[path] = (key, result)
+        return result
+
+    def put(self, path, result):
+        stat = os.stat(path)
+        with self._lock:
+            self._entries[path] = ((stat.st_size, stat.st_mtime_ns), result)
+
+
+package_hashes = PackageHashCache()
+
+
+def package_relpath_for_url(download_url):
+    """
+    下载链接对应的 packages 目录内相对路径 (不检查文件是否存在)：/download/<路径> 取其中的路径，
+    其他外部链接取文件名 (本地镜像)；无法对应时返回 None。
+    """
+    if not download_url:
+        return None
+    url_path = unquote(urlsplit(download_url).path)
+    relpath = url_path.split('/download/', 1)[1] if '/download/' in url_path else os.path.basename(url_path)
+    return relpath or None
+
+
+def package_path_for_url(package_folder, download_url):
+    """下载链接对应的本地安装包路径，找不到时返回 None"""
+    relpath = package_relpath_for_url(download_url)
+    return find_package(package_folder, relpath) if relpath else None
+
+
+def find_software_for_package(conn, filename):
+    """下载链接指向 packages/<filename> 的软件 ID 列表，只比较链接，不读取任何安装包"""
+    target = os.path.normpath(filename)
+    # 先用文件名粗筛；含百分号编码的链接无法在 SQL 中比较，全部交给下面逐行判断
+    rows = conn.execute(
+        "SELECT id, download_url FROM software WHERE instr(download_url, ?) > 0 OR instr(download_url, '%') > 0",
+        (os.path.basename(target),)
+    ).fetchall()
+    software_ids = []
+    for row in rows:
+        relpath = package_relpath_for_url(row['download_url'])
+        if relpath and os.path.normpath(relpath) == target:
+            software_ids.append(row['id'])
+    return software_ids
+
+
+def version_path(package_folder, sha256):
+    """摘要为 sha256 的历史版本在 packages/_versions 中的路径"""
+    return os.path.join(package_folder, VERSIONS_DIR, sha256)
+
+
+def archive_package_version(package_folder, path, sha256):
+    """按摘要保留一份安装包，优先使用硬链接；已保留时直接返回"""
+    target = version_path(package_folder, sha256)
+    if os.path.exists(target):
+        return target
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    try:
+        os.link(path, tmp_path)
+    except OSError:
+        # 不支持硬链接的文件系统 (或跨设备) 时复制
+        shutil.copyfile(path, tmp_path)
+    os.replace(tmp_path, target)
+    return target
+
+
+class PackageVersionUnavailable(ValueError):
+    """历史版本的安装包无法恢复 (没有记录摘要，或 _versions 中的文件已被清理)"""
+
+
+def restore_package_version(package_folder, download_url, sha256):
+    """
+    把摘要为 sha256 的历史安装包从 packages/_versions 放回下载链接对应的位置 (硬链接或复制后原子替换)，
+    返回 (sha256, 字节数)。下载链接是外部地址且本地没有镜像时无需恢复文件，返回 None；
+    本地安装包无法按摘要恢复时抛出 PackageVersionUnavailable，避免把当前文件标记为旧版本。
+    """
+    relpath = package_relpath_for_url(download_url)
+    is_local = '/download/' in unquote(urlsplit(download_url).path)
+    if not is_local and not (relpath and find_package(package_folder, relpath)):
+        return None
+    if not sha256:
+        raise PackageVersionUnavailable('No checksum was recorded for this version, its package cannot be restored')
+    source = version_path(package_folder, sha256)
+    if not os.path.isfile(source):
+        raise PackageVersionUnavailable('The archived package of this version has been removed')
+    target = safe_join(package_folder, relpath) if relpath and not relpath.startswith('_') else None
+    if target is None:
+        raise PackageVersionUnavailable(f"Invalid package path: {relpath}")
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, target)
+    result = (sha256, os.path.getsize(target))
+    package_hashes.put(target, result)
+    return result
+
+
+def restore_software_with_package(conn, package_folder, software_id, version_id):
+    """
+    恢复软件的某个历史版本，连同安装包文件一起恢复 (见 restore_package_version)。
+    返回需要重新核对校验和的软件 ID 列表 (包括引用同一文件的其他软件)，找不到该版本时返回 None。
+    """
+    restored = []
+
+    def restore_package(download_url, sha256):
+        checksum = restore_package_version(package_folder, download_url, sha256)
+        if checksum is not None:
+            restored.append(package_relpath_for_url(download_url))
+        return checksum
+
+    if not restore_software_version(conn, software_id, version_id, restore_package):
+        return None
+    software_ids = {software_id}
+    for relpath in restored:
+        software_ids.update(find_software_for_package(conn, relpath))
+    return sorted(software_ids)
+
+
+def update_package_checksums(conn, package_folder, software_ids=None, recompute=False):
+    """
+    为下载链接指向本地安装包的软件计算 sha256 / size_bytes 并写回，只更新确实变化的行，返回更新的行数。
+    software_ids 为 None 时处理所有尚未计算的软件 (recompute=True 时处理全部软件)。
+    """
+    sql = 'SELECT id, download_url, sha256, size_bytes FROM software'
+    params = ()
+    if software_ids is not None:
+        software_ids = list(software_ids)
+        if not software_ids:
+            return 0
+        sql += f" WHERE id IN ({','.join('?' * len(software_ids))})"
+        params = software_ids
+    elif not recompute:
+        sql += ' WHERE sha256 IS NULL'
+
+    updates = []
+    for row in conn.execute(sql, params).fetchall():
+        path = package_path_for_url(package_folder, row['download_url'])
+        if path is None:
+            continue
+        sha256, size = package_hashes.get(path)
+        archive_package_version(package_folder, path, sha256)
+        if (sha256, size) != (row['sha256'], row['size_bytes']):
+            updates.append((sha256, sha256, size, row['id'], row['download_url']))
+
+    if updates:
+        # 计算期间下载链接被修改的行不写入，等下一次计算；安装包被同名替换时记下旧摘要
+        conn.executemany('''
+            UPDATE software SET
+                previous_sha256 = CASE WHEN sha256 IS NOT NULL AND sha256 != ? THEN sha256 ELSE previous_sha256 END,
+                sha256 = ?, size_bytes = ?
+            WHERE id = ? AND download_url = ?
+        ''', updates)
+        conn.commit()
+    return len(updates)
+
+
+def store_package(package_folder, filename, chunks):
+    """
+    把依次产生的字节块写入 packages/<filename>，同时计算 SHA-256，返回 (摘要, 字节数)。
+    先写入同目录的临时文件再原子替换，正在下载旧文件的客户端不受影响。
+    """
+    path = safe_join(package_folder, filename)
+    if path is None or filename.endswith('/'):
+        raise ValueError(f"Invalid package filename: {filename}")
+    if filename.startswith('_'):
+        # _versions / _deltas 等目录由服务端维护
+        raise ValueError(f"Reserved package filename: {filename}")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='.upload-', suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        digest, size = hashlib.sha256(), 0
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    result = (digest.hexdigest(), size)
+    package_hashes.put(path, result)
+    return result
+
+
+class PackageHasher:
+    """
+    在后台单线程中计算校验和，写接口提交后调用 schedule() 立即返回。
+    after_update(conn, package_folder) 在每次计算之后于同一线程中调用 (用于生成差分补丁)。
+    """
+
+    def __init__(self, after_update=None):
+        self._after_update = after_update
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def schedule(self, database, package_folder, software_ids=None):
+        """software_ids 为 None 时处理所有尚未计算校验和的软件"""
+        with self._lock:
+            # fork 出的子进程不会继承父进程的线程，需要重新创建线程池
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='package-hasher')
+                self._pid = os.getpid()
+            self._executor.submit(self._run, database, package_folder, software_ids)
+
+    def _run(self, database, package_folder, software_ids):
+        pool = get_connection_pool(database)
+        conn = pool.acquire()
+        try:
+            update_package_checksums(conn, package_folder, software_ids)
+            if self._after_update is not None:
+                self._after_update(conn, package_folder)
+        except Exception as e:
+            print(f"Package checksum update failed: {e}")
+        finally:
+            pool.release(conn)
@@ -0,0 +1,327 @@
+"""
+按需分析单个请求的耗时 (app.py 与 app_server.py 共用)。
+
+触发方式：
+  - 请求头 X-Profile: cprofile | sample，或查询参数 ?_profile=cprofile | sample (值为 1 时使用 cprofile)；
+    必须设置 APPSTORE_PROFILE_TOKEN，且请求携带相同值的 X-Profile-Token 请求头 / ?profile_token= 参数，
+    其余请求忽略该标记 (不按来源地址放行：同机的反向代理转发的请求也来自本机)；
+  - 按路由抽样：环境变量 APPSTORE_PROFILE_SAMPLE="/api/software=100;/=20" 表示这两个路由每 100 / 20 个请求分析一个。
+
+cprofile 使用标准库 cProfile 记录请求线程中的全部函数调用 (结果可用 snakeviz 等工具打开)，
+同一进程同时只能有一个 cProfile 在运行 (Python 3.12 起第二个会报错)，已有请求在分析时新的请求不做分析；
+sample 由后台线程每 PROFILE_SAMPLE_INTERVAL 秒读取一次请求线程的调用栈，开销更低，适合较慢的请求，
+结果为 flamegraph.pl / speedscope 可直接读取的折叠栈格式。
+
+结果保存在 profiles 目录 (APPSTORE_PROFILE_DIR 可修改)，每个请求一个结果文件和一个 .json 元数据文件，
+只保留最近 PROFILE_MAX_FILES 个 (保存的路径中去掉了 profile_token 参数)；
+/debug/profiles 列出结果 (访问限制同上)，响应头 X-Profile-Id 为本次结果的编号。
+"""
+import os
+import io
+import re
+import sys
+import hmac
+import html
+import json
+import time
+import pstats
+import cProfile
+import itertools
+import threading
+from collections import Counter
+from urllib.parse import urlencode
+from flask import g, request, abort, Response, send_from_directory
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+# 最多保留的结果个数，超出时删除最早的
+PROFILE_MAX_FILES = 500
+# sample 模式的采样间隔 (秒)
+PROFILE_SAMPLE_INTERVAL = 0.002
+# 报告中显示的函数 / 调用栈条数
+REPORT_LINES = 60
+PROFILE_MODES = ('cprofile', 'sample')
+# 携带令牌的查询参数，保存结果时从路径中去掉
+TOKEN_PARAM = 'profile_token'
+RESULT_EXTENSIONS = {'cprofile': '.prof', 'sample': '.folded'}
+PROFILE_ID_PATTERN = re.compile(r'^[0-9]{8}-[0-9]{6}-[0-9]+-[0-9]+$')
+
+_sequence = itertools.count(1)
+# 同一进程中正在运行的 cProfile 只能有一个，非阻塞获取，拿不到时本次请求不分析
+_cprofile_lock = threading.Lock()
+
+
+# --- 分析器 ---
+
+class StackSampler:
+    """定时读取目标线程的调用栈 (sys._current_frames)，统计各调用栈出现的次数"""
+
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+        self._target = None
+
+    def enable(self):
+        self._target = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+        self._thread.start()
+
+    def disable(self):
+        # 先清除目标线程，停止过程中不再记录 (否则会采到 disable 本身)
+        self._target = None
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def dump_stats(self, path):
+        """折叠栈格式：每行 "调用栈 次数"，调用栈从外到内以分号分隔"""
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.counts.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+# --- 配置与触发 ---
+
+def parse_sample_rates(value):
+    """解析 "/api/software=100;/=20" 形式的抽样配置，返回 {路由规则: N}"""
+    rates = {}
+    for item in (value or '').split(';'):
+        rule, _, rate = item.strip().rpartition('=')
+        if rule and rate.isdigit() and int(rate) > 0:
+            rates[rule] = int(rate)
+    return rates
+
+
+def profiling_allowed(app):
+    """携带正确令牌的请求；没有设置 APPSTORE_PROFILE_TOKEN 时按需分析和结果页面都不可用"""
+    token = app.config.get('PROFILE_TOKEN')
+    if not token:
+        return False
+    supplied = request.headers.get('X-Profile-Token') or request.args.get(TOKEN_PARAM) or ''
+    return hmac.compare_digest(supplied.encode(), token.encode())
+
+
+def requested_mode(app):
+    """本次请求要求的分析方式 (没有要求或无权要求时返回 None)"""
+    value = request.headers.get('X-Profile') or request.args.get('_profile')
+    if not value:
+        return None
+    value = 'cprofile' if value == '1' else value.lower()
+    if value not in PROFILE_MODES or not profiling_allowed(app):
+        return None
+    return value
+
+
+class RouteSampler:
+    """按路由计数，每 N 个请求返回一次 True (itertools.count 的 next() 不需要加锁)"""
+
+    def __init__(self, rates):
+        self.rates = rates
+        self._counters = {rule: itertools.count() for rule in rates}
+
+    def should_sample(self, rule):
+        counter = self._counters.get(rule)
+        return counter is not None and next(counter) % self.rates[rule] == 0
+
+
+# --- 结果保存 ---
+
+def new_profile_id():
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(_sequence)}"
+
+
+def request_path():
+    """请求路径和查询参数，去掉令牌参数 (结果列表对所有持有令牌的人可见，令牌不应出现在其中)"""
+    args = [(key, value) for key, value in request.args.items(multi=True) if key != TOKEN_PARAM]
+    return f"{request.path}?{urlencode(args)}" if args else request.path
+
+
+def save_profile(folder, profiler, mode, trigger, duration, status):
+    """写入结果文件和元数据，返回结果编号"""
+    os.makedirs(folder, exist_ok=True)
+    profile_id = new_profile_id()
+    profiler.dump_stats(os.path.join(folder, profile_id + RESULT_EXTENSIONS[mode]))
+    meta = {
+        'id': profile_id,
+        'mode': mode,
+        'trigger': trigger,
+        'method': request.method,
+        'path': request_path(),
+        'route': request.url_rule.rule if request.url_rule is not None else None,
+        'status': status,
+        'duration_ms': round(duration * 1000, 2),
+        'created_at': time.time(),
+    }
+    with open(os.path.join(folder, profile_id + '.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    prune_profiles(folder)
+    return profile_id
+
+
+def list_profiles(folder, limit=PROFILE_MAX_FILES):
+    """按时间倒序返回结果的元数据"""
+    if not os.path.isdir(folder):
+        return []
+    names = sorted((name for name in os.listdir(folder) if name.endswith('.json')),
+                   key=lambda name: os.path.getmtime(os.path.join(folder, name)), reverse=True)
+    profiles = []
+    for name in names[:limit]:
+        try:
+            with open(os.path.join(folder, name), encoding='utf-8') as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return profiles
+
+
+def prune_profiles(folder, keep=PROFILE_MAX_FILES):
+    """删除超出保留个数的最早结果 (多个 worker 同时删除同一个文件时忽略)"""
+    metas = sorted((name for name in os.listdir(folder) if name.endswith('.json')),
+                   key=lambda name: os.path.getmtime(os.path.join(folder, name)))
+    for name in metas[:max(0, len(metas) - keep)]:
+        profile_id = name[:-len('.json')]
+        for ext in ('.json',) + tuple(RESULT_EXTENSIONS.values()):
+            try:
+                os.remove(os.path.join(folder, profile_id + ext))
+            except FileNotFoundError:
+                pass
+
+
+def render_report(folder, meta):
+    """文本报告：cprofile 按累计耗时排序；sample 列出采样最多的函数 (自身) 和调用栈"""
+    path = os.path.join(folder, meta['id'] + RESULT_EXTENSIONS[meta['mode']])
+    header = f"{meta['method']} {meta['path']}  status={meta['status']}  {meta['duration_ms']} ms  ({meta['mode']}, {meta['trigger']})\n\n"
+    if meta['mode'] == 'cprofile':
+        stream = io.StringIO()
+        stats = pstats.Stats(path, stream=stream)
+        stats.sort_stats('cumulative').print_stats(REPORT_LINES)
+        return header + stream.getvalue()
+
+    stacks = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            stacks.append((stack, int(count)))
+    total = sum(count for _, count in stacks) or 1
+    leaves = Counter()
+    for stack, count in stacks:
+        leaves[stack.rsplit(';', 1)[-1]] += count
+    lines = [header, f"共 {total} 个样本 (间隔 {PROFILE_SAMPLE_INTERVAL * 1000:g} ms)\n\n按函数自身：\n"]
+    lines += [f"{count:8d} {count * 100 / total:6.1f}%  {name}\n" for name, count in leaves.most_common(REPORT_LINES)]
+    lines.append("\n调用栈：\n")
+    lines += [f"{count:8d}  {stack}\n" for stack, count in stacks[:REPORT_LINES]]
+    return ''.join(lines)
+
+
+# --- Flask 集成 ---
+
+def init_profiling(app):
+    """
+    注册分析钩子和 /debug/profiles 页面。需在其他 init_* 之前调用：
+    before_request 最先执行、after_request 最后执行，分析范围覆盖视图函数和其他钩子。
+    """
+    app.config.setdefault('PROFILE_FOLDER', os.environ.get('APPSTORE_PROFILE_DIR') or os.path.join(APP_ROOT, 'profiles'))
+    app.config.setdefault('PROFILE_TOKEN', os.environ.get('APPSTORE_PROFILE_TOKEN') or None)
+    app.config.setdefault('PROFILE_SAMPLE_RATES', parse_sample_rates(os.environ.get('APPSTORE_PROFILE_SAMPLE')))
+    sampler = RouteSampler(app.config['PROFILE_SAMPLE_RATES'])
+
+    @app.before_request
+    def start_profiler():
+        mode, trigger = requested_mode(app), 'request'
+        if mode is None and sampler.rates and request.url_rule is not None \
+                and sampler.should_sample(request.url_rule.rule):
+            mode, trigger = 'cprofile', 'sample'
+        if mode is None:
+            return
+        if mode == 'cprofile':
+            if not _cprofile_lock.acquire(blocking=False):
+                return
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError as e:
+                # 调试器、coverage 等其他分析工具已经占用了 sys.monitoring
+                _cprofile_lock.release()
+                app.logger.warning(f"Profiling skipped: {e}")
+                return
+        else:
+            profiler = StackSampler()
+            profiler.enable()
+        g._profile = (profiler, mode, trigger, time.perf_counter())
+
+    @app.after_request
+    def stop_profiler(response):
+        profile_id = _finish_profile(app, response.status_code)
+        if profile_id:
+            response.headers['X-Profile-Id'] = profile_id
+        return response
+
+    @app.teardown_request
+    def abort_profiler(exception):
+        # 视图抛出未处理的异常时 after_request 不会执行
+        _finish_profile(app, 500)
+
+    def profiles_page():
+        if not profiling_allowed(app):
+            abort(404)
+        rows = ''.join(
+            f"<tr><td>{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(meta['created_at']))}</td>"
+            f"<td>{meta['method']}</td><td><a href=\"/debug/profiles/{meta['id']}\">{html.escape(meta['path'])}</a></td>"
+            f"<td>{meta['status']}</td><td style=\"text-align:right\">{meta['duration_ms']}</td>"
+            f"<td>{meta['mode']}</td><td>{meta['trigger']}</td>"
+            f"<td><a href=\"/debug/profiles/{meta['id']}?download=1\">下载</a></td></tr>"
+            for meta in list_profiles(app.config['PROFILE_FOLDER'])
+        )
+        page = f"""<!DOCTYPE html>
+<html lang="zh-CN"><head><meta charset="UTF-8"><title>请求分析结果</title>
+<style>body{{font-family:sans-serif;margin:24px}} table{{border-collapse:collapse}}
+td,th{{border:1px solid #ddd;padding:4px 8px;font-size:13px}} th{{background:#f5f5f5}}</style></head>
+<body><h2>请求分析结果</h2>
+<p>在请求中添加 <code>X-Profile: cprofile</code> (或 <code>sample</code>) 和 <code>X-Profile-Token</code> 请求头，或 <code>?_profile=1&amp;profile_token=...</code> 参数，即可分析该请求。</p>
+<table><tr><th>时间</th><th>方法</th><th>路径</th><th>状态</th><th>耗时 (ms)</th><th>方式</th><th>来源</th><th></th></tr>
+{rows or '<tr><td colspan="8">暂无结果</td></tr>'}</table></body></html>"""
+        return Response(page, mimetype='text/html')
+
+    def profile_detail(profile_id):
+        if not profiling_allowed(app) or not PROFILE_ID_PATTERN.match(profile_id):
+            abort(404)
+        folder = app.config['PROFILE_FOLDER']
+        try:
+            with open(os.path.join(folder, profile_id + '.json'), encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            abort(404)
+        if request.args.get('download'):
+            return send_from_directory(folder, profile_id + RESULT_EXTENSIONS[meta['mode']], as_attachment=True)
+        return Response(render_report(folder, meta), mimetype='text/plain')
+
+    app.add_url_rule('/debug/profiles', 'debug_profiles', profiles_page)
+    app.add_url_rule('/debug/profiles/<profile_id>', 'debug_profile_detail', profile_detail)
+    return app
+
+
+def _finish_profile(app, status):
+    state = g.pop('_profile', None)
+    if state is None:
+        return None
+    profiler, mode, trigger, started = state
+    profiler.disable()
+    duration = time.perf_counter() - started
+    if mode == 'cprofile':
+        _cprofile_lock.release()
+    try:
+        return save_profile(app.config['PROFILE_FOLDER'], profiler, mode, trigger, duration, status)
+    except OSError as e:
+        app.logger.warning(f"Saving profile failed: {e}")
+        return None
@@ -1,7 +1,20 @@
 // /pwa/app.js
 const API_URL = 'http://localhost:5000/api/software';
+const CHANGES_URL = `${API_URL}/changes`;
+// 全部 Logo 拼成的雪碧图坐标表，首屏只需一次图片请求
+const SPRITE_URL = `${API_URL}/logo-sprite`;
 const BASE_URL = 'http://localhost:5000';
+// 列表界面需要的字段，首次加载时分页获取
+const CATALOG_FIELDS = 'name,version,description,category,logo_url,install_type,download_url,silent_args,sha256,size_bytes';
+const FIRST_PAGE_SIZE = 50;
+const PAGE_SIZE = 200;
+// 列表图标使用服务端预生成的缩略图 (/logos/<name>?size=40)，浏览器无需下载和缩放原图
+const LOGO_SIZE = 40;
 let allSoftwareData = [];
+// 最近一次同步到的目录版本号，用于增量同步
+let catalogRevision = null;
+// 当前使用的雪碧图 ({revision, size, image, tiles})，加载失败时为 null，逐个加载 Logo
+let logoSprite = null;
 
 document.addEventListener('DOMContentLoaded', () => {
     // 注册 Service Worker，启用 PWA 功能
@@ -23,11 +36,15 @@ async function fetchSoftwareData() {
     statusText.className = 'text-info';
 
     try {
-        const response = await fetch(API_URL);
-        if (!response.ok) {
-            throw new Error(`HTTP error! status: ${response.status}`);
+        // 雪碧图与软件列表并行加载，失败不影响列表显示
+        const spriteLoaded = loadLogoSprite();
+        // 已有版本号时只拉取增量变更，否则下载完整列表
+        if (catalogRevision !== null) {
+            await syncSoftwareChanges();
+        } else {
+            await loadFullCatalog();
         }
-        allSoftwareData = await response.json();
+        await spriteLoaded;
         filterSoftware(); // 初次加载并渲染所有数据
         statusText.textContent = '软件列表加载成功。';
         statusText.className = 'text-success';
@@ -39,6 +56,81 @@ async function fetchSoftwareData() {
     }
 }
 
+async function loadFullCatalog() {
+    // 分页加载：首屏数据到达后立即渲染，其余页在后台继续加载
+    let url = `${API_URL}?limit=${FIRST_PAGE_SIZE}&fields=${CATALOG_FIELDS}`;
+    const softwareList = [];
+    let revision = null;
+
+    while (url) {
+        const response = await fetch(url);
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        softwareList.push(...await response.json());
+        if (revision === null) {
+            // 以第一页的版本号为准，分页期间发生的变更会在下次增量同步时补上
+            revision = response.headers.get('X-Catalog-Revision');
+        }
+
+        const nextCursor = response.headers.get('X-Next-Cursor');
+        url = null;
+        if (nextCursor) {
+            if (softwareList.length <= FIRST_PAGE_SIZE) {
+                allSoftwareData = softwareList.slice();
+                filterSoftware();
+            }
+            url = `${API_URL}?limit=${PAGE_SIZE}&fields=${CATALOG_FIELDS}&after=${encodeURIComponent(nextCursor)}`;
+        }
+    }
+
+    allSoftwareData = softwareList;
+    catalogRevision = revision !== null ? parseInt(revision, 10) : null;
+}
+
+async function loadLogoSprite() {
+    try {
+        const response = await fetch(`${SPRITE_URL}?size=${LOGO_SIZE}&format=webp`);
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        const sprite = await response.json();
+        sprite.image = `${BASE_URL}${sprite.image}`;
+        logoSprite = sprite;
+    } catch (error) {
+        console.warn("Failed to load logo sprite, falling back to per-logo requests:", error);
+    }
+}
+
+async function syncSoftwareChanges() {
+    const response = await fetch(`${CHANGES_URL}?since=${catalogRevision}`);
+    if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+    }
+    const changes = await response.json();
+
+    if (changes.full) {
+        // 服务器已清理旧的变更记录，返回的是完整列表
+        allSoftwareData = changes.software;
+    } else {
+        const deletedIds = new Set(changes.deleted);
+        const upserted = new Map(changes.upserted.map(software => [software.id, software]));
+        // 修改过的软件原位替换，新增的软件显示在列表最前面
+        const kept = allSoftwareData
+            .filter(software => !deletedIds.has(software.id))
+            .map(software => {
+                const updated = upserted.get(software.id);
+                if (updated) {
+                    upserted.delete(software.id);
+                    return updated;
+                }
+                return software;
+            });
+        allSoftwareData = [...upserted.values()].concat(kept);
+    }
+    catalogRevision = changes.revision;
+}
+
 function filterSoftware() {
     const searchTerm = document.getElementById('search-input').value.toLowerCase().trim();
     
@@ -53,15 +145,30 @@ function filterSoftware() {
     renderSoftwareList(filteredList);
 }
 
-function getLogoUrl(software) {
+function getLogoUrl(software, size = LOGO_SIZE) {
     const logoPath = software.logo_url;
     if (logoPath && logoPath.startsWith('/logos/')) {
-        return `${BASE_URL}${logoPath}`;
+        return `${BASE_URL}${logoPath}?size=${size}`;
+    }
+    if (logoPath && logoPath.startsWith(`${BASE_URL}/logos/`)) {
+        return `${logoPath}?size=${size}`;
     }
     // TODO: 提供一个合理的默认 Logo 路径
     return '/pwa/icons/placeholder.png'; 
 }
 
+function formatSize(bytes) {
+    // 安装包大小由服务端计算，下载前即可显示
+    const units = ['B', 'KB', 'MB', 'GB'];
+    let size = bytes;
+    let unit = 0;
+    while (size >= 1024 && unit < units.length - 1) {
+        size /= 1024;
+        unit++;
+    }
+    return `${size.toFixed(unit === 0 ? 0 : 1)} ${units[unit]}`;
+}
+
 function handleInstallClick(software) {
     const installType = software.install_type ? software.install_type.toLowerCase() : 'silent';
     
@@ -95,6 +202,8 @@ function renderSoftwareList(softwareList) {
 
     softwareList.forEach(software => {
         const logoUrl = getLogoUrl(software);
+        // 高分屏使用更大一档的缩略图
+        const logoUrl2x = getLogoUrl(software, LOGO_SIZE * 2);
         const installType = software.install_type ? software.install_type.toLowerCase() : 'silent';
         
         let description = software.description || '无描述';
@@ -105,9 +214,15 @@ function renderSoftwareList(softwareList) {
         const item = document.createElement('div');
         item.className = 'row software-item mx-0';
         
+        const tile = logoSprite && logoSprite.tiles[software.id];
+        // 雪碧图中有该图标时用背景定位显示，否则单独加载缩略图
+        const logoHtml = tile
+            ? `<span class="software-logo logo-sprite" role="img" aria-label="${software.name} Logo" style="background-image: url('${logoSprite.image}'); background-position: -${tile[0]}px -${tile[1]}px;"></span>`
+            : `<img src="${logoUrl}" srcset="${logoUrl} 1x, ${logoUrl2x} 2x" alt="${software.name} Logo" class="software-logo" onerror="this.onerror=null;this.src='/pwa/icons/placeholder.png';">`;
+        
         item.innerHTML = `
             <div class="col-1 d-flex justify-content-center">
-                <img src="${logoUrl}" alt="${software.name} Logo" class="software-logo" onerror="this.onerror=null;this.src='/pwa/icons/placeholder.png';">
+                ${logoHtml}
             </div>
             <div class="col-3">
                 <h5 class="fw-bold text-primary mb-0">${software.name}</h5>
@@ -115,6 +230,7 @@ function renderSoftwareList(softwareList) {
             </div>
             <div class="col-2 text-center text-secondary">
                 ${software.version || 'N/A'}
+                ${software.size_bytes ? `<div class="small text-muted">${formatSize(software.size_bytes)}</div>` : ''}
             </div>
             <div class="col-4 text-muted small">
                 ${description}
@@ -0,0 +1,326 @@
+"""
+生产环境启动器 (纯 Python，只依赖 Werkzeug)：
+
+    python serve.py app --workers 4 --threads 8 --port 5000
+    python serve.py app_server --host 0.0.0.0
+
+主进程导入应用模块并调用其 bootstrap() 做一次性初始化 (建表、占位文件等)，
+然后创建监听套接字，fork 出多个 worker；每个 worker 用固定大小的线程池处理连接，
+只在有空闲线程时 accept，线程全忙的 worker 不再接收连接，新连接留给其他 worker。
+Werkzeug 的请求处理每个响应后都会关闭连接 (Connection: close)，不支持 HTTP/1.1 长连接。
+  - worker 处理 --max-requests 个请求后自动退出并由主进程补齐 (加随机抖动，避免同时重启)；
+  - SIGTERM / SIGINT：停止接受新连接，等待进行中的请求完成后退出；
+  - SIGHUP：平滑重载。主进程带着监听套接字重新执行自身 (重新导入代码)，
+    新 worker 启动后再让旧 worker 处理完手头的请求退出，期间不会拒绝连接。
+不支持 fork 的平台 (Windows) 上退化为单进程线程池服务器。
+"""
+import os
+import sys
+import time
+import errno
+import random
+import shutil
+import signal
+import socket
+import threading
+import importlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import click
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler, select_address_family
+
+# 重新执行主进程 (SIGHUP) 时，通过环境变量把监听套接字和需要退役的旧 worker 交给新主进程
+LISTEN_FD_ENV = 'APPSTORE_SERVE_FD'
+RETIRE_PIDS_ENV = 'APPSTORE_SERVE_RETIRE'
+# 多个 worker 共享的指标快照目录 (见 metrics.py)；未设置时由主进程创建临时目录，退出时删除
+METRICS_DIR_ENV = 'APPSTORE_METRICS_DIR'
+METRICS_TEMP_ENV = 'APPSTORE_METRICS_TEMP_DIR'
+# worker 在 accept 或等待空闲线程时最长阻塞的时间，到时检查是否收到了退出信号
+WORKER_POLL_SECONDS = 1.0
+# 读取请求的套接字超时 (秒)，避免迟迟不发完请求的慢速客户端一直占住线程
+REQUEST_TIMEOUT = 5
+CAN_FORK = hasattr(os, 'fork')
+
+
+class PooledRequestHandler(WSGIRequestHandler):
+    """
+    使用 HTTP/1.1 (没有 Content-Length 的响应按 chunked 发送)；Werkzeug 在每个响应后关闭连接，
+    因此每个连接只处理一个请求。套接字读写超过 timeout 秒未完成时断开，避免慢速客户端占住线程池
+    """
+
+    protocol_version = 'HTTP/1.1'
+    timeout = REQUEST_TIMEOUT
+    access_log = True
+
+    def make_environ(self):
+        environ = super().make_environ()
+        # 应用据此为目录接口保留线程 (见 admission.py)
+        environ['appstore.threads'] = self.server.threads
+        return environ
+
+    def log_request(self, code='-', size='-'):
+        if self.access_log:
+            super().log_request(code, size)
+
+
+def make_handler(access_log):
+    """按命令行参数生成请求处理类"""
+    return type('ConfiguredRequestHandler', (PooledRequestHandler,), {'access_log': access_log})
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """用固定大小线程池处理连接的 WSGI 服务器 (werkzeug 的 threaded 模式每个连接新建一个线程)"""
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads, handler=None, fd=None, multiprocess=False):
+        self.multiprocess = multiprocess
+        self.threads = threads
+        super().__init__(host, port, app, handler=handler, fd=fd)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='http')
+        # 空闲线程数：accept 前取得一个，连接处理完 (shutdown_request) 后归还
+        self._slots = threading.BoundedSemaphore(threads)
+        self.handled = 0
+        self._count_lock = threading.Lock()
+        # 统计请求数，供 --max-requests 使用
+        wsgi_app = self.app
+
+        def counting_app(environ, start_response):
+            with self._count_lock:
+                self.handled += 1
+            return wsgi_app(environ, start_response)
+
+        self.app = counting_app
+
+    def get_request(self):
+        """
+        有空闲线程时才 accept：线程全忙时连接留在共享的监听队列中，由其他 worker 接收，
+        而不是在本进程的线程池队列里排队。等待超时时抛出 OSError，serve_forever / handle_request 会直接返回
+        """
+        if not self._slots.acquire(timeout=WORKER_POLL_SECONDS):
+            raise socket.timeout('no idle thread')
+        try:
+            return super().get_request()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def shutdown_request(self, request):
+        # 每个 accept 到的连接 (无论正常处理还是出错) 都会恰好调用一次
+        try:
+            super().shutdown_request(request)
+        finally:
+            self._slots.release()
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._process_request_thread, request, client_address)
+
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def drain(self):
+        """停止接受新连接后调用：等待线程池中的请求完成"""
+        self.executor.shutdown(wait=True)
+        self.socket.close()
+
+
+def load_target(target):
+    """导入应用模块，返回 (模块, Flask 应用)"""
+    module = importlib.import_module(target)
+    return module, module.app
+
+
+def create_listen_socket(host, port, backlog):
+    """创建监听套接字；重载后的新主进程直接使用继承来的套接字"""
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+    if fd is not None:
+        return socket.socket(fileno=int(fd))
+    family = select_address_family(host, port)
+    return socket.create_server((host, port), family=family, backlog=backlog)
+
+
+def run_worker(app, sock, options):
+    """worker 进程主循环：收到信号或达到请求上限后停止接受连接，处理完手头请求退出"""
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    host, port = sock.getsockname()[:2]
+    server = PooledWSGIServer(host, port, app, options['threads'], handler=options['handler'],
+                              fd=sock.fileno(), multiprocess=True)
+    sock.close()
+    # 多个 worker 共享同一个监听套接字，被其他 worker 抢先 accept 时立即返回而不是阻塞
+    server.socket.setblocking(False)
+    server.timeout = WORKER_POLL_SECONDS
+
+    max_requests = options['max_requests']
+    if max_requests:
+        max_requests += random.randint(0, options['max_requests_jitter'])
+    while not stopping and not (max_requests and server.handled >= max_requests):
+        server.handle_request()
+    server.drain()
+    if options.get('worker_exit') is not None:
+        options['worker_exit']()
+
+
+class Arbiter:
+    """主进程：维持 worker 数量，处理信号、回收和重载"""
+
+    def __init__(self, app, sock, options):
+        self.app = app
+        self.sock = sock
+        self.options = options
+        self.workers = set()
+        self.stopping = False
+        self.reloading = False
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(self.app, self.sock, self.options)
+            except Exception as e:
+                print(f"[worker {os.getpid()}] 异常退出: {e}", file=sys.stderr)
+                code = 1
+            finally:
+                os._exit(code)
+        self.workers.add(pid)
+
+    def reap_workers(self):
+        """回收已退出的子进程，返回本轮退出的 worker 数 (不含旧主进程留下的 worker)"""
+        exited = 0
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return exited
+            if pid == 0:
+                return exited
+            if pid in self.workers:
+                self.workers.discard(pid)
+                exited += 1
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+
+        for _ in range(self.options['workers']):
+            self.spawn_worker()
+        # 重载后：新 worker 已就绪，通知旧主进程留下的 worker 处理完请求后退出
+        retired = [int(pid) for pid in os.environ.pop(RETIRE_PIDS_ENV, '').split(',') if pid]
+        for pid in retired:
+            self._signal(pid, signal.SIGTERM)
+
+        while not self.stopping:
+            time.sleep(0.5)
+            self.reap_workers()
+            if self.reloading:
+                self.reexec()
+            # 达到请求上限或异常退出的 worker 由这里补齐
+            while len(self.workers) < self.options['workers'] and not self.stopping:
+                self.spawn_worker()
+        self.shutdown()
+
+    def shutdown(self):
+        """通知所有 worker 平滑退出，超过 graceful_timeout 仍未退出的强制结束"""
+        for pid in self.workers:
+            self._signal(pid, signal.SIGTERM)
+        deadline = time.time() + self.options['graceful_timeout']
+        while self.workers and time.time() < deadline:
+            self.reap_workers()
+            time.sleep(0.1)
+        for pid in self.workers:
+            self._signal(pid, signal.SIGKILL)
+        self.sock.close()
+
+    def reexec(self):
+        """带着监听套接字重新执行主进程，旧 worker 由新主进程在新 worker 启动后退役"""
+        print("[serve] 收到 SIGHUP，重新加载...")
+        os.set_inheritable(self.sock.fileno(), True)
+        env = dict(os.environ)
+        env[LISTEN_FD_ENV] = str(self.sock.fileno())
+        env[RETIRE_PIDS_ENV] = ','.join(str(pid) for pid in self.workers)
+        os.execve(sys.executable, [sys.executable] + sys.argv, env)
+
+    def _on_stop(self, signum, frame):
+        self.stopping = True
+
+    def _on_reload(self, signum, frame):
+        self.reloading = True
+
+    @staticmethod
+    def _signal(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+
+def serve_threaded(app, host, port, threads=8, access_log=True):
+    """单进程线程池服务器 (不支持 fork 的平台，或只需要一个进程的桌面端服务)"""
+    server = PooledWSGIServer(host, port, app, threads, handler=make_handler(access_log))
+    print(f"[serve] 单进程模式，{threads} 个线程，监听 http://{host}:{server.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.drain()
+
+
+@click.command()
+@click.argument('target', default='app')
+@click.option('--host', default='127.0.0.1', show_default=True, envvar='APPSTORE_HOST')
+@click.option('--port', default=5000, show_default=True, envvar='APPSTORE_PORT')
+@click.option('--workers', default=2, show_default=True, envvar='APPSTORE_WORKERS', help='worker 进程数')
+@click.option('--threads', default=8, show_default=True, envvar='APPSTORE_THREADS', help='每个 worker 的线程数')
+@click.option('--max-requests', default=10000, show_default=True, help='worker 处理多少个请求后重启，0 表示不重启')
+@click.option('--max-requests-jitter', default=1000, show_default=True, help='请求上限上附加的随机量')
+@click.option('--graceful-timeout', default=30, show_default=True, help='停止时等待进行中请求的最长秒数')
+@click.option('--backlog', default=2048, show_default=True)
+@click.option('--access-log/--no-access-log', default=True, show_default=True)
+def main(target, host, port, workers, threads, max_requests, max_requests_jitter,
+         graceful_timeout, backlog, access_log):
+    """以多进程 (pre-fork) + 线程池方式运行 TARGET 模块中的 Flask 应用 (app / app_server / installer_client)"""
+    module, app = load_target(target)
+    bootstrap = getattr(module, 'bootstrap', None)
+    if bootstrap is not None:
+        # 一次性初始化只在主进程中执行，worker 直接继承结果
+        bootstrap()
+
+    if not CAN_FORK:
+        serve_threaded(app, host, port, threads, access_log)
+        return
+
+    sock = create_listen_socket(host, port, backlog)
+    if METRICS_DIR_ENV not in os.environ:
+        # 重载 (重新执行主进程) 时环境变量保留，继续使用同一个目录
+        os.environ[METRICS_DIR_ENV] = os.environ[METRICS_TEMP_ENV] = tempfile.mkdtemp(prefix='appstore-metrics-')
+    options = {
+        'workers': max(1, workers),
+        'threads': max(1, threads),
+        'handler': make_handler(access_log),
+        'max_requests': max_requests,
+        'max_requests_jitter': max_requests_jitter,
+        'graceful_timeout': graceful_timeout,
+        # 应用模块可以提供 worker_exit()，在 worker 处理完请求、退出之前调用
+        'worker_exit': getattr(module, 'worker_exit', None),
+    }
+    print(f"[serve] 主进程 {os.getpid()}：{options['workers']} 个 worker × {options['threads']} 个线程，"
+          f"监听 http://{host}:{sock.getsockname()[1]}")
+    Arbiter(app, sock, options).run()
+    if os.environ.get(METRICS_TEMP_ENV):
+        shutil.rmtree(os.environ[METRICS_TEMP_ENV], ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()